@@ -1,54 +1,95 @@
 import logging
 import csv
+import os
 import sys
-from modules import simulation_utils
+import argparse
+import time
+from modules import simulation_utils, metrikker
 from tabulate import tabulate
 
 # Config logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("AutoTest")
 
-def main():
-    logger.info("Starter automatisert testing...")
+def les_parametre(argv=None):
+    parser = argparse.ArgumentParser(description="Automatisert testing av visjon + levering")
+    parser.add_argument("--arbeidere", type=int, default=1, help="Antall prosesser (resultatet er likt uansett antall)")
+    parser.add_argument("--seed", type=int, default=0, help="Rot-seed for hele kjøringen")
+    # Parameter-rutenett. Oppgis ingen av disse, kjøres standard-scenarioene.
+    parser.add_argument("--stoy", type=float, nargs="+", help="Støynivåer, f.eks. 0 0.05 0.15")
+    parser.add_argument("--bilder", type=int, nargs="+", help="Antall bilder per oppgang")
+    parser.add_argument("--oppganger", type=int, nargs="+", help="Antall oppganger")
+    parser.add_argument("--pakker", type=int, nargs="+", help="Antall pakker")
+    parser.add_argument("--volum-fordeling", type=float, nargs=3, metavar=("S", "M", "L"), help="Andel pakker per volumklasse")
+    parser.add_argument("--zipf", type=float, help="Skjev mottakerfordeling (Zipf-eksponent, f.eks. 1.1)")
+    parser.add_argument("--csv", default="resultater.csv", help="Resultatfil (flettes på scenarionavn, volumfordeling og zipf)")
+    parser.add_argument("--lagre-bilder", action="store_true", help="Skriv testbildene til data/temp_test_bilder (debug)")
+    parser.add_argument("--uten-metrikker", action="store_true", help="Ikke mål tid per steg i bildeanalysen")
+    return parser.parse_args(argv)
+
+def _flettenokkel(rad):
+    # Eldre rader mangler kolonnene: standard fordelinger
+    return rad["navn"], rad.get("volum_fordeling") or "", rad.get("zipf") or ""
+
+def flett_resultater(csv_file, results):
+    """
+    Fletter nye resultater inn i CSV-filen. Rader med samme scenarionavn,
+    volumfordeling og zipf erstattes, øvrige rader beholdes.
+    """
+    rader = {}
+    if os.path.exists(csv_file):
+        with open(csv_file, newline='') as f:
+            for rad in csv.DictReader(f):
+                rader[_flettenokkel(rad)] = rad
+    for r in results:
+        rader[_flettenokkel(r)] = r
     
-    # Definer test-scenarioer
-    scenarios = [
-        {"navn": "Baseline (Lav støy)", "oppganger": 5, "pakker": 100, "stoy": 0.0, "bilder": 1},
-        {"navn": "Realistisk (Litt støy)", "oppganger": 5, "pakker": 100, "stoy": 0.05, "bilder": 3},
-        {"navn": "Vanskelig (Mye støy)", "oppganger": 5, "pakker": 100, "stoy": 0.15, "bilder": 3},
-        {"navn": "Ekstrem (Kraftig støy)", "oppganger": 5, "pakker": 100, "stoy": 0.25, "bilder": 5}, # Tester om flere bilder kompenserer
-    ]
+    keys = results[0].keys()
+    with open(csv_file, 'w', newline='') as f:
+        dict_writer = csv.DictWriter(f, fieldnames=keys, extrasaction='ignore')
+        dict_writer.writeheader()
+        dict_writer.writerows(rader.values())
+
+def main(argv=None):
+    args = les_parametre(argv)
+    logger.info("Starter automatisert testing...")
     
-    results = []
+    if any(v is not None for v in (args.stoy, args.bilder, args.oppganger, args.pakker)):
+        scenarios = simulation_utils.scenario_rutenett(
+            stoy=args.stoy or [0.05],
+            bilder=args.bilder or [3],
+            oppganger=args.oppganger or [5],
+            pakker=args.pakker or [100]
+        )
+    else:
+        # Definer test-scenarioer
+        scenarios = [
+            {"navn": "Baseline (Lav støy)", "oppganger": 5, "pakker": 100, "stoy": 0.0, "bilder": 1},
+            {"navn": "Realistisk (Litt støy)", "oppganger": 5, "pakker": 100, "stoy": 0.05, "bilder": 3},
+            {"navn": "Vanskelig (Mye støy)", "oppganger": 5, "pakker": 100, "stoy": 0.15, "bilder": 3},
+            {"navn": "Ekstrem (Kraftig støy)", "oppganger": 5, "pakker": 100, "stoy": 0.25, "bilder": 5}, # Tester om flere bilder kompenserer
+        ]
     
     for scen in scenarios:
-        logger.info(f"Kjører scenario: {scen['navn']}")
-        
-        # 1. Generer data
-        opp_conf, pakker = simulation_utils.generer_syntetiske_ruter(
-            n_oppganger=scen["oppganger"],
-            n_postkasser_per_oppgang=11, # Matcher visjon generator
-            n_pakker=scen["pakker"]
-        )
-        
-        # 2. Kjør simulering
-        res = simulation_utils.kjør_simulering(
-            navn=scen["navn"],
-            oppgang_configs=opp_conf,
-            pakker=pakker,
-            stoy_faktor=scen["stoy"],
-            antall_bilder=scen["bilder"]
-        )
+        scen["volum_fordeling"] = args.volum_fordeling
+        scen["zipf"] = args.zipf
         
-        results.append(res)
+    logger.info(f"Kjører {len(scenarios)} scenarioer med {args.arbeidere} arbeider(e), seed {args.seed}")
+    
+    # Generer data og kjør simulering (n_postkasser_per_oppgang=11 matcher visjon generator)
+    metrikker.aktiver(not args.uten_metrikker)
+    start = time.perf_counter()
+    results = simulation_utils.kjør_scenarioer(scenarios, arbeidere=args.arbeidere, seed=args.seed, lagre_bilder=args.lagre_bilder)
+    varighet = time.perf_counter() - start
+    
+    # Fordelingene er med i CSV-en (og flettenøkkelen), som tekst så de kan sammenlignes
+    for scen, r in zip(scenarios, results):
+        r["volum_fordeling"] = " ".join(f"{v:g}" for v in scen["volum_fordeling"]) if scen["volum_fordeling"] else ""
+        r["zipf"] = f"{scen['zipf']:g}" if scen["zipf"] else ""
         
     # Skriv til CSV
-    csv_file = "resultater.csv"
-    keys = results[0].keys()
-    with open(csv_file, 'w', newline='') as f:
-        dict_writer = csv.DictWriter(f, fieldnames=keys)
-        dict_writer.writeheader()
-        dict_writer.writerows(results)
+    csv_file = args.csv
+    flett_resultater(csv_file, results)
         
     logger.info(f"Resultater lagret til {csv_file}")
     
@@ -58,5 +99,20 @@ def main():
     table_data = [[r["navn"], r["stoy"], r["n_oppganger"], r["n_pakker"], r["direkte"], r["hentekontor"], f"{r['andel_direkte_pst']:.1f}%"] for r in results]
     print(tabulate(table_data, headers=headers, tablefmt="github"))
     
+    if metrikker.er_aktiv():
+        skriv_metrikker(varighet)
+        
+def skriv_metrikker(varighet):
+    """Skriver tid per steg i bildeanalysen (summert over alle arbeidere)."""
+    rader, n = metrikker.sammendrag()
+    if not n["bilder"]:
+        return
+    print("\n=== VISJON: TID PER STEG ===")
+    print(tabulate(rader, headers=["Steg", "Antall", "Snitt (ms)", "Maks (ms)", "Andel"], tablefmt="github", floatfmt=".2f"))
+    print(f"{n['bilder']} bilder på {varighet:.2f} s ({n['bilder'] / varighet:.1f} bilder/s totalt, "
+          f"{n['bilder_per_sek']:.1f} bilder/s per arbeider)")
+    print(f"{n['konturer_per_bilde']:.1f} konturer per bilde, {n['forkastet_stoy']} forkastet som støy, "
+          f"{n['finmalinger']} målt på nytt, {n['feil']} feil")
+
 if __name__ == "__main__":
     main()
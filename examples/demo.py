@@ -46,14 +46,15 @@ def run_demo():
         # 1.2 Analyze
         analysis_result = vision.analyser_bilder_av_oppgang(img_paths, oppgang_id)
         
-        # 1.3 Hydrate Models
+        # 1.3 Hydrate Models (one shared timestamp per entrance)
         pk_list = []
+        verified_at = datetime.now()
         for item in analysis_result:
             p = Postkasse(
                 id=f"{item['oppgang_id']}-{item['postkasse_id']}",
                 oppgang_id=item['oppgang_id'],
                 kapasitet_klasse=item['kapasitet_klasse'],
-                sist_verifisert=datetime.now()
+                sist_verifisert=verified_at
             )
             pk_list.append(p)
             
@@ -7,6 +7,9 @@ struct ContentView: View {
     @State private var results: [PostkasseResult] = []
     @State private var isLoading = false
     @State private var errorMessage: String?
+    // Photos of the current entrance, sent together to /analyze/batch
+    @State private var entrancePhotos: [UIImage] = []
+    @State private var oppgangID = ""
     
     // Custom camera trigger
     private let cameraCoordinator = ARCameraCoordinatorHolder()
@@ -52,6 +55,26 @@ struct ContentView: View {
                 }
                 .listStyle(PlainListStyle())
                 
+                if !entrancePhotos.isEmpty {
+                    VStack(spacing: 8) {
+                        TextField("Oppgang-ID", text: $oppgangID)
+                            .textFieldStyle(RoundedBorderTextFieldStyle())
+                            .autocapitalization(.none)
+                        HStack {
+                            Button("Analyser oppgang (\(entrancePhotos.count) bilder)") {
+                                analyzeEntrance()
+                            }
+                            .disabled(isLoading || oppgangID.trimmingCharacters(in: .whitespaces).isEmpty)
+                            Spacer()
+                            Button("Nullstill") {
+                                entrancePhotos = []
+                            }
+                            .foregroundColor(.red)
+                        }
+                    }
+                    .padding(.horizontal)
+                }
+                
                 Spacer()
                 
                 Button(action: {
@@ -97,6 +120,11 @@ struct ContentView: View {
     func analyzeImage() {
         guard let inputImage = inputImage else { return }
         
+        // Closing the camera without a new photo keeps the old one; don't count it twice
+        if entrancePhotos.last !== inputImage {
+            entrancePhotos.append(inputImage)
+        }
+        
         isLoading = true
         errorMessage = nil
         results = [] // Clear previous
@@ -116,6 +144,33 @@ struct ContentView: View {
             }
         }
     }
+    
+    /// Sends every photo of the entrance in one request; the server merges them per mailbox.
+    func analyzeEntrance() {
+        let photos = entrancePhotos
+        let id = oppgangID.trimmingCharacters(in: .whitespaces)
+        guard !photos.isEmpty, !id.isEmpty else { return }
+        
+        isLoading = true
+        errorMessage = nil
+        results = []
+        
+        Task {
+            do {
+                let foundPostkasser = try await networkManager.uploadImages(images: photos, oppgangID: id)
+                DispatchQueue.main.async {
+                    self.results = foundPostkasser
+                    self.entrancePhotos = []
+                    self.isLoading = false
+                }
+            } catch {
+                DispatchQueue.main.async {
+                    self.errorMessage = error.localizedDescription
+                    self.isLoading = false
+                }
+            }
+        }
+    }
 }
 
 // Helper to bridge the Action from View to Coordinator
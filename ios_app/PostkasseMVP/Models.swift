@@ -14,6 +14,38 @@ struct AnalysisResponse: Codable {
     let count: Int
 }
 
+struct BatchAnalysisResponse: Codable {
+    let success: Bool
+    let oppgangID: String
+    let postkasser: [PostkasseResult]
+    let count: Int
+    
+    enum CodingKeys: String, CodingKey {
+        case success, postkasser, count
+        case oppgangID = "oppgang_id"
+    }
+}
+
+/// 202 from /analyze or /analyze/batch: the analysis was queued and is fetched from statusURL.
+struct JobAccepted: Codable {
+    let jobID: String
+    let status: String
+    let statusURL: String
+    
+    enum CodingKeys: String, CodingKey {
+        case status
+        case jobID = "job_id"
+        case statusURL = "status_url"
+    }
+}
+
+/// GET /jobs/<id>. status is "venter", "kjører", "ferdig" or "feilet".
+struct JobStatusResponse: Codable {
+    let status: String
+    let postkasser: [PostkasseResult]?
+    let error: String?
+}
+
 struct PostkasseResult: Codable, Identifiable {
     var id: String { postkasseID } // Map 'id' from JSON to identifiable property
     let postkasseID: String
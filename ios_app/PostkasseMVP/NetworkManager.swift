@@ -9,11 +9,24 @@
 import Foundation
 import UIKit
 
+enum AnalysisError: LocalizedError {
+    case jobFailed(String)
+    
+    var errorDescription: String? {
+        switch self {
+        case .jobFailed(let message): return "Analysen feilet: \(message)"
+        }
+    }
+}
+
 class NetworkManager: ObservableObject {
     // IMPORTANT: Replace with your Mac's Local IP Address!
     // Simulator runs on Mac so "localhost" works, but for physical device use local IP.
     @Published var serverURL = "http://192.168.0.126:5001/analyze"
     
+    /// How often a queued analysis (202) is polled.
+    private let pollInterval: UInt64 = 1_000_000_000
+    
     func uploadImage(image: UIImage) async throws -> [PostkasseResult] {
         guard let url = URL(string: serverURL) else {
             throw URLError(.badURL)
@@ -32,14 +45,88 @@ class NetworkManager: ObservableObject {
         let body = createBody(boundary: boundary, data: imageData, mimeType: "image/jpeg", filename: "upload.jpg")
         request.httpBody = body
         
+        return try await analysisResults(for: request) { data in
+            try JSONDecoder().decode(AnalysisResponse.self, from: data).postkasser
+        }
+    }
+    
+    /// Uploads all photos of one entrance in a single request to /analyze/batch.
+    /// The server aggregates the observations and returns one result per mailbox.
+    func uploadImages(images: [UIImage], oppgangID: String) async throws -> [PostkasseResult] {
+        guard let url = URL(string: serverURL + "/batch") else {
+            throw URLError(.badURL)
+        }
+        
+        var request = URLRequest(url: url)
+        request.httpMethod = "POST"
+        
+        let boundary = UUID().uuidString
+        request.setValue("multipart/form-data; boundary=\(boundary)", forHTTPHeaderField: "Content-Type")
+        
+        let lineBreak = "\r\n"
+        var body = Data()
+        body.append("--\(boundary + lineBreak)")
+        body.append("Content-Disposition: form-data; name=\"oppgang_id\"\(lineBreak + lineBreak)")
+        body.append("\(oppgangID + lineBreak)")
+        
+        for (index, image) in images.enumerated() {
+            guard let imageData = image.jpegData(compressionQuality: 0.8) else {
+                throw URLError(.cannotDecodeContentData)
+            }
+            body.append("--\(boundary + lineBreak)")
+            body.append("Content-Disposition: form-data; name=\"images\"; filename=\"upload_\(index).jpg\"\(lineBreak)")
+            body.append("Content-Type: image/jpeg\(lineBreak + lineBreak)")
+            body.append(imageData)
+            body.append(lineBreak)
+        }
+        body.append("--\(boundary)--\(lineBreak)")
+        request.httpBody = body
+        
+        return try await analysisResults(for: request) { data in
+            try JSONDecoder().decode(BatchAnalysisResponse.self, from: data).postkasser
+        }
+    }
+    
+    /// Sends an analysis request. 200 is decoded directly; 202 means the server queued the
+    /// analysis (busy, or slower than its timeout), so the job is polled until it finishes.
+    private func analysisResults(for request: URLRequest, decode: (Data) throws -> [PostkasseResult]) async throws -> [PostkasseResult] {
         let (data, response) = try await URLSession.shared.data(for: request)
         
-        guard let httpResponse = response as? HTTPURLResponse, httpResponse.statusCode == 200 else {
+        guard let httpResponse = response as? HTTPURLResponse else {
             throw URLError(.badServerResponse)
         }
-        
-        let decodedResponse = try JSONDecoder().decode(AnalysisResponse.self, from: data)
-        return decodedResponse.postkasser
+        switch httpResponse.statusCode {
+        case 200:
+            return try decode(data)
+        case 202:
+            let accepted = try JSONDecoder().decode(JobAccepted.self, from: data)
+            return try await waitForJob(statusURL: accepted.statusURL)
+        default:
+            throw URLError(.badServerResponse)
+        }
+    }
+    
+    private func waitForJob(statusURL: String) async throws -> [PostkasseResult] {
+        guard let base = URL(string: serverURL), let url = URL(string: statusURL, relativeTo: base) else {
+            throw URLError(.badURL)
+        }
+        while true {
+            try await Task.sleep(nanoseconds: pollInterval) // Throws if the task is cancelled
+            let (data, response) = try await URLSession.shared.data(from: url)
+            
+            guard let httpResponse = response as? HTTPURLResponse, httpResponse.statusCode == 200 else {
+                throw URLError(.badServerResponse) // 404: the job expired
+            }
+            let job = try JSONDecoder().decode(JobStatusResponse.self, from: data)
+            switch job.status {
+            case "ferdig":
+                return job.postkasser ?? []
+            case "feilet":
+                throw AnalysisError.jobFailed(job.error ?? "ukjent feil")
+            default:
+                continue // "venter" or "kjører"
+            }
+        }
     }
     
     private func createBody(boundary: String, data: Data, mimeType: String, filename: String) -> Data {
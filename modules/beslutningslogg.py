@@ -0,0 +1,256 @@
+import os
+import json
+import logging
+import numpy as np
+from typing import List, Dict, Any, Iterable, Iterator, Optional
+from modules.datamodel import KapasitetKlasse, VolumKlasse, Utfall
+
+logger = logging.getLogger(__name__)
+
+# Kolonner og typer. Hver kolonne er en rå binærfil (<navn>.bin) som vokser bit for bit.
+KOLONNER = {
+    "utfall": np.uint8,      # Utfall-verdi
+    "volum": np.uint8,       # VolumKlasse-verdi
+    "kapasitet": np.uint8,   # KapasitetKlasse-verdi, 0 = ukjent mottaker
+    "postkasse": np.int32,   # Indeks i postkasse-ordboken (meta.json)
+    "pakke_slutt": np.int64  # Sluttposisjon for pakke-ID-en i pakke_ids.bin
+}
+
+# Postkasser lagt til i ordboken etter at meta.json ble skrevet (til loggen lukkes)
+NYE_POSTKASSER = "postkasser_nye.jsonl"
+
+# Navn på mottakeren når postkasse-indeksen er -1 (ukjent, og ID-en ble ikke logget)
+UKJENT = "UKJENT"
+
+# Ordbøker: kode -> navn, samme navn som i simuler_rute sin logg
+ORDBOKER = {
+    "utfall": [u.name for u in Utfall],
+    "volum": [None] + [v.name for v in VolumKlasse],
+    "kapasitet": ["N/A"] + [k.name for k in KapasitetKlasse]
+}
+
+class BeslutningsloggSkriver:
+    """
+    Skriver en beslutningslogg kolonnevis til en katalog, én bit om gangen.
+
+    Utfall, volum og kapasitet lagres som 1-byte koder, mottakeren som indeks i
+    en postkasse-ordbok og pakke-ID-ene som én sammenhengende UTF-8-blob med
+    sluttposisjoner. Katalogen leses med Beslutningslogg.åpne().
+
+    postkasse_oppgang og oppgang_ids (som PostkasseRegister.oppgang/oppgang_ids)
+    lagres i meta.json, slik at rapporter kan gruppere per oppgang.
+
+    meta.json skrives ved oppstart og i lukk(). Mottakere som legges til i
+    postkasse-ordboken underveis, føyes til NYE_POSTKASSER (én JSON-streng per
+    linje, før radene som bruker de nye kodene), så en bit koster ikke en ny
+    meta.json. Antall rader skrives først i lukk(); en logg fra en simulering
+    som krasjet, leses likevel, med antallet regnet ut fra filstørrelsene og
+    ordboken fra meta.json pluss NYE_POSTKASSER.
+    """
+
+    def __init__(self, katalog: str, postkasse_ids: Optional[List[str]] = None,
+                 postkasse_oppgang: Optional[Iterable[int]] = None, oppgang_ids: Optional[List[str]] = None):
+        self.katalog = katalog
+        os.makedirs(katalog, exist_ok=True)
+        self._postkasser: List[str] = list(postkasse_ids or [])
+        self._pk_indeks: Dict[str, int] = {pk_id: i for i, pk_id in enumerate(self._postkasser)}
+        self._postkasse_oppgang: List[int] = [int(o) for o in postkasse_oppgang] if postkasse_oppgang is not None else []
+        self._oppganger: List[str] = list(oppgang_ids or [])
+        self._antall = 0
+        self._pakke_bytes = 0
+        self._filer = {navn: open(os.path.join(katalog, f"{navn}.bin"), "wb") for navn in KOLONNER}
+        self._pakke_ids = open(os.path.join(katalog, "pakke_ids.bin"), "wb")
+        self._nye_postkasser = open(os.path.join(katalog, NYE_POSTKASSER), "w", encoding="utf-8")
+        self._skriv_meta(ferdig=False)
+
+    def _skriv_meta(self, ferdig: bool) -> None:
+        meta = {
+            "antall": self._antall if ferdig else None, # None: ikke lukket, tell radene i filene
+            "kolonner": {navn: np.dtype(dtype).str for navn, dtype in KOLONNER.items()},
+            "ordboker": ORDBOKER,
+            "postkasser": self._postkasser,
+            "oppganger": self._oppganger,
+            "postkasse_oppgang": self._postkasse_oppgang # Postkasser uten oppgang (ukjente mottakere) mangler
+        }
+        sti = os.path.join(self.katalog, "meta.json")
+        with open(sti + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(sti + ".tmp", sti)
+
+    def _postkasse_nr(self, pk_id: str) -> int:
+        nr = self._pk_indeks.get(pk_id)
+        if nr is None:
+            nr = len(self._postkasser)
+            self._postkasser.append(pk_id)
+            self._pk_indeks[pk_id] = nr
+            self._nye_postkasser.write(json.dumps(pk_id) + "\n")
+        return nr
+
+    def skriv(self, utfall: np.ndarray, volum: np.ndarray, kapasitet: np.ndarray, postkasse_idx: np.ndarray,
+              pakke_ids: Iterable[str], mottaker_ids: Optional[List[str]] = None) -> None:
+        """
+        Legger til én bit med beslutninger.
+
+        Args:
+            utfall, volum, kapasitet: Koder per pakke (som fra simuler_rute_batch).
+            postkasse_idx: Indeks i postkasse_ids gitt til konstruktøren, -1 for ukjent.
+            pakke_ids: Pakke-ID per rad.
+            mottaker_ids: Mottaker-ID per rad. Brukes til å legge ukjente mottakere
+                (-1) inn i ordboken, slik at ID-en deres ikke går tapt.
+        """
+        postkasse_idx = np.asarray(postkasse_idx, dtype=np.int32)
+        ukjente = np.flatnonzero(postkasse_idx < 0)
+        if len(ukjente) and mottaker_ids is not None:
+            postkasse_idx = postkasse_idx.copy()
+            postkasse_idx[ukjente] = [self._postkasse_nr(mottaker_ids[i]) for i in ukjente]
+            self._nye_postkasser.flush() # Ordboken må ligge på disk før radene som peker inn i den
+
+        kodet = [pakke_id.encode("utf-8") for pakke_id in pakke_ids]
+        slutt = self._pakke_bytes + np.cumsum([len(b) for b in kodet], dtype=np.int64)
+        self._pakke_ids.write(b"".join(kodet))
+        if len(slutt):
+            self._pakke_bytes = int(slutt[-1])
+
+        n = len(postkasse_idx)
+        for navn, verdier in (("utfall", utfall), ("volum", volum), ("kapasitet", kapasitet),
+                              ("postkasse", postkasse_idx), ("pakke_slutt", slutt)):
+            kolonne = np.ascontiguousarray(verdier, dtype=KOLONNER[navn])
+            if len(kolonne) != n:
+                raise ValueError(f"Kolonnen {navn} har {len(kolonne)} rader, forventet {n}")
+            self._filer[navn].write(kolonne.tobytes())
+        self._antall += n
+        # Tøm bufrene per bit, så et krasj mister høyst biten som ble skrevet
+        self._pakke_ids.flush()
+        for f in self._filer.values():
+            f.flush()
+
+    def lukk(self) -> None:
+        """Lukker filene og skriver meta.json med endelig antall rader."""
+        for f in self._filer.values():
+            f.close()
+        self._pakke_ids.close()
+        self._nye_postkasser.close()
+        self._skriv_meta(ferdig=True) # Med hele ordboken; NYE_POSTKASSER trengs ikke lenger
+        os.remove(os.path.join(self.katalog, NYE_POSTKASSER))
+        logger.info(f"Beslutningslogg med {self._antall} rader skrevet til {self.katalog}")
+
+    def __enter__(self) -> "BeslutningsloggSkriver":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.lukk()
+
+class Beslutningslogg:
+    """
+    Lesevisning av en beslutningslogg. Kolonnene er minnemappet, så selv
+    svært store logger kan telles og blas i uten å lastes inn.
+    """
+
+    def __init__(self, katalog: str, meta: Dict[str, Any], kolonner: Dict[str, np.ndarray], pakke_ids: np.ndarray):
+        self.katalog = katalog
+        self.meta = meta
+        self.kolonner = kolonner
+        self._pakke_ids = pakke_ids
+        self._postkasser = meta["postkasser"]
+
+        # Oppgang per postkasse-kode, -1 der oppgangen ikke er kjent
+        self.oppganger: List[str] = meta.get("oppganger", [])
+        self.postkasse_oppgang = np.full(len(self._postkasser), -1, dtype=np.int32)
+        kjente = meta.get("postkasse_oppgang", [])
+        self.postkasse_oppgang[:len(kjente)] = kjente
+
+    @classmethod
+    def åpne(cls, katalog: str) -> "Beslutningslogg":
+        with open(os.path.join(katalog, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("antall") is None:
+            meta["postkasser"] = meta["postkasser"] + cls._nye_postkasser(katalog)
+            meta["antall"] = cls._hele_rader(katalog, meta)
+            logger.warning(f"Beslutningsloggen i {katalog} ble ikke lukket; leser {meta['antall']} hele rader")
+        n = meta["antall"]
+
+        def mapp(filnavn: str, dtype: Any, antall: int) -> np.ndarray:
+            if antall == 0:
+                return np.zeros(0, dtype=dtype) # Tomme filer kan ikke minnemappes
+            return np.memmap(os.path.join(katalog, filnavn), dtype=dtype, mode="r", shape=(antall,))
+
+        kolonner = {navn: mapp(f"{navn}.bin", np.dtype(dtype), n) for navn, dtype in meta["kolonner"].items()}
+        pakke_bytes = int(kolonner["pakke_slutt"][-1]) if n else 0
+        return cls(katalog, meta, kolonner, mapp("pakke_ids.bin", np.uint8, pakke_bytes))
+
+    @staticmethod
+    def _nye_postkasser(katalog: str) -> List[str]:
+        """Mottakere lagt til underveis i en logg som ikke ble lukket (bare hele linjer)."""
+        try:
+            with open(os.path.join(katalog, NYE_POSTKASSER), encoding="utf-8") as f:
+                return [json.loads(linje) for linje in f if linje.endswith("\n")]
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _hele_rader(katalog: str, meta: Dict[str, Any]) -> int:
+        """Antall rader som er skrevet helt i alle kolonnene (for en logg som ikke ble lukket)."""
+        def rader_i(navn: str, dtype: Any) -> int:
+            sti = os.path.join(katalog, f"{navn}.bin")
+            return os.path.getsize(sti) // np.dtype(dtype).itemsize if os.path.exists(sti) else 0
+
+        n = min(rader_i(navn, dtype) for navn, dtype in meta["kolonner"].items())
+        if n == 0:
+            return 0
+        # Pakke-ID-ene skrives før kolonnene, men kan likevel være kuttet
+        slutt = np.memmap(os.path.join(katalog, "pakke_slutt.bin"), dtype=np.dtype(meta["kolonner"]["pakke_slutt"]),
+                          mode="r", shape=(n,))
+        n = int(np.searchsorted(slutt, os.path.getsize(os.path.join(katalog, "pakke_ids.bin")), side="right"))
+        return n
+
+    def __len__(self) -> int:
+        return self.meta["antall"]
+
+    def postkasse_navn(self, kode: int) -> str:
+        """Postkasse-ID for en kode i postkasse-kolonnen; -1 (ukjent mottaker) gir UKJENT."""
+        return self._postkasser[kode] if kode >= 0 else UKJENT
+
+    def pakke_id(self, rad: int) -> str:
+        slutt = self.kolonner["pakke_slutt"]
+        start = int(slutt[rad - 1]) if rad > 0 else 0
+        return bytes(self._pakke_ids[start:int(slutt[rad])]).decode("utf-8")
+
+    def rader(self, start: int = 0, stopp: Optional[int] = None) -> Iterator[Dict[str, str]]:
+        """Beslutninger i samme format som simuler_rute sin logg."""
+        stopp = len(self) if stopp is None else min(stopp, len(self))
+        ordbok = self.meta["ordboker"]
+        k = self.kolonner
+        for i in range(start, stopp):
+            yield {
+                "pakke_id": self.pakke_id(i),
+                "volum": ordbok["volum"][k["volum"][i]],
+                "destinasjon_pk": self.postkasse_navn(int(k["postkasse"][i])),
+                "utfall": ordbok["utfall"][k["utfall"][i]],
+                "pk_kapasitet": ordbok["kapasitet"][k["kapasitet"][i]]
+            }
+
+    def tellinger(self) -> Dict[str, int]:
+        """Samme tellere som simuler_rute_batch, regnet rett fra utfall-kolonnen."""
+        telling = np.bincount(self.kolonner["utfall"], minlength=len(Utfall))
+        direkte = int(telling[Utfall.LEVERT_I_POSTKASSE.value])
+        return {
+            "antall_pakker": len(self),
+            "direkte_i_postkasse": direkte,
+            "til_hentekontor": len(self) - direkte,
+            "ukjent_postkasse": int(telling[Utfall.UKJENT_POSTKASSE.value])
+        }
+
+def eksporter_logg(logg: List[Dict[str, str]], katalog: str) -> None:
+    """Skriver en logg fra simuler_rute (liste av dicts) til binært kolonneformat."""
+    utfall_kode = {navn: i for i, navn in enumerate(ORDBOKER["utfall"])}
+    volum_kode = {navn: i for i, navn in enumerate(ORDBOKER["volum"])}
+    kapasitet_kode = {navn: i for i, navn in enumerate(ORDBOKER["kapasitet"])}
+    with BeslutningsloggSkriver(katalog) as skriver:
+        skriver.skriv(
+            utfall=[utfall_kode[b["utfall"]] for b in logg],
+            volum=[volum_kode[b["volum"]] for b in logg],
+            kapasitet=[kapasitet_kode[b["pk_kapasitet"]] for b in logg],
+            postkasse_idx=np.full(len(logg), -1, dtype=np.int32),
+            pakke_ids=[b["pakke_id"] for b in logg],
+            mottaker_ids=[b["destinasjon_pk"] for b in logg]
+        )
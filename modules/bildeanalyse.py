@@ -1,124 +1,499 @@
 import cv2
 import numpy as np
 import logging
-from typing import List, Tuple, Dict, Any
+from functools import lru_cache
+from typing import List, Tuple, Dict, Any, Iterable, Optional, Union
 from datetime import datetime
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 from modules.datamodel import KapasitetKlasse
+from modules.bildecache import AnalyseCache, FeiletAnalyse
+from modules import metrikker, detektorer
 
 logger = logging.getLogger(__name__)
 
 # --- DEL 1: Syntetisk Bildegenerering (Demo-formål) ---
 
-def generer_test_bilde(filnavn: str, shift_x: int = 0, shift_y: int = 0, stoy_faktor: float = 0.0) -> None:
+class ReolMal:
     """
-    Genererer et syntetisk bilde av en postkassereol for testing.
-    Kan legge til støy og forskyvning for å simulere realisme.
+    Geometri og ferdig tegnet grunnbilde for en syntetisk postkassereol.
+    
+    Det som er likt i alle bilder (bakgrunn, overkanter og etiketter) tegnes én gang.
+    Sidekanter og bunnkanter varierer med støyen og tegnes per bilde i
+    generer_test_bilder_batch. Bruk hent_reol_mal for å gjenbruke maler.
     """
-    # ... (Samme logikk som før) ...
-    # Kopierer inn logikken fra image_analysis.py for å gjøre modulen selvstendig
     
-    height, width = 600, 800
-    image = np.ones((height, width, 3), dtype=np.uint8) * 255 # Hvit bakgrunn
+    def __init__(self, rad_hoyder: Tuple[int, ...] = (80, 120, 120, 160), kolonner: int = 3,
+                 maks_postkasser: Optional[int] = 11, hoyde: int = 600, bredde: int = 800,
+                 start: Tuple[int, int] = (50, 50), pk_bredde: int = 150, margin: int = 10):
+        self.hoyde = hoyde
+        self.bredde = bredde
+        
+        # Definer "sanne" størrelser for simuleringen (standard):
+        # Rad 0: Små (LITEN) - h=80
+        # Rad 1: Standard (STANDARD) - h=120
+        # Rad 2: Standard (STANDARD) - h=120
+        # Rad 3: Store (STOR) - h=160
+        x0, y0, h = [], [], []
+        current_y = start[1]
+        for rad_h in rad_hoyder:
+            for c in range(kolonner):
+                x0.append(start[0] + c * (pk_bredde + margin))
+                y0.append(current_y)
+                h.append(rad_h)
+            current_y += rad_h + margin
+        n = len(x0) if maks_postkasser is None else min(len(x0), maks_postkasser) # Standard: 11 for asymmetri
+        
+        self.x0 = np.array(x0[:n])
+        self.y0 = np.array(y0[:n])
+        self.h = np.array(h[:n])
+        self.pk_bredde = pk_bredde
+        
+        # Grunnbilde: hvit bakgrunn, overkanter og etiketter (for visuell debug)
+        self.bilde = np.full((hoyde, bredde, 3), 255, dtype=np.uint8)
+        for i in range(n):
+            x, y = int(self.x0[i]), int(self.y0[i])
+            cv2.line(self.bilde, (x, y), (x + pk_bredde, y), (0, 0, 0), 2)
+            cv2.putText(self.bilde, str(i + 1), (x+10, y+30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0,0,0), 2)
+            
+    def __len__(self) -> int:
+        return len(self.x0)
+        
+    def polstret(self, p: int) -> np.ndarray:
+        """Grunnbildet med p px hvit kant rundt, slik at forskyvninger kan klippes ut."""
+        return cv2.copyMakeBorder(self.bilde, p, p, p, p, cv2.BORDER_CONSTANT, value=(255, 255, 255))
+
+@lru_cache(maxsize=16)
+def hent_reol_mal(rad_hoyder: Tuple[int, ...] = (80, 120, 120, 160), kolonner: int = 3,
+                  maks_postkasser: Optional[int] = 11, hoyde: int = 600, bredde: int = 800) -> ReolMal:
+    """Gjenbrukbar ReolMal (tegnes bare første gang for hver kombinasjon)."""
+    return ReolMal(tuple(rad_hoyder), kolonner, maks_postkasser, hoyde, bredde)
+
+def _sett_svart(bilder: np.ndarray, k: np.ndarray, y: np.ndarray, x: np.ndarray) -> None:
+    # Setter piksler (k, y, x) til svart, med punkter utenfor bildet filtrert bort
+    k, y, x = (a.ravel() for a in np.broadcast_arrays(k, y, x))
+    inne = (y >= 0) & (y < bilder.shape[1]) & (x >= 0) & (x < bilder.shape[2])
+    bilder[k[inne], y[inne], x[inne]] = 0
 
-    # Tegn en "reol"
-    pk_start_x, pk_start_y = 50 + shift_x, 50 + shift_y
-    rader, kolonner = 4, 3 
+def generer_test_bilder_batch(antall: int, stoy_faktor: float = 0.0, forskyvninger: Optional[np.ndarray] = None,
+                              rng: Optional[np.random.Generator] = None, mal: Optional[ReolMal] = None) -> np.ndarray:
+    """
+    Genererer antall syntetiske reolbilder på en gang.
+    
+    Args:
+        antall: Antall bilder (K).
+        stoy_faktor: Samme betydning som i generer_test_bilde.
+        forskyvninger: (K, 2)-array med (shift_x, shift_y) per bilde. None = ingen forskyvning.
+        rng: Seedet Generator for reproduserbare bilder. All tilfeldighet trekkes herfra.
+        mal: ReolMal med reolens oppsett. None = standardreolen (4 rader, 11 postkasser).
+        
+    Returns:
+        uint8-array med form (K, H, W, 3) i BGR. Store korpus bør lages i biter
+        med samme rng; ett bilde på 800x600 tar 1.4 MB.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    if mal is None:
+        mal = hent_reol_mal()
+    if forskyvninger is None:
+        forskyvninger = np.zeros((antall, 2), dtype=np.int64)
+    forskyvninger = np.asarray(forskyvninger, dtype=np.int64).reshape(antall, 2)
+    sx, sy = forskyvninger[:, 0], forskyvninger[:, 1]
+    H, W = mal.hoyde, mal.bredde
     
-    # Definer "sanne" størrelser for simuleringen
-    # Rad 0: Små (LITEN) - h=80
-    # Rad 1: Standard (STANDARD) - h=120
-    # Rad 2: Standard (STANDARD) - h=120
-    # Rad 3: Store (STOR) - h=160
+    # 1. Forskyv grunnbildet: klipp ut et H x W-vindu per bilde fra en polstret mal
+    p = int(np.abs(forskyvninger).max()) if antall else 0
+    vinduer = np.lib.stride_tricks.sliding_window_view(mal.polstret(p), (H, W, 3))[:, :, 0]
+    bilder = vinduer[p - sy, p - sx] # (K, H, W, 3), kopi
     
-    rad_hoyder = [80, 120, 120, 160]
-    pk_bredde = 150
-    margin = 10
+    # 2. Postkassehøyder med støy (avkortet mot null som int())
+    hoyder = np.broadcast_to(mal.h, (antall, len(mal)))
+    if stoy_faktor > 0:
+        hoyder = hoyder + np.trunc(rng.normal(0, 50 * stoy_faktor, size=hoyder.shape)).astype(np.int64)
+        
+    # 3. Side- og bunnkanter for alle bilder og postkasser samtidig.
+    #    Kantene er 3 px brede (som cv2.rectangle med tykkelse 2)
+    topp = mal.y0[None, :] + sy[:, None]                         # (K, N)
+    bunn = topp + hoyder
+    ovre, nedre = np.minimum(topp, bunn) - 1, np.maximum(topp, bunn) + 1
+    rader = np.arange(H)
+    i_kant = (rader >= ovre[..., None]) & (rader <= nedre[..., None]) # (K, N, H)
+    k, n, y = np.nonzero(i_kant)
+    for kant_x in (mal.x0, mal.x0 + mal.pk_bredde):
+        x = kant_x[n] + sx[k]
+        _sett_svart(bilder, k[:, None], y[:, None], x[:, None] + np.arange(-1, 2))
+        
+    kk = np.arange(antall)[:, None, None, None]
+    by = bunn[:, :, None, None] + np.arange(-1, 2)[:, None]          # (K, N, 3, 1)
+    bx = (mal.x0[:, None] + np.arange(-1, mal.pk_bredde + 2))[None, :, None, :] + sx[:, None, None, None]
+    _sett_svart(bilder, kk, by, bx)
     
-    current_y = pk_start_y
-    pk_counter = 0
+    # 4. Pikselstøy. Som før brytes negative verdier rundt i uint8 og metter mot
+    #    hvitt i den mettede addisjonen, så hvit bakgrunn forblir hvit uansett.
+    #    Støy trekkes derfor bare for pikslene som er tegnet på (kanter og etiketter).
+    #    Før støy er bildet gråtoner, så kanal 0 avgjør hvilke piksler det gjelder
+    if stoy_faktor > 0:
+        piksler = bilder.reshape(-1, 3)
+        tegnet = np.flatnonzero(bilder[..., 0] < 255)
+        stoy = rng.standard_normal((tegnet.size, 3), dtype=np.float32)
+        stoy *= 25 * stoy_faktor
+        stoy = stoy.astype(np.int16).astype(np.uint8)
+        piksler[tegnet] = np.minimum(piksler[tegnet] + stoy.astype(np.uint16), 255)
+        
+    return bilder
 
-    for r in range(rader):
-        h = rad_hoyder[r]
-        current_x = pk_start_x
-        for c in range(kolonner):
-            pk_counter += 1
-            if pk_counter > 11: break # Stopp etter 11 for asymmetri
+def generer_test_bilde(filnavn: Optional[str] = None, shift_x: int = 0, shift_y: int = 0, stoy_faktor: float = 0.0,
+                       rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """
+    Genererer et syntetisk bilde av en postkassereol for testing.
+    Kan legge til støy og forskyvning for å simulere realisme.
+    Gi en seedet rng for reproduserbare bilder.
+    
+    Bildet returneres som et BGR-array som kan gis direkte til analyser_bilde.
+    Det skrives bare til disk hvis filnavn er oppgitt.
+    """
+    image = generer_test_bilder_batch(1, stoy_faktor, [[shift_x, shift_y]], rng=rng)[0]
+    
+    if filnavn:
+        cv2.imwrite(filnavn, image)
+        logger.info(f"Testbilde generert: {filnavn}")
+    return image
 
-            # Tegn postkasse
-            # Legg til litt tilfeldig variasjon hvis støy er på
-            noise_h = int(np.random.normal(0, 50 * stoy_faktor)) if stoy_faktor > 0 else 0
-            
-            top_left = (current_x, current_y)
-            bottom_right = (current_x + pk_bredde, current_y + h + noise_h)
-            
-            cv2.rectangle(image, top_left, bottom_right, (0, 0, 0), 2)
-            
-            # Etikett (for visuell debug)
-            cv2.putText(image, str(pk_counter), (current_x+10, current_y+30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0,0,0), 2)
-            
-            current_x += pk_bredde + margin
-        current_y += h + margin
 
-    if stoy_faktor > 0:
-        noise = np.random.normal(0, 25 * stoy_faktor, image.shape).astype(np.uint8)
-        image = cv2.add(image, noise)
+# --- DEL 2: Bildeanalyse (Kjerne) ---
 
-    cv2.imwrite(filnavn, image)
-    logger.info(f"Testbilde generert: {filnavn}")
+# Analyseparametre (kalibrert mot generer_test_bilde). Inngår også i cache-nøkkelen,
+# så endrede verdier gir aldri gamle resultater fra cachen.
+TERSKEL = 200         # Gråtone-terskel for binærbildet
+MIN_STORRELSE = 20    # Konturer smalere/lavere enn dette regnes som støy (px)
+GRENSE_LITEN = 100    # h < GRENSE_LITEN -> LITEN (px)
+GRENSE_STANDARD = 140 # h < GRENSE_STANDARD -> STANDARD, ellers STOR (px)
 
+# Store bilder (f.eks. 12MP fra telefon) analyseres nedskalert. Alle grenser over
+# er i piksler i full oppløsning og skaleres med, så klassene blir de samme.
+MAAL_SIDE = 1000      # Nedskaler (2x/4x/8x) så lenge lengste side holder seg over dette (px)
+GRENSE_MARGIN = 2     # Bokser nærmere en grense enn dette (nedskalerte px) måles på nytt i full oppløsning
 
-# --- DEL 2: Bildeanalyse (Kjerne) ---
+def analyse_parametre() -> Dict[str, Any]:
+    """Gjeldende analyseparametre, til bruk i cache-nøkler og metadata."""
+    return {
+        "terskel": TERSKEL,
+        "min_storrelse": MIN_STORRELSE,
+        "grense_liten": GRENSE_LITEN,
+        "grense_standard": GRENSE_STANDARD,
+        "maal_side": MAAL_SIDE,
+        "grense_margin": GRENSE_MARGIN
+    }
+
+# En bildekilde kan være en filsti, kodede bytes (JPEG/PNG rett fra opplasting)
+# eller et NumPy-array (enten kodet buffer eller ferdig dekodet bilde).
+BildeKilde = Union[str, bytes, bytearray, memoryview, np.ndarray]
 
-def analyser_bilde(bilde_sti: str) -> List[Tuple[str, KapasitetKlasse]]:
+def les_bilde(kilde: BildeKilde) -> Optional[np.ndarray]:
     """
-    Analyserer et enkeltbilde og returnerer funn.
+    Dekoder en bildekilde til et BGR-bilde. Returnerer None hvis dekoding feiler.
     """
-    try:
-        img = cv2.imread(bilde_sti)
-        if img is None:
-            raise FileNotFoundError(f"Fant ikke bildet: {bilde_sti}")
+    if isinstance(kilde, str):
+        return cv2.imread(kilde)
+    if isinstance(kilde, (bytes, bytearray, memoryview)):
+        buf = np.frombuffer(kilde, dtype=np.uint8)
+        return cv2.imdecode(buf, cv2.IMREAD_COLOR) if buf.size else None
+    if isinstance(kilde, np.ndarray):
+        if kilde.ndim == 1:
+            # Kodet buffer (f.eks. fra np.frombuffer på en opplasting)
+            return cv2.imdecode(kilde, cv2.IMREAD_COLOR) if kilde.size else None
+        return kilde
+    raise TypeError(f"Ukjent bildekilde: {type(kilde).__name__}")
+
+def les_dimensjoner(buf: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Leser (bredde, høyde) fra headeren til et PNG- eller JPEG-bilde uten å dekode det.
+    Returnerer None for andre formater eller ødelagte headere.
+    """
+    buf = bytes(buf[:64 * 1024]) # Headeren ligger i starten; EXIF kan ta noen kB
+    if buf[:8] == b"\x89PNG\r\n\x1a\n" and len(buf) >= 24:
+        return int.from_bytes(buf[16:20], "big"), int.from_bytes(buf[20:24], "big")
+    if buf[:2] != b"\xff\xd8":
+        return None
         
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        _, thresh = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY_INV)
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # JPEG: gå gjennom segmentene til første SOF-markør
+    i = 2
+    while i + 9 <= len(buf):
+        if buf[i] != 0xFF:
+            return None
+        markor = buf[i + 1]
+        if markor == 0xFF: # Fyllbyte
+            i += 1
+            continue
+        if markor in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+            return int.from_bytes(buf[i+7:i+9], "big"), int.from_bytes(buf[i+5:i+7], "big")
+        if 0xD0 <= markor <= 0xD9 or markor == 0x01: # Markører uten lengde
+            i += 2
+            continue
+        i += 2 + int.from_bytes(buf[i+2:i+4], "big")
+    return None
+
+def velg_reduksjon(bredde: int, hoyde: int) -> int:
+    """Største nedskalering (1, 2, 4 eller 8) som holder lengste side over MAAL_SIDE."""
+    faktor = 1
+    while faktor < 8 and max(bredde, hoyde) // (faktor * 2) >= MAAL_SIDE:
+        faktor *= 2
+    return faktor
+
+_REDUSERT_GRATONE = {
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8
+}
+
+class _Gratone:
+    """
+    Gråtonebilde for analyse, eventuelt nedskalert med faktor.
+    Fullt bilde dekodes først når en boks må måles på nytt (se full()).
+    """
+    
+    def __init__(self, kilde: BildeKilde, klokke: Any = metrikker.INGEN_KLOKKE):
+        self.kilde = kilde
+        self.faktor = 1
+        self._full: Optional[np.ndarray] = None
         
-        sorted_contours = sorted(contours, key=lambda c: cv2.boundingRect(c)[1])
+        if isinstance(kilde, str):
+            with open(kilde, "rb") as f:
+                kilde = self.kilde = f.read()
+        kodet = not isinstance(kilde, np.ndarray) or kilde.ndim == 1
+        
+        if kodet:
+            # JPEG dekodes direkte i redusert størrelse (DCT-skalering), uten fullt bilde i minnet
+            dim = les_dimensjoner(kilde)
+            self.faktor = velg_reduksjon(*dim) if dim else 1
+            if self.faktor > 1:
+                self.bilde = cv2.imdecode(np.frombuffer(kilde, dtype=np.uint8), _REDUSERT_GRATONE[self.faktor])
+                klokke.runde("dekoding")
+                return
+            img = les_bilde(kilde)
+            klokke.runde("dekoding")
+        else:
+            img = kilde
+            self.faktor = velg_reduksjon(img.shape[1], img.shape[0])
+            
+        if img is None:
+            self.bilde = None
+            return
+        self._full = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if self.faktor > 1:
+            h, w = self._full.shape
+            self.bilde = cv2.resize(self._full, (w // self.faktor, h // self.faktor), interpolation=cv2.INTER_AREA)
+        else:
+            self.bilde = self._full
+        klokke.runde("gratone")
+        
+    def full(self) -> np.ndarray:
+        if self._full is None:
+            self._full = cv2.imdecode(np.frombuffer(self.kilde, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        return self._full
+
+def _beskriv(kilde: BildeKilde) -> str:
+    # Kort beskrivelse til logg, uten å dumpe bildebytes
+    if isinstance(kilde, str):
+        return kilde
+    if isinstance(kilde, np.ndarray):
+        return f"<ndarray {kilde.shape}>"
+    return f"<{len(kilde)} bytes>"
+
+def _finn_bokser(gray: np.ndarray, klokke: Any = metrikker.INGEN_KLOKKE) -> List[Tuple[int, int, int, int]]:
+    # Ytre konturer som (x, y, w, h), sortert ovenfra og ned
+    _, thresh = cv2.threshold(gray, TERSKEL, 255, cv2.THRESH_BINARY_INV)
+    klokke.runde("terskel")
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    klokke.runde("konturer")
+    bokser = [cv2.boundingRect(c) for c in contours]
+    bokser.sort(key=lambda b: b[1])
+    klokke.runde("bokser")
+    klokke.tell("konturer", len(bokser))
+    return bokser
+
+def _nær_grense(verdi: float, grenser: Tuple[float, ...], margin: float) -> bool:
+    return any(abs(verdi - g) <= margin for g in grenser)
+
+def _mål_på_nytt(full: np.ndarray, boks: Tuple[int, int, int, int], faktor: int) -> Optional[Tuple[int, int]]:
+    """Måler (w, h) for en nedskalert boks i full oppløsning, innenfor et utsnitt rundt boksen."""
+    x, y, w, h = (v * faktor for v in boks)
+    pad = 2 * faktor
+    x0, y0 = max(0, x - pad), max(0, y - pad)
+    utsnitt = full[y0:y + h + pad, x0:x + w + pad]
+    bokser = _finn_bokser(utsnitt)
+    if not bokser:
+        return None
+    # Naboboksene kan stikke inn i kanten av utsnittet; vår boks er den største
+    _, _, bw, bh = max(bokser, key=lambda b: b[2] * b[3])
+    return bw, bh
+
+# Boks i full oppløsning: (x, y, w, h) i piksler
+Boks = Tuple[int, int, int, int]
+
+def finn_postkasser(kilde: BildeKilde) -> List[Tuple[Boks, KapasitetKlasse]]:
+    """
+    Som analyser_bilde, men med boksen til hver postkasse (ovenfra og ned).
+    Brukes der posisjonen trengs, f.eks. til sporing mellom videobilder.
+    """
+    klokke = metrikker.stoppeklokke()
+    try:
+        gray = _Gratone(kilde, klokke)
+        if gray.bilde is None:
+            raise FileNotFoundError(f"Fant ikke bildet: {_beskriv(kilde)}")
+        f = gray.faktor
         
-        pk_count = 0
         resultater = []
         
-        for cnt in sorted_contours:
-            x, y, w, h = cv2.boundingRect(cnt)
-            if w < 20 or h < 20: continue # Støyfilter
-            
-            pk_count += 1
-            pk_id = f"PK-{pk_count}"
+        for boks in _finn_bokser(gray.bilde, klokke):
+            # Mål i full oppløsning
+            w, h = boks[2] * f, boks[3] * f
+            if f > 1 and (_nær_grense(w, (MIN_STORRELSE,), GRENSE_MARGIN * f) or
+                          _nær_grense(h, (MIN_STORRELSE, GRENSE_LITEN, GRENSE_STANDARD), GRENSE_MARGIN * f)):
+                w, h = _mål_på_nytt(gray.full(), boks, f) or (w, h)
+                klokke.tell("finmalinger")
+            if w < MIN_STORRELSE or h < MIN_STORRELSE: # Støyfilter
+                klokke.tell("forkastet_stoy")
+                continue
             
             # Klassifisering (Kalibrerte verdier)
-            if h < 100: kap = KapasitetKlasse.LITEN
-            elif h < 140: kap = KapasitetKlasse.STANDARD
+            if h < GRENSE_LITEN: kap = KapasitetKlasse.LITEN
+            elif h < GRENSE_STANDARD: kap = KapasitetKlasse.STANDARD
             else: kap = KapasitetKlasse.STOR
             
-            resultater.append((pk_id, kap))
+            resultater.append(((boks[0] * f, boks[1] * f, w, h), kap))
             
+        klokke.runde("klassifisering")
+        klokke.tell("bilder")
+        klokke.tell("postkasser", len(resultater))
+        klokke.ferdig()
         return resultater
     except Exception as e:
-        logger.error(f"Feil i analyser_bilde({bilde_sti}): {e}")
-        return []
+        logger.error(f"Feil i analyser_bilde({_beskriv(kilde)}): {e}")
+        klokke.tell("feil")
+        klokke.ferdig()
+        return FeiletAnalyse()
 
-# --- DEL 3: Aggregering (API) ---
+def analyser_bilde(kilde: BildeKilde) -> List[Tuple[str, KapasitetKlasse]]:
+    """
+    Analyserer et enkeltbilde og returnerer funn.
+    Kilden kan være en filsti, kodede bytes eller et NumPy-array (se les_bilde).
+    
+    Store bilder analyseres nedskalert (se MAAL_SIDE), med grensene skalert likt.
+    Bokser som havner nær en grense måles på nytt i full oppløsning.
+    """
+    return detektorer.til_funn(finn_postkasser(kilde))
 
-def analyser_bilder_av_oppgang(bilder: List[str], oppgang_id: str) -> List[Dict[str, Any]]:
+def _cache_innhold(kilde: BildeKilde) -> Tuple[BildeKilde, bytes]:
     """
-    Tar flere bilder av samme oppgang, aggregerer resultatene og returnerer strukturert data.
+    Returnerer (kilde å analysere, bytes å hashe). Filer leses én gang, og
+    bytesene gjenbrukes til analysen i stedet for en ny cv2.imread.
     """
-    logger.info(f"Analyserer {len(bilder)} bilder for oppgang {oppgang_id}")
+    if isinstance(kilde, str):
+        with open(kilde, "rb") as f:
+            innhold = f.read()
+        return innhold, innhold
+    if isinstance(kilde, np.ndarray):
+        # Dekodede bilder: form og type må med, ellers kan to ulike bilder kollidere
+        hode = f"{kilde.shape}|{kilde.dtype}|".encode("utf-8")
+        return kilde, hode + np.ascontiguousarray(kilde).tobytes()
+    return kilde, bytes(kilde)
+
+def cache_oppslag(kilde: BildeKilde, cache: AnalyseCache, detektor: Optional["detektorer.Detektor"] = None) -> Tuple[BildeKilde, Optional[str], Optional[List[Tuple[str, KapasitetKlasse]]]]:
+    """
+    Slår opp en bildekilde i cachen. Nøkkelen tar med detektorens parametre
+    (aktiv detektor hvis ingen er oppgitt).
+    
+    Returns:
+        (kilde å analysere ved bom, nøkkel å lagre under, resultat eller None).
+        Nøkkelen er None hvis kilden ikke kunne leses (f.eks. manglende fil).
+    """
+    try:
+        kilde, innhold = _cache_innhold(kilde)
+    except OSError:
+        return kilde, None, None # Manglende fil logges av analyser_bilde
+    nokkel = cache.nokkel(innhold, (detektor or detektorer.aktiv()).parametre())
+    return kilde, nokkel, cache.hent(nokkel)
+
+def analyser_bilder(kilder: List[BildeKilde], detektor: Optional["detektorer.Detektor"] = None) -> List[List[Tuple[str, KapasitetKlasse]]]:
+    """
+    Analyserer bildene med en detektor (aktiv detektor hvis ingen er oppgitt,
+    se modules.detektorer). Funn per bilde, i samme rekkefølge som kildene.
+    """
+    return (detektor or detektorer.aktiv()).analyser(list(kilder))
+
+def analyser_ett(kilde: BildeKilde, detektor: Optional["detektorer.Detektor"] = None) -> List[Tuple[str, KapasitetKlasse]]:
+    """Som analyser_bilde, men med valgt (eller aktiv) detektor."""
+    return analyser_bilder([kilde], detektor)[0]
+
+def analyser_bilde_cachet(kilde: BildeKilde, cache: Optional[AnalyseCache], detektor: Optional["detektorer.Detektor"] = None) -> List[Tuple[str, KapasitetKlasse]]:
+    """
+    Som analyser_ett, men slår først opp i en AnalyseCache.
+    Bilder som ikke kunne analyseres (FeiletAnalyse) caches ikke.
+    """
+    if cache is None:
+        return analyser_ett(kilde, detektor)
+    kilde, nokkel, resultat = cache_oppslag(kilde, cache, detektor)
+    if resultat is None:
+        resultat = analyser_ett(kilde, detektor)
+        if nokkel is not None and not isinstance(resultat, FeiletAnalyse):
+            cache.lagre(nokkel, resultat)
+    return resultat
+
+# --- DEL 3: Aggregering (API) ---
+
+def lag_executor(modus: str = "tråd", maks_arbeidere: Optional[int] = None) -> Executor:
+    """
+    Lager en pool for parallell bildeanalyse.
     
+    Args:
+        modus: "tråd" (OpenCV slipper GIL under dekoding og terskling) eller "prosess".
+        maks_arbeidere: Antall arbeidere. None gir standardverdien til poolen.
+    """
+    if modus == "tråd":
+        return ThreadPoolExecutor(max_workers=maks_arbeidere, thread_name_prefix="bildeanalyse")
+    if modus == "prosess":
+        return ProcessPoolExecutor(max_workers=maks_arbeidere)
+    raise ValueError(f"Ukjent executor-modus: {modus} (bruk 'tråd' eller 'prosess')")
+
+def _map(executor: Optional[Executor], kilder: List[BildeKilde], detektor: "detektorer.Detektor") -> List[List[Tuple[str, KapasitetKlasse]]]:
+    # Bildene sendes i biter på detektor.batch_storrelse (1 for konturanalysen, flere for en modell).
+    # Målinger fra arbeidsprosesser flettes inn (se metrikker.send_inn).
+    if executor is None:
+        return detektor.analyser(kilder)
+    n = detektor.batch_storrelse
+    futures = [metrikker.send_inn(executor, detektor.analyser, kilder[i:i + n]) for i in range(0, len(kilder), n)]
+    return [res for f in futures for res in f.result()]
+
+def _analyser_alle(bilder: List[BildeKilde], executor: Optional[Executor], cache: Optional[AnalyseCache] = None,
+                   detektor: Optional["detektorer.Detektor"] = None) -> List[List[Tuple[str, KapasitetKlasse]]]:
+    # Resultatene holdes i samme rekkefølge, så aggreringen blir lik den serielle
+    detektor = detektor or detektorer.aktiv()
+    if cache is None:
+        return _map(executor, list(bilder), detektor)
+        
+    # Cache-oppslag gjøres her i kallende prosess; kun bom sendes videre til poolen
+    resultater: List[Optional[List[Tuple[str, KapasitetKlasse]]]] = [None] * len(bilder)
+    bom = [] # [(indeks, kilde, nøkkel)]
+    for i, kilde in enumerate(bilder):
+        kilde, nokkel, resultater[i] = cache_oppslag(kilde, cache, detektor)
+        if resultater[i] is None:
+            bom.append((i, kilde, nokkel))
+            
+    nye = _map(executor, [kilde for _, kilde, _ in bom], detektor)
+    for (i, _, nokkel), res in zip(bom, nye):
+        resultater[i] = res
+        if nokkel is not None:
+            cache.lagre(nokkel, res)
+    return resultater
+
+def aggreger_observasjoner(resultater: Iterable[List[Tuple[str, KapasitetKlasse]]], oppgang_id: str) -> List[Dict[str, Any]]:
+    """
+    Slår sammen funn fra flere bilder av samme oppgang (konservativt: største klasse vinner).
+    """
     observasjoner = {} # {pk_id: [KapasitetKlasse, ...]}
     
     # 1. Samle data fra alle bilder
-    for sti in bilder:
-        res = analyser_bilde(sti)
+    for res in resultater:
         for pk_id, kap in res:
             if pk_id not in observasjoner:
                 observasjoner[pk_id] = []
@@ -153,3 +528,41 @@ def analyser_bilder_av_oppgang(bilder: List[str], oppgang_id: str) -> List[Dict[
         output_data.append(data)
         
     return output_data
+
+def analyser_bilder_av_oppgang(bilder: List[BildeKilde], oppgang_id: str, executor: Optional[Executor] = None,
+                               cache: Optional[AnalyseCache] = None, detektor: Optional["detektorer.Detektor"] = None) -> List[Dict[str, Any]]:
+    """
+    Tar flere bilder av samme oppgang, aggregerer resultatene og returnerer strukturert data.
+    Med en executor (se lag_executor) analyseres bildene parallelt.
+    Med en AnalyseCache gjenbrukes resultater for bilder som er analysert før.
+    detektor velger analysemetode (se modules.detektorer); None bruker den aktive.
+    """
+    logger.info(f"Analyserer {len(bilder)} bilder for oppgang {oppgang_id}")
+    return aggreger_observasjoner(_analyser_alle(bilder, executor, cache, detektor), oppgang_id)
+
+def analyser_rute(oppganger: Dict[str, List[BildeKilde]], executor: Optional[Executor] = None,
+                  cache: Optional[AnalyseCache] = None, detektor: Optional["detektorer.Detektor"] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Analyserer alle oppganger på en rute i én samlet kjøring.
+    Alle bilder sendes til poolen samtidig, slik at små oppganger ikke blir en flaskehals.
+    
+    Args:
+        oppganger: {oppgang_id: [bildekilder]}
+        executor: Pool fra lag_executor. None kjører serielt.
+        cache: Valgfri AnalyseCache.
+        detektor: Analysemetode (se modules.detektorer). None bruker den aktive.
+        
+    Returns:
+        {oppgang_id: aggregert output som fra analyser_bilder_av_oppgang}
+    """
+    flate_bilder = [kilde for bilder in oppganger.values() for kilde in bilder]
+    logger.info(f"Analyserer rute med {len(oppganger)} oppganger og {len(flate_bilder)} bilder")
+    resultater = _analyser_alle(flate_bilder, executor, cache, detektor)
+    
+    output = {}
+    start = 0
+    for oppgang_id, bilder in oppganger.items():
+        slutt = start + len(bilder)
+        output[oppgang_id] = aggreger_observasjoner(resultater[start:slutt], oppgang_id)
+        start = slutt
+    return output
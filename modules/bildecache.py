@@ -0,0 +1,209 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Tuple, Dict, Any, Optional
+from modules.datamodel import KapasitetKlasse
+
+logger = logging.getLogger(__name__)
+
+Analyseresultat = List[Tuple[str, KapasitetKlasse]]
+
+class FeiletAnalyse(list):
+    """
+    Tomt resultat for et bilde som ikke kunne leses eller analyseres.
+    Oppfører seg som en tom liste, men skilles fra "ingen postkasser funnet"
+    så feilen ikke caches.
+    """
+
+class AnalyseCache:
+    """
+    Innholdsadressert cache for resultater fra bildeanalyse.analyser_bilde.
+
+    Nøkkelen er en SHA-256 av bildebytes pluss analyseparametrene, så samme
+    bilde lastet opp to ganger treffer cachen uansett filnavn.
+    To nivåer:
+        Minne: LRU med maks_elementer oppføringer.
+        Disk (valgfritt): én JSON-fil per nøkkel i disk_katalog, med
+        LRU-utkastelse (etter endringstid) når katalogen passerer maks_disk_bytes.
+
+    Diskkatalogen kan deles av flere prosesser. Filene skrives atomisk, og
+    treff på filer fra andre prosesser brukes. Grensen gjelder hele katalogen:
+    hver prosess teller katalogen opp på nytt for hver tiendedel av
+    maks_disk_bytes den skriver, så katalogen kan overskride grensen med
+    omtrent 10 % per prosess. Feilede analyser (FeiletAnalyse) lagres ikke.
+    """
+
+    def __init__(self, maks_elementer: int = 1024, disk_katalog: Optional[str] = None, maks_disk_bytes: int = 64 * 1024 * 1024):
+        self.maks_elementer = maks_elementer
+        self.disk_katalog = disk_katalog
+        self.maks_disk_bytes = maks_disk_bytes
+
+        self._lås = threading.Lock()
+        self._minne: "OrderedDict[str, Analyseresultat]" = OrderedDict()
+        self._disk: "OrderedDict[str, int]" = OrderedDict() # {nøkkel: filstørrelse}, eldste først
+        self._disk_bytes = 0
+        self._skrevet_siden_telling = 0
+
+        self.minne_treff = 0
+        self.disk_treff = 0
+        self.bom = 0
+
+        if disk_katalog:
+            os.makedirs(disk_katalog, exist_ok=True)
+            self._les_diskindeks()
+
+    @staticmethod
+    def nokkel(innhold: bytes, parametre: Dict[str, Any]) -> str:
+        """Lager cache-nøkkel av bildeinnhold og analyseparametre."""
+        h = hashlib.sha256(innhold)
+        h.update(json.dumps(parametre, sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+    # --- Disknivå ---
+
+    def _disk_sti(self, nokkel: str) -> str:
+        return os.path.join(self.disk_katalog, f"{nokkel}.json")
+
+    def _les_diskindeks(self) -> None:
+        # Ved oppstart og før utkastelse; ellers holdes indeksen i minnet
+        self._disk.clear()
+        self._disk_bytes = 0
+        self._skrevet_siden_telling = 0
+        oppforinger = []
+        for entry in os.scandir(self.disk_katalog):
+            if entry.is_file() and entry.name.endswith(".json"):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue # Fjernet av en annen prosess
+                oppforinger.append((st.st_mtime, entry.name[:-5], st.st_size))
+        for _, nokkel, storrelse in sorted(oppforinger):
+            self._disk[nokkel] = storrelse
+            self._disk_bytes += storrelse
+
+    def _hent_disk(self, nokkel: str) -> Optional[Analyseresultat]:
+        if not self.disk_katalog:
+            return None
+        sti = self._disk_sti(nokkel)
+        try:
+            with open(sti) as f:
+                storrelse = os.fstat(f.fileno()).st_size
+                data = json.load(f)
+            os.utime(sti) # Marker som nylig brukt
+        except FileNotFoundError:
+            self._glem_disk(nokkel) # Aldri skrevet, eller kastet ut av en annen prosess
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ugyldig cache-fil {sti}: {e}")
+            self._fjern_disk(nokkel)
+            return None
+        if nokkel not in self._disk: # Skrevet av en annen prosess
+            self._disk[nokkel] = storrelse
+            self._disk_bytes += storrelse
+        self._disk.move_to_end(nokkel)
+        return [(pk_id, KapasitetKlasse[navn]) for pk_id, navn in data]
+
+    def _lagre_disk(self, nokkel: str, resultat: Analyseresultat) -> None:
+        if not self.disk_katalog or nokkel in self._disk:
+            return
+        sti = self._disk_sti(nokkel)
+        innhold = json.dumps([[pk_id, kap.name] for pk_id, kap in resultat]).encode("utf-8")
+        tmp = f"{sti}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(innhold)
+            os.replace(tmp, sti) # Andre prosesser ser aldri en halvskrevet fil
+        except OSError as e:
+            logger.warning(f"Kunne ikke skrive cache-fil {sti}: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self._disk[nokkel] = len(innhold)
+        self._disk_bytes += len(innhold)
+
+        self._skrevet_siden_telling += len(innhold)
+
+        # Andre prosesser skriver også: tell opp katalogen på nytt når indeksen
+        # passerer grensen, eller etter hver tiendedel av grensen som er skrevet
+        if self._disk_bytes > self.maks_disk_bytes or self._skrevet_siden_telling >= self.maks_disk_bytes // 10:
+            self._les_diskindeks()
+            if self._disk_bytes > self.maks_disk_bytes:
+                # Ned til 90 %, så neste lagring ikke straks må kaste ut igjen
+                grense = self.maks_disk_bytes * 9 // 10
+                while self._disk_bytes > grense and len(self._disk) > 1:
+                    eldste = next(iter(self._disk))
+                    self._fjern_disk(eldste)
+
+    def _glem_disk(self, nokkel: str) -> None:
+        self._disk_bytes -= self._disk.pop(nokkel, 0)
+
+    def _fjern_disk(self, nokkel: str) -> None:
+        self._glem_disk(nokkel)
+        try:
+            os.remove(self._disk_sti(nokkel))
+        except OSError:
+            pass
+
+    # --- API ---
+
+    def hent(self, nokkel: str) -> Optional[Analyseresultat]:
+        """Slår opp et resultat. Disktreff flyttes opp i minnet."""
+        with self._lås:
+            resultat = self._minne.get(nokkel)
+            if resultat is not None:
+                self._minne.move_to_end(nokkel)
+                self.minne_treff += 1
+                return list(resultat)
+
+            resultat = self._hent_disk(nokkel)
+            if resultat is not None:
+                self.disk_treff += 1
+                self._legg_i_minne(nokkel, resultat)
+                return list(resultat)
+
+            self.bom += 1
+            return None
+
+    def _legg_i_minne(self, nokkel: str, resultat: Analyseresultat) -> None:
+        self._minne[nokkel] = list(resultat)
+        self._minne.move_to_end(nokkel)
+        while len(self._minne) > self.maks_elementer:
+            self._minne.popitem(last=False)
+
+    def lagre(self, nokkel: str, resultat: Analyseresultat) -> None:
+        """Lagrer et resultat i begge nivåer. En FeiletAnalyse ignoreres."""
+        if isinstance(resultat, FeiletAnalyse):
+            return
+        with self._lås:
+            self._legg_i_minne(nokkel, resultat)
+            self._lagre_disk(nokkel, resultat)
+
+    def tom(self) -> None:
+        """Tømmer begge nivåer og nullstiller tellerne."""
+        with self._lås:
+            self._minne.clear()
+            if self.disk_katalog:
+                self._les_diskindeks()
+            for nokkel in list(self._disk):
+                self._fjern_disk(nokkel)
+            self.minne_treff = self.disk_treff = self.bom = 0
+
+    def statistikk(self) -> Dict[str, Any]:
+        with self._lås:
+            treff = self.minne_treff + self.disk_treff
+            oppslag = treff + self.bom
+            return {
+                "treff": treff,
+                "minne_treff": self.minne_treff,
+                "disk_treff": self.disk_treff,
+                "bom": self.bom,
+                "treffrate": treff / oppslag if oppslag else 0.0,
+                "elementer_minne": len(self._minne),
+                "elementer_disk": len(self._disk),
+                "disk_bytes": self._disk_bytes
+            }
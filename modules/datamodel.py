@@ -1,3 +1,4 @@
+import sys
 from dataclasses import dataclass
 from enum import Enum, auto
 from typing import List, Optional
@@ -20,7 +21,20 @@ class KapasitetKlasse(Enum):
     STANDARD = 2 # Passer S og M
     STOR = 3     # Passer S, M og L
 
-@dataclass
+class Utfall(Enum):
+    """
+    Utfall av en leveringsbeslutning.
+    Verdien brukes som kompakt kode i kolonnebaserte beslutningslogger.
+    """
+    LEVERT_I_POSTKASSE = 0
+    HENTEKONTOR = 1
+    UKJENT_POSTKASSE = 2 # Mottaker finnes ikke i registeret
+
+# Modellene er slottet (ingen __dict__ per objekt), og ID-er internes slik at
+# samme ID-streng deles av alle objekter som peker på den. Ved hydrering av
+# mange postkasser bør også ett felles tidsstempel (datetime) gjenbrukes.
+
+@dataclass(slots=True)
 class Postkasse:
     """
     Representerer en fysisk postkasse i en oppgang.
@@ -30,19 +44,30 @@ class Postkasse:
     kapasitet_klasse: KapasitetKlasse # Estimert kapasitet
     sist_verifisert: datetime # Tidsstempel for når bildeanalysen ble kjørt
 
-@dataclass
+    def __post_init__(self):
+        self.id = sys.intern(str(self.id))
+        self.oppgang_id = sys.intern(str(self.oppgang_id))
+
+@dataclass(frozen=True, slots=True)
 class Pakke:
     """
-    Representerer en pakke som skal leveres.
+    Representerer en pakke som skal leveres. Uforanderlig.
     """
     id: str # Sporingsnummer e.l.
     volum_klasse: VolumKlasse # Størrelse på pakken
     mottaker_postkasse_id: str # ID til postkassen den skal til
 
-@dataclass
+    def __post_init__(self):
+        # Mange pakker går til samme postkasse; del ID-strengen med postkassen
+        object.__setattr__(self, "mottaker_postkasse_id", sys.intern(str(self.mottaker_postkasse_id)))
+
+@dataclass(slots=True)
 class Oppgang:
     """
     Representerer en oppgang (inngangsparti) med flere postkasser.
     """
     id: str
     postkasser: List[Postkasse]
+
+    def __post_init__(self):
+        self.id = sys.intern(str(self.id))
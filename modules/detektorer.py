@@ -0,0 +1,316 @@
+import os
+import ast
+import hashlib
+import logging
+import threading
+import cv2
+import numpy as np
+from typing import List, Tuple, Dict, Any, Optional
+from modules.datamodel import KapasitetKlasse
+from modules.bildecache import FeiletAnalyse
+from modules import bildeanalyse, metrikker
+
+logger = logging.getLogger(__name__)
+
+Funn = List[Tuple[str, KapasitetKlasse]] # Som analyser_bilde: [(PK-1, klasse), ...] ovenfra og ned
+BoksFunn = List[Tuple["bildeanalyse.Boks", KapasitetKlasse]] # Som finn_postkasser: [((x, y, w, h), klasse), ...]
+
+def til_funn(bokser: BoksFunn) -> Funn:
+    """Nummererer bokser (ovenfra og ned) som PK-1, PK-2, ..."""
+    if isinstance(bokser, FeiletAnalyse):
+        return FeiletAnalyse() # Bildet kunne ikke analyseres; skal ikke caches
+    return [(f"PK-{i + 1}", kap) for i, (_, kap) in enumerate(bokser)]
+
+class Detektor:
+    """
+    Grensesnitt for postkassedetektorer brukt av bildeanalyse.
+
+    analyser() tar en liste bildekilder og returnerer funn per bilde i samme
+    rekkefølge. batch_storrelse sier hvor mange bilder som lønner seg å sende
+    i ett kall; parametre() inngår i cache-nøkkelen, så to detektorer aldri
+    deler cache-oppføringer.
+    """
+
+    navn = "detektor"
+    batch_storrelse = 1
+
+    def analyser(self, kilder: List["bildeanalyse.BildeKilde"]) -> List[Funn]:
+        raise NotImplementedError
+
+    def finn_bokser(self, kilder: List["bildeanalyse.BildeKilde"]) -> List[BoksFunn]:
+        """Som analyser(), men med boksen (full oppløsning) til hvert funn. Trengs til sporing."""
+        raise NotImplementedError(f"Detektoren {self.navn} gir ikke bokser")
+
+    def parametre(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def varm_opp(self) -> None:
+        """Laster det som trengs og kjører et første kall, så første forespørsel ikke betaler for det."""
+
+class KonturDetektor(Detektor):
+    """Terskel + konturer (bildeanalyse.analyser_bilde). Ingen modell, ett bilde per kall."""
+
+    navn = "kontur"
+
+    def analyser(self, kilder: List["bildeanalyse.BildeKilde"]) -> List[Funn]:
+        return [bildeanalyse.analyser_bilde(kilde) for kilde in kilder]
+
+    def finn_bokser(self, kilder: List["bildeanalyse.BildeKilde"]) -> List[BoksFunn]:
+        return [bildeanalyse.finn_postkasser(kilde) for kilde in kilder]
+
+    def parametre(self) -> Dict[str, Any]:
+        # Uendret fra før detektorene kom, så eksisterende cache-oppføringer gjelder fortsatt
+        return bildeanalyse.analyse_parametre()
+
+# --- ONNX (YOLOv8 eksportert med train_model.py) ---
+
+# Én økt per modell og prosess, delt av alle detektorer og tråder (InferenceSession.run er trådsikker)
+_ØKTER: Dict[Tuple[str, Optional[int]], Any] = {}
+_ØKT_LÅS = threading.Lock()
+
+def _last_okt(modell_sti: str, tråder: Optional[int]) -> Any:
+    nokkel = (os.path.abspath(modell_sti), tråder)
+    with _ØKT_LÅS:
+        okt = _ØKTER.get(nokkel)
+        if okt is None:
+            try:
+                import onnxruntime as ort
+            except ImportError:
+                raise ImportError("ONNX-detektoren krever onnxruntime (pip install onnxruntime)") from None
+            valg = ort.SessionOptions()
+            valg.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if tråder:
+                valg.intra_op_num_threads = tråder
+            okt = ort.InferenceSession(modell_sti, sess_options=valg, providers=["CPUExecutionProvider"])
+            _ØKTER[nokkel] = okt
+            logger.info(f"Lastet ONNX-modell {modell_sti}")
+        return okt
+
+def letterbox(bilde: np.ndarray, storrelse: int, ut: Optional[np.ndarray] = None) -> Tuple[np.ndarray, float, int, int]:
+    """
+    Skalerer bildet inn i en storrelse x storrelse ramme med bevart sideforhold
+    og grå kanter (114, som i YOLOv8-treningen).
+
+    Returns:
+        (ramme, skala, pad_x, pad_y). Et punkt i rammen tilsvarer ((x - pad_x) / skala, (y - pad_y) / skala) i bildet.
+    """
+    h, w = bilde.shape[:2]
+    skala = min(storrelse / h, storrelse / w)
+    nh, nw = max(1, round(h * skala)), max(1, round(w * skala))
+    pad_x, pad_y = (storrelse - nw) // 2, (storrelse - nh) // 2
+
+    if ut is None:
+        ut = np.empty((storrelse, storrelse, 3), dtype=np.uint8)
+    ut[...] = 114
+    if (nh, nw) != (h, w):
+        bilde = cv2.resize(bilde, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    ut[pad_y:pad_y + nh, pad_x:pad_x + nw] = bilde
+    return ut, skala, pad_x, pad_y
+
+_REDUSERT_FARGE = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+def _dekod_for_modell(kilde: "bildeanalyse.BildeKilde", storrelse: int) -> Tuple[Optional[np.ndarray], int]:
+    # Modellen ser bare storrelse px, så store JPEG-er dekodes direkte nedskalert (som i _Gratone)
+    if isinstance(kilde, str):
+        with open(kilde, "rb") as f:
+            kilde = f.read()
+    if isinstance(kilde, (bytes, bytearray, memoryview)):
+        dim = bildeanalyse.les_dimensjoner(kilde)
+        faktor = 1
+        while dim and faktor < 8 and max(dim) // (faktor * 2) >= storrelse:
+            faktor *= 2
+        if faktor > 1:
+            return cv2.imdecode(np.frombuffer(kilde, dtype=np.uint8), _REDUSERT_FARGE[faktor]), faktor
+    bilde = bildeanalyse.les_bilde(kilde)
+    if bilde is not None and bilde.ndim == 2:
+        bilde = cv2.cvtColor(bilde, cv2.COLOR_GRAY2BGR)
+    return bilde, 1
+
+class OnnxDetektor(Detektor):
+    """
+    YOLOv8-modell eksportert til ONNX, kjørt på CPU med onnxruntime.
+
+    Bildene letterboxes og kjøres i batcher på batch_storrelse. Økten lastes én
+    gang per prosess (se _last_okt); objektet kan sendes til arbeidsprosesser,
+    som da laster modellen selv ved første bruk.
+
+    Kapasitetsklasse: har modellen klasser som heter LITEN/STANDARD/STOR, brukes
+    de. Ellers (én klasse, "postkasse") klassifiseres boksens høyde i full
+    oppløsning med de samme grensene som konturanalysen.
+    """
+
+    navn = "onnx"
+
+    def __init__(self, modell_sti: str, bildestorrelse: int = 640, konf_terskel: float = 0.25,
+                 iou_terskel: float = 0.45, batch_storrelse: int = 8, tråder: Optional[int] = None):
+        if not os.path.exists(modell_sti):
+            raise FileNotFoundError(f"Fant ikke modellen: {modell_sti}")
+        self.modell_sti = modell_sti
+        self.bildestorrelse = bildestorrelse
+        self.konf_terskel = konf_terskel
+        self.iou_terskel = iou_terskel
+        self.batch_storrelse = batch_storrelse
+        self.tråder = tråder
+        with open(modell_sti, "rb") as f:
+            self._modell_hash = hashlib.sha256(f.read()).hexdigest()
+        self._okt: Any = None
+        self._klasser: Optional[Dict[int, KapasitetKlasse]] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Økten kan ikke pickles; arbeidsprosessen laster sin egen
+        tilstand = dict(self.__dict__)
+        tilstand["_okt"] = None
+        return tilstand
+
+    def parametre(self) -> Dict[str, Any]:
+        return {
+            "detektor": self.navn,
+            "modell": self._modell_hash,
+            "bildestorrelse": self.bildestorrelse,
+            "konf_terskel": self.konf_terskel,
+            "iou_terskel": self.iou_terskel,
+            "grense_liten": bildeanalyse.GRENSE_LITEN,
+            "grense_standard": bildeanalyse.GRENSE_STANDARD
+        }
+
+    def _sikre_okt(self) -> Any:
+        if self._okt is None:
+            # Bygges i lokale variabler og publiseres med _okt til slutt: en annen
+            # tråd som ser _okt satt, ser også resten. To tråder som laster samtidig
+            # får samme økt fra _last_okt og skriver samme verdier.
+            okt = _last_okt(self.modell_sti, self.tråder)
+            inn = okt.get_inputs()[0]
+            # Fast batchdimensjon (eksport uten dynamic=True) begrenser batchene
+            fast_batch = inn.shape[0] if isinstance(inn.shape[0], int) and inn.shape[0] > 0 else None
+            self._inn_navn = inn.name
+            self._fast_batch = fast_batch
+            self._klasser = self._les_klasser(okt)
+            if fast_batch:
+                self.batch_storrelse = min(self.batch_storrelse, fast_batch)
+            self._okt = okt
+        return self._okt
+
+    def _les_klasser(self, okt: Any) -> Dict[int, KapasitetKlasse]:
+        # Ultralytics lagrer klassenavnene i metadata som "{0: 'postkasse'}"
+        navn = okt.get_modelmeta().custom_metadata_map.get("names")
+        try:
+            navn = ast.literal_eval(navn) if navn else {}
+        except (ValueError, SyntaxError):
+            navn = {}
+        return {int(i): KapasitetKlasse[n.upper()] for i, n in navn.items() if n.upper() in KapasitetKlasse.__members__}
+
+    def varm_opp(self) -> None:
+        self._sikre_okt()
+        self._kjør(np.zeros((self._fast_batch or 1, 3, self.bildestorrelse, self.bildestorrelse), dtype=np.float32))
+        logger.info(f"ONNX-detektor klar ({os.path.basename(self.modell_sti)}, batch {self.batch_storrelse})")
+
+    def _kjør(self, batch: np.ndarray) -> np.ndarray:
+        n = len(batch)
+        if self._fast_batch and n < self._fast_batch:
+            batch = np.concatenate([batch, np.zeros((self._fast_batch - n,) + batch.shape[1:], dtype=batch.dtype)])
+        return self._okt.run(None, {self._inn_navn: batch})[0][:n]
+
+    def _klasse(self, klasse_nr: int, h: float) -> KapasitetKlasse:
+        if klasse_nr in self._klasser:
+            return self._klasser[klasse_nr]
+        if h < bildeanalyse.GRENSE_LITEN: return KapasitetKlasse.LITEN
+        if h < bildeanalyse.GRENSE_STANDARD: return KapasitetKlasse.STANDARD
+        return KapasitetKlasse.STOR
+
+    def _etterbehandle(self, pred: np.ndarray, skala: float, pad_x: int, pad_y: int, faktor: int) -> BoksFunn:
+        # pred: (4 + klasser, kandidater) med (cx, cy, w, h) i letterbox-piksler
+        pred = pred.T
+        poeng = pred[:, 4:]
+        klasse_nr = poeng.argmax(axis=1)
+        konf = poeng[np.arange(len(pred)), klasse_nr]
+        behold = konf >= self.konf_terskel
+        if not behold.any():
+            return []
+        pred, klasse_nr, konf = pred[behold], klasse_nr[behold], konf[behold]
+
+        # Tilbake til piksler i originalbildet (før eventuell nedskalert dekoding)
+        f = faktor / skala
+        w, h = pred[:, 2] * f, pred[:, 3] * f
+        x = (pred[:, 0] - pad_x) * f - w / 2
+        y = (pred[:, 1] - pad_y) * f - h / 2
+        bokser = np.stack([x, y, w, h], axis=1)
+
+        valgt = np.asarray(cv2.dnn.NMSBoxes(bokser.tolist(), konf.tolist(), self.konf_terskel, self.iou_terskel)).reshape(-1)
+        valgt = valgt[np.argsort(y[valgt], kind="stable")] # Ovenfra og ned, som konturanalysen
+        return [((int(round(x[j])), int(round(y[j])), int(round(w[j])), int(round(h[j]))), self._klasse(int(klasse_nr[j]), float(h[j])))
+                for j in valgt]
+
+    def analyser(self, kilder: List["bildeanalyse.BildeKilde"]) -> List[Funn]:
+        return [til_funn(bokser) for bokser in self.finn_bokser(kilder)]
+
+    def finn_bokser(self, kilder: List["bildeanalyse.BildeKilde"]) -> List[BoksFunn]:
+        self._sikre_okt()
+        resultater: List[BoksFunn] = []
+        for start in range(0, len(kilder), self.batch_storrelse):
+            resultater.extend(self._analyser_batch(kilder[start:start + self.batch_storrelse]))
+        return resultater
+
+    def _analyser_batch(self, kilder: List["bildeanalyse.BildeKilde"]) -> List[BoksFunn]:
+        klokke = metrikker.stoppeklokke()
+        s = self.bildestorrelse
+        rammer = np.empty((len(kilder), s, s, 3), dtype=np.uint8)
+        geometri: List[Optional[Tuple[float, int, int, int]]] = []
+        for i, kilde in enumerate(kilder):
+            try:
+                bilde, faktor = _dekod_for_modell(kilde, s)
+            except OSError:
+                bilde, faktor = None, 1
+            if bilde is None:
+                logger.error(f"Feil i OnnxDetektor: kunne ikke lese {bildeanalyse._beskriv(kilde)}")
+                klokke.tell("feil")
+                rammer[i] = 114
+                geometri.append(None)
+                continue
+            _, skala, pad_x, pad_y = letterbox(bilde, s, rammer[i])
+            geometri.append((skala, pad_x, pad_y, faktor))
+        klokke.runde("dekoding")
+
+        # BGR (N, H, W, 3) uint8 -> RGB (N, 3, H, W) float32 i [0, 1]
+        batch = np.ascontiguousarray(rammer[..., ::-1].transpose(0, 3, 1, 2), dtype=np.float32)
+        batch *= 1 / 255
+        klokke.runde("letterbox")
+        pred = self._kjør(batch)
+        klokke.runde("inferens")
+
+        resultater = [self._etterbehandle(p, *g) if g else FeiletAnalyse() for p, g in zip(pred, geometri)]
+        klokke.runde("klassifisering")
+        klokke.tell("bilder", sum(g is not None for g in geometri))
+        klokke.tell("postkasser", sum(len(r) for r in resultater))
+        klokke.ferdig()
+        return resultater
+
+# --- Aktiv detektor i prosessen ---
+
+_AKTIV: Detektor = KonturDetektor()
+
+def lag_detektor(navn: str = "kontur", modell_sti: Optional[str] = None, **valg: Any) -> Detektor:
+    """Lager en detektor ut fra navn ("kontur" eller "onnx")."""
+    if navn == "kontur":
+        return KonturDetektor()
+    if navn == "onnx":
+        if not modell_sti:
+            raise ValueError("ONNX-detektoren trenger modell_sti")
+        return OnnxDetektor(modell_sti, **valg)
+    raise ValueError(f"Ukjent detektor: {navn} (bruk 'kontur' eller 'onnx')")
+
+def aktiv() -> Detektor:
+    """Detektoren bildeanalyse bruker når ingen er oppgitt."""
+    return _AKTIV
+
+def installer(detektor: Detektor) -> None:
+    """
+    Gjør detektoren aktiv i denne prosessen og varmer den opp.
+    Kan brukes som initializer for en ProcessPoolExecutor.
+    """
+    global _AKTIV
+    detektor.varm_opp()
+    _AKTIV = detektor
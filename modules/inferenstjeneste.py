@@ -0,0 +1,435 @@
+import os
+import sys
+import time
+import queue
+import logging
+import secrets
+import argparse
+import ipaddress
+import itertools
+import threading
+import numpy as np
+from collections import Counter, deque
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client, Connection
+from typing import List, Tuple, Dict, Any, Optional, Union
+from modules import bildeanalyse, detektorer
+
+logger = logging.getLogger(__name__)
+
+Adresse = Union[Tuple[str, int], str] # (vert, port) eller sti til en Unix-socket
+
+STANDARD_ADRESSE: Adresse = ("127.0.0.1", 6001)
+# Meldingene er pickles, så nøkkelen er det eneste som hindrer andre prosesser i å
+# kjøre kode i tjenesten. INFERENCE_AUTHKEY vinner; ellers deler tjeneste og
+# arbeidere en tilfeldig nøkkel i NOKKEL_FIL, som tjenesten lager (0600) ved første start.
+NOKKEL_FIL = os.environ.get("INFERENCE_AUTHKEY_FILE", os.path.join("data", "inferens.key"))
+
+def les_nokkel(fil: Optional[str] = None, opprett: bool = False) -> bytes:
+    """Nøkkelen fra INFERENCE_AUTHKEY eller nøkkelfilen. opprett=True lager filen med en tilfeldig nøkkel."""
+    miljø = os.environ.get("INFERENCE_AUTHKEY")
+    if miljø:
+        return miljø.encode("utf-8")
+    fil = fil or NOKKEL_FIL
+    if opprett and not os.path.exists(fil):
+        os.makedirs(os.path.dirname(fil) or ".", exist_ok=True)
+        tmp = f"{fil}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp, fil) # Feiler hvis en annen tjeneste rakk å lage filen; da gjelder dens nøkkel
+            logger.info(f"Laget ny nøkkel for inferenstjenesten i {fil}")
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    try:
+        with open(fil) as f:
+            nokkel = f.read().strip()
+        modus = os.stat(fil).st_mode
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Ingen nøkkel for inferenstjenesten: sett INFERENCE_AUTHKEY "
+                                f"eller start tjenesten, som lager {fil}") from None
+    if not nokkel:
+        raise ValueError(f"Nøkkelfilen {fil} er tom")
+    if modus & 0o077:
+        logger.warning(f"Nøkkelfilen {fil} kan leses av andre brukere (chmod 600)")
+    return nokkel.encode("utf-8")
+
+def er_lokal(adresse: Adresse) -> bool:
+    """Unix-socket eller loopback: bare prosesser på samme maskin kan koble til."""
+    if isinstance(adresse, str):
+        return True
+    vert = adresse[0]
+    if vert == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(vert).is_loopback
+    except ValueError:
+        return False
+
+def les_adresse(tekst: str) -> Adresse:
+    """ "vert:port" -> (vert, port); alt annet tolkes som sti til en Unix-socket."""
+    vert, _, port = tekst.rpartition(":")
+    if vert and port.isdigit():
+        return vert, int(port)
+    return tekst
+
+# --- Tjenesten (sidevogn-prosessen) ---
+
+class _Forespørsel:
+    """Ett analyser-kall fra en klient. Svaret sendes når alle bildene er ferdige."""
+
+    def __init__(self, forbindelse: Connection, lås: threading.Lock, id: int, antall: int):
+        self.forbindelse = forbindelse
+        self.lås = lås
+        self.id = id
+        self.resultater: List[Any] = [None] * antall
+        self.gjenstår = antall
+
+    def sett(self, i: int, resultat: Any) -> None:
+        # Kalles bare fra batch-tråden, så telleren trenger ingen lås
+        self.resultater[i] = resultat
+        self.gjenstår -= 1
+        if self.gjenstår == 0:
+            feil = next((r for r in self.resultater if isinstance(r, Exception)), None)
+            svar = ("feil", self.id, str(feil)) if feil else ("ok", self.id, self.resultater)
+            try:
+                with self.lås:
+                    self.forbindelse.send(svar)
+            except (OSError, EOFError):
+                pass # Klienten har gått
+
+class _Statistikk:
+    """Batchstørrelser, køtid per bilde og tid per batch over de siste vindu målingene."""
+
+    def __init__(self, vindu: int = 10_000):
+        self._lås = threading.Lock()
+        self.batcher = 0
+        self.bilder = 0
+        self.storrelser: Counter = Counter()
+        self.ventetider: deque = deque(maxlen=vindu)
+        self.latenser: deque = deque(maxlen=vindu)
+
+    def registrer(self, ventetider: List[float], latens: float) -> None:
+        with self._lås:
+            self.batcher += 1
+            self.bilder += len(ventetider)
+            self.storrelser[len(ventetider)] += 1
+            self.ventetider.extend(ventetider)
+            self.latenser.append(latens)
+
+    @staticmethod
+    def _fordeling(verdier: deque) -> Dict[str, float]:
+        if not verdier:
+            return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "maks": 0.0}
+        ms = np.array(verdier) * 1000
+        p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+        return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "maks": float(ms.max())}
+
+    def oppsummer(self) -> Dict[str, Any]:
+        with self._lås:
+            return {
+                "batcher": self.batcher,
+                "bilder": self.bilder,
+                "snitt_batch": self.bilder / self.batcher if self.batcher else 0.0,
+                "batch_storrelser": dict(sorted(self.storrelser.items())),
+                "ventetid_ms": self._fordeling(self.ventetider),
+                "batch_latens_ms": self._fordeling(self.latenser)
+            }
+
+class Inferenstjeneste:
+    """
+    Holder én detektor og betjener alle serverarbeiderne over en lokal socket.
+
+    Bilder fra alle klienter legges i én kø. Batch-tråden tar det første bildet,
+    venter til maks_ventetid har gått siden det kom (eller til maks_batch bilder
+    er samlet) og kjører hele batchen i ett detektor-kall. Lav last gir altså små
+    batcher og kort ventetid, høy last fulle batcher.
+
+    Meldinger (pickles av multiprocessing.connection):
+        ("analyser", id, [kilder]) -> ("ok", id, [bokser per bilde]) eller ("feil", id, tekst)
+        ("parametre",)             -> detektorens parametre (til cache-nøkler)
+        ("statistikk",)            -> se statistikk()
+    """
+
+    def __init__(self, detektor: detektorer.Detektor, adresse: Adresse = STANDARD_ADRESSE,
+                 maks_batch: Optional[int] = None, maks_ventetid: float = 0.010, authkey: Optional[bytes] = None,
+                 nokkel_fil: Optional[str] = None):
+        self.detektor = detektor
+        self.adresse = adresse
+        self.maks_batch = maks_batch or max(detektor.batch_storrelse, 16)
+        self.maks_ventetid = maks_ventetid
+        self.authkey = authkey # None: les_nokkel() ved start
+        self.nokkel_fil = nokkel_fil
+        self._ko: "queue.Queue[Tuple[_Forespørsel, int, Any, float]]" = queue.Queue()
+        self._stopp = threading.Event()
+        self._statistikk = _Statistikk()
+        self._listener: Optional[Listener] = None
+        self._klient_lås = threading.Lock()
+        self.klienter = 0
+
+    def start(self) -> "Inferenstjeneste":
+        eksplisitt = self.authkey is not None or bool(os.environ.get("INFERENCE_AUTHKEY"))
+        if not er_lokal(self.adresse) and not eksplisitt:
+            raise ValueError(f"{self.adresse} er ikke en lokal adresse; sett INFERENCE_AUTHKEY "
+                             f"(samme verdi på serveren) for å lytte på nettverket")
+        if self.authkey is None:
+            self.authkey = les_nokkel(self.nokkel_fil, opprett=True)
+        self._listener = Listener(self.adresse, backlog=64, authkey=self.authkey) # Mange arbeidere kobler til samtidig
+        self.adresse = self._listener.address # Port 0 gir en ledig port
+        threading.Thread(target=self._godta, name="inferens-godta", daemon=True).start()
+        threading.Thread(target=self._kjør_batcher, name="inferens-batch", daemon=True).start()
+        logger.info(f"Inferenstjeneste lytter på {self.adresse} (maks batch {self.maks_batch}, "
+                    f"maks ventetid {self.maks_ventetid * 1000:.0f} ms)")
+        return self
+
+    def stopp(self) -> None:
+        self._stopp.set()
+        if self._listener is not None:
+            self._listener.close()
+
+    def statistikk(self) -> Dict[str, Any]:
+        stat = self._statistikk.oppsummer()
+        stat.update(ko=self._ko.qsize(), klienter=self.klienter, maks_batch=self.maks_batch,
+                    maks_ventetid_ms=self.maks_ventetid * 1000, detektor=self.detektor.navn)
+        return stat
+
+    def _godta(self) -> None:
+        while not self._stopp.is_set():
+            try:
+                forbindelse = self._listener.accept()
+            except AuthenticationError:
+                logger.warning("Avviste en klient med feil nøkkel")
+                continue
+            except (OSError, EOFError):
+                if self._stopp.is_set():
+                    return
+                continue
+            threading.Thread(target=self._betjen, args=(forbindelse,), name="inferens-klient", daemon=True).start()
+
+    def _betjen(self, forbindelse: Connection) -> None:
+        lås = threading.Lock() # Batch-tråden og denne tråden skriver til samme forbindelse
+        with self._klient_lås:
+            self.klienter += 1
+        try:
+            while True:
+                melding = forbindelse.recv()
+                if melding[0] == "analyser":
+                    _, id, kilder = melding
+                    if not kilder:
+                        with lås:
+                            forbindelse.send(("ok", id, []))
+                        continue
+                    forespørsel = _Forespørsel(forbindelse, lås, id, len(kilder))
+                    naa = time.perf_counter()
+                    for i, kilde in enumerate(kilder):
+                        self._ko.put((forespørsel, i, kilde, naa))
+                else:
+                    svar = self.detektor.parametre() if melding[0] == "parametre" else self.statistikk()
+                    with lås:
+                        forbindelse.send(svar)
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self._klient_lås:
+                self.klienter -= 1
+            forbindelse.close()
+
+    def _samle_batch(self) -> Optional[List[Tuple[_Forespørsel, int, Any, float]]]:
+        try:
+            første = self._ko.get(timeout=0.1)
+        except queue.Empty:
+            return None
+        batch = [første]
+        frist = første[3] + self.maks_ventetid
+        while len(batch) < self.maks_batch:
+            igjen = frist - time.perf_counter()
+            try:
+                batch.append(self._ko.get(timeout=igjen) if igjen > 0 else self._ko.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _kjør_batcher(self) -> None:
+        while not self._stopp.is_set():
+            batch = self._samle_batch()
+            if batch is None:
+                continue
+            start = time.perf_counter()
+            try:
+                resultater: List[Any] = self.detektor.finn_bokser([kilde for _, _, kilde, _ in batch])
+            except Exception as e:
+                logger.error(f"Feil i batch på {len(batch)} bilder: {e}")
+                resultater = [e] * len(batch)
+            slutt = time.perf_counter()
+            self._statistikk.registrer([start - mottatt for _, _, _, mottatt in batch], slutt - start)
+            for (forespørsel, i, _, _), resultat in zip(batch, resultater):
+                forespørsel.sett(i, resultat)
+
+# --- Klienten (i serverarbeiderne) ---
+
+class TjenesteDetektor(detektorer.Detektor):
+    """
+    Detektor som sender bildene til en Inferenstjeneste i stedet for å laste
+    modellen selv. Hver tråd får sin egen forbindelse; objektet kan sendes til
+    arbeidsprosesser, som da kobler til ved første bruk.
+    """
+
+    navn = "tjeneste"
+    batch_storrelse = 64 # Tjenesten lager batchene selv; dette begrenser bare meldingsstørrelsen
+
+    def __init__(self, adresse: Adresse = STANDARD_ADRESSE, authkey: Optional[bytes] = None, tidsavbrudd: float = 60.0):
+        self.adresse = adresse
+        self.authkey = authkey # None: les_nokkel() ved første kall, så tjenesten kan starte etter serveren
+        self.tidsavbrudd = tidsavbrudd
+        self._parametre: Optional[Dict[str, Any]] = None
+        self._lokal = threading.local()
+        self._id = itertools.count()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        tilstand = dict(self.__dict__)
+        del tilstand["_lokal"], tilstand["_id"]
+        return tilstand
+
+    def __setstate__(self, tilstand: Dict[str, Any]) -> None:
+        self.__dict__.update(tilstand)
+        self._lokal = threading.local()
+        self._id = itertools.count()
+
+    def _nokkel(self) -> bytes:
+        if self.authkey is None:
+            try:
+                self.authkey = les_nokkel()
+            except FileNotFoundError as e:
+                raise ConnectionError(str(e)) from e
+        return self.authkey
+
+    def _forbindelse(self) -> Connection:
+        # En fork arver trådens forbindelse; barnet må ikke dele socketen med forelderen
+        if getattr(self._lokal, "pid", None) != os.getpid():
+            self._lokal.forbindelse = None
+            self._lokal.pid = os.getpid()
+        if self._lokal.forbindelse is None:
+            self._lokal.forbindelse = Client(self.adresse, authkey=self._nokkel())
+        return self._lokal.forbindelse
+
+    def _lukk_forbindelse(self) -> None:
+        forbindelse = getattr(self._lokal, "forbindelse", None)
+        self._lokal.forbindelse = None
+        if forbindelse is not None:
+            forbindelse.close()
+
+    def _spør(self, melding: tuple) -> Any:
+        for forsøk in range(2):
+            try:
+                forbindelse = self._forbindelse()
+                forbindelse.send(melding)
+                if not forbindelse.poll(self.tidsavbrudd):
+                    raise TimeoutError(f"Inferenstjenesten svarte ikke innen {self.tidsavbrudd} s")
+                return forbindelse.recv()
+            except (EOFError, ConnectionError, BrokenPipeError) as e:
+                # Tjenesten kan ha startet på nytt: koble til én gang til
+                self._lokal.forbindelse = None
+                if forsøk == 1:
+                    raise ConnectionError(f"Ingen kontakt med inferenstjenesten på {self.adresse}: {e}") from e
+            except AuthenticationError as e:
+                self._lokal.forbindelse = None
+                raise ConnectionError(f"Inferenstjenesten på {self.adresse} avviste nøkkelen") from e
+            except TimeoutError:
+                self._lukk_forbindelse() # Et sent svar må ikke havne hos neste kall
+                raise
+
+    def analyser(self, kilder: List[bildeanalyse.BildeKilde]) -> List[detektorer.Funn]:
+        return [detektorer.til_funn(bokser) for bokser in self.finn_bokser(kilder)]
+
+    def finn_bokser(self, kilder: List[bildeanalyse.BildeKilde]) -> List[detektorer.BoksFunn]:
+        # Filstier leses her; tjenesten kan ha en annen arbeidskatalog
+        sendes = []
+        for kilde in kilder:
+            if isinstance(kilde, str):
+                with open(kilde, "rb") as f:
+                    kilde = f.read()
+            elif isinstance(kilde, (bytearray, memoryview)):
+                kilde = bytes(kilde)
+            sendes.append(kilde)
+        id = next(self._id)
+        status, svar_id, svar = self._spør(("analyser", id, sendes))
+        if svar_id != id:
+            self._lukk_forbindelse() # Svarene er ute av takt med forespørslene
+            raise RuntimeError(f"Inferenstjenesten svarte på forespørsel {svar_id}, ventet {id}")
+        if status != "ok":
+            raise RuntimeError(f"Inferenstjenesten feilet: {svar}")
+        return svar
+
+    def parametre(self) -> Dict[str, Any]:
+        # Samme nøkler som detektoren i tjenesten, så cachen deles med lokal analyse
+        if self._parametre is None:
+            self._parametre = self._spør(("parametre",))
+        return self._parametre
+
+    def statistikk(self) -> Dict[str, Any]:
+        return self._spør(("statistikk",))
+
+    def varm_opp(self) -> None:
+        self.parametre()
+        logger.info(f"Koblet til inferenstjenesten på {self.adresse}")
+
+def prometheus(statistikk: Dict[str, Any], prefiks: str = "pkasse") -> str:
+    """Tjenestestatistikken i Prometheus tekstformat."""
+    linjer = [
+        f"# HELP {prefiks}_inferens_batcher_total Batcher kjørt av inferenstjenesten",
+        f"# TYPE {prefiks}_inferens_batcher_total counter",
+        f"{prefiks}_inferens_batcher_total {statistikk['batcher']}",
+        f"# HELP {prefiks}_inferens_bilder_total Bilder analysert av inferenstjenesten",
+        f"# TYPE {prefiks}_inferens_bilder_total counter",
+        f"{prefiks}_inferens_bilder_total {statistikk['bilder']}",
+        f"# HELP {prefiks}_inferens_ko Bilder som venter på en batch",
+        f"# TYPE {prefiks}_inferens_ko gauge",
+        f"{prefiks}_inferens_ko {statistikk['ko']}",
+        f"# HELP {prefiks}_inferens_snitt_batch Gjennomsnittlig batchstørrelse",
+        f"# TYPE {prefiks}_inferens_snitt_batch gauge",
+        f"{prefiks}_inferens_snitt_batch {statistikk['snitt_batch']:.3f}"
+    ]
+    for navn, hjelp in (("ventetid_ms", "Tid i kø før batchen starter"), ("batch_latens_ms", "Tid per batch")):
+        linjer.append(f"# HELP {prefiks}_inferens_{navn} {hjelp} (siste målinger)")
+        linjer.append(f"# TYPE {prefiks}_inferens_{navn} gauge")
+        for kvantil, verdi in statistikk[navn].items():
+            linjer.append(f'{prefiks}_inferens_{navn}{{kvantil="{kvantil}"}} {verdi:.3f}')
+    return "\n".join(linjer) + "\n"
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Inferenstjeneste: én detektor med dynamisk batching for alle serverarbeidere")
+    parser.add_argument("--detektor", choices=["kontur", "onnx"], default="onnx")
+    parser.add_argument("--modell", help="ONNX-modell for --detektor onnx")
+    parser.add_argument("--adresse", default=f"{STANDARD_ADRESSE[0]}:{STANDARD_ADRESSE[1]}",
+                        help="vert:port eller sti til Unix-socket; annet enn loopback krever INFERENCE_AUTHKEY")
+    parser.add_argument("--nokkel-fil", default=NOKKEL_FIL, help="Delt nøkkel når INFERENCE_AUTHKEY ikke er satt (lages ved behov)")
+    parser.add_argument("--maks-batch", type=int, default=None, help="Største batch (standard: detektorens, minst 16)")
+    parser.add_argument("--maks-ventetid-ms", type=float, default=10.0, help="Lengste tid første bilde venter på flere")
+    parser.add_argument("--statistikk-intervall", type=float, default=60.0, help="Sekunder mellom statistikk i loggen (0 = aldri)")
+    args = parser.parse_args(argv)
+
+    if not er_lokal(les_adresse(args.adresse)) and not os.environ.get("INFERENCE_AUTHKEY"):
+        parser.error(f"{args.adresse} er ikke loopback: sett INFERENCE_AUTHKEY (samme verdi på serveren)")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    valg = {"batch_storrelse": args.maks_batch} if args.detektor == "onnx" and args.maks_batch else {}
+    detektor = detektorer.lag_detektor(args.detektor, args.modell, **valg)
+    detektorer.installer(detektor) # Last og varm opp før første klient kobler til
+    tjeneste = Inferenstjeneste(detektor, les_adresse(args.adresse), args.maks_batch, args.maks_ventetid_ms / 1000,
+                                nokkel_fil=args.nokkel_fil).start()
+    try:
+        while True:
+            time.sleep(args.statistikk_intervall or 3600)
+            if args.statistikk_intervall:
+                s = tjeneste.statistikk()
+                logger.info(f"{s['bilder']} bilder i {s['batcher']} batcher (snitt {s['snitt_batch']:.1f}), "
+                            f"ventetid p99 {s['ventetid_ms']['p99']:.1f} ms, batch p99 {s['batch_latens_ms']['p99']:.1f} ms, kø {s['ko']}")
+    except KeyboardInterrupt:
+        tjeneste.stopp()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+import os
+import time
+import uuid
+import logging
+import threading
+import multiprocessing
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from modules import metrikker
+
+logger = logging.getLogger(__name__)
+
+class KoFullError(Exception):
+    """Kastes når arbeidskøen er full. Klienten bør prøve igjen senere."""
+
+# I arbeidsprosessene: køen jobbene melder seg på når de faktisk starter
+_STARTKØ: Any = None
+
+def _start_arbeider(startkø: Any, initializer: Optional[Callable], initargs: tuple) -> None:
+    global _STARTKØ
+    _STARTKØ = startkø
+    if initializer is not None:
+        initializer(*initargs)
+
+def _kjør_jobb(jobb_id: str, meld: Optional[Callable[[str], None]], fn: Callable, args: tuple) -> Any:
+    # Poolen merker jobber som "running" allerede når de legges i kallkøen,
+    # så arbeideren sier selv fra når den begynner
+    if meld is not None:
+        meld(jobb_id)
+    elif _STARTKØ is not None:
+        _STARTKØ.put(jobb_id)
+    return fn(*args)
+
+def _ingenting() -> None:
+    pass
+
+@dataclass
+class Jobb:
+    """
+    En analysejobb i køen.
+    """
+    id: str
+    etikett: str # Fritekst som forteller hva resultatet er (f.eks. "bilde", "oppgang")
+    future: Future = field(repr=False)
+    opprettet: float = field(default_factory=time.time)
+    ferdig: Optional[float] = None
+    startet: bool = False # Satt av arbeideren når jobben faktisk begynner
+    deler: List["Jobb"] = field(default_factory=list, repr=False) # Jobbene en samlet jobb venter på
+
+    @property
+    def status(self) -> str:
+        if self.future.done():
+            # Avbrutt teller som feilet; exception() ville kastet CancelledError
+            if self.future.cancelled() or self.future.exception() is not None:
+                return "feilet"
+            return "ferdig"
+        if self.startet or any(d.startet or d.future.done() for d in self.deler):
+            return "kjører"
+        return "venter"
+
+class JobbKo:
+    """
+    Begrenset arbeidskø foran CPU-tunge analysekall.
+
+    Køen slipper inn maksimalt arbeidere + maks_ventende jobber om gangen.
+    Er den full, kastes KoFullError umiddelbart i stedet for at forespørselen
+    blir hengende. Ferdige jobber huskes i behold_sekunder slik at de kan
+    hentes med jobb-ID.
+
+    Ingen tråder eller prosesser startes før start(). I prosessmodus startes
+    arbeiderne der, før køens egen lyttetråd, så de forkes fra en prosess
+    uten andre tråder.
+    """
+
+    def __init__(self, arbeidere: Optional[int] = None, maks_ventende: Optional[int] = None,
+                 modus: str = "prosess", behold_sekunder: float = 600.0,
+                 initializer: Optional[Callable] = None, initargs: tuple = ()):
+        self.arbeidere = arbeidere or os.cpu_count() or 1
+        self.maks_ventende = self.arbeidere * 4 if maks_ventende is None else maks_ventende
+        self.modus = modus
+        self.behold_sekunder = behold_sekunder
+        if modus not in ("prosess", "tråd"):
+            raise ValueError(f"Ukjent modus: {modus} (bruk 'prosess' eller 'tråd')")
+        self._initializer = initializer
+        self._initargs = initargs
+        self._executor: Optional[Executor] = None
+        self._startkø: Any = None
+
+        self._lås = threading.Lock()
+        self._i_arbeid = 0
+        self._jobber: Dict[str, Jobb] = {}
+        self._fullførte = 0
+        self._avviste = 0
+
+    @property
+    def kapasitet(self) -> int:
+        return self.arbeidere + self.maks_ventende
+
+    def start(self) -> "JobbKo":
+        """Starter arbeiderne. Kalles én gang, fra main eller oppsettet av appen."""
+        if self._executor is not None:
+            return self
+        if self.modus == "prosess":
+            self._startkø = multiprocessing.SimpleQueue()
+            self._executor = ProcessPoolExecutor(max_workers=self.arbeidere, initializer=_start_arbeider,
+                                                 initargs=(self._startkø, self._initializer, self._initargs))
+            self._executor.submit(_ingenting).result() # Arbeiderne forkes nå, før lyttetråden finnes
+            threading.Thread(target=self._lytt, args=(self._startkø,), name="jobbko-start", daemon=True).start()
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.arbeidere, thread_name_prefix="jobbko",
+                                                initializer=self._initializer, initargs=self._initargs)
+        return self
+
+    def _lytt(self, startkø: Any) -> None:
+        while True:
+            jobb_id = startkø.get()
+            if jobb_id is None:
+                return
+            self._meld_start(jobb_id)
+
+    def _meld_start(self, jobb_id: str) -> None:
+        with self._lås:
+            jobb = self._jobber.get(jobb_id)
+            if jobb is not None:
+                jobb.startet = True
+
+    def _reserver(self, antall: int) -> None:
+        with self._lås:
+            if self._i_arbeid + antall > self.kapasitet:
+                self._avviste += antall
+                raise KoFullError(f"Køen er full ({self._i_arbeid}/{self.kapasitet})")
+            self._i_arbeid += antall
+
+    def _frigi(self, antall: int) -> None:
+        # Reserverte plasser som aldri ble til jobber (submit feilet)
+        with self._lås:
+            self._i_arbeid -= antall
+
+    def _jobb_ferdig(self, jobb: Jobb) -> None:
+        with self._lås:
+            self._i_arbeid -= 1
+            self._fullførte += 1
+        jobb.ferdig = time.time()
+
+    def _rydd(self) -> None:
+        grense = time.time() - self.behold_sekunder
+        with self._lås:
+            utløpt = [j_id for j_id, j in self._jobber.items() if j.ferdig is not None and j.ferdig < grense]
+            for j_id in utløpt:
+                del self._jobber[j_id]
+
+    def _start(self, etikett: str, fn: Callable, args: tuple) -> Jobb:
+        if self._executor is None:
+            raise RuntimeError("JobbKo er ikke startet (kall start())")
+        jobb_id = uuid.uuid4().hex
+        meld = self._meld_start if self.modus == "tråd" else None
+        # Registrer under låsen, så en startmelding ikke kan komme før jobben finnes
+        with self._lås:
+            future = metrikker.send_inn(self._executor, _kjør_jobb, jobb_id, meld, fn, args)
+            jobb = Jobb(id=jobb_id, etikett=etikett, future=future)
+            self._jobber[jobb.id] = jobb
+        future.add_done_callback(lambda _f: self._jobb_ferdig(jobb))
+        return jobb
+
+    def send_inn(self, fn: Callable, *args: Any, etikett: str = "") -> Jobb:
+        """
+        Legger én jobb i køen.
+
+        Raises:
+            KoFullError: Hvis køen er full.
+        """
+        self._rydd()
+        self._reserver(1)
+        try:
+            return self._start(etikett, fn, args)
+        except BaseException:
+            self._frigi(1) # F.eks. BrokenProcessPool; plassen må ikke gå tapt
+            raise
+
+    def send_inn_mange(self, fn: Callable, args_liste: List[tuple], etikett: str = "") -> List[Jobb]:
+        """
+        Legger flere jobber i køen under én reservasjon (alt eller ingenting).
+
+        Raises:
+            KoFullError: Hvis det ikke er plass til alle jobbene.
+        """
+        self._rydd()
+        self._reserver(len(args_liste))
+        jobber: List[Jobb] = []
+        try:
+            for args in args_liste:
+                jobber.append(self._start(etikett, fn, args))
+        except BaseException:
+            self._frigi(len(args_liste) - len(jobber)) # De startede frigis når de blir ferdige
+            raise
+        return jobber
+
+    def samle(self, jobber: List[Jobb], kombiner: Callable[[List[Any]], Any], etikett: str = "") -> Jobb:
+        """
+        Én jobb som blir ferdig når alle jobbene er ferdige, med kombiner(resultatene)
+        som resultat, f.eks. for å gi klienten én jobb-ID for mange bilder. Bruker
+        ingen arbeider eller køplass; delene har allerede sin.
+        """
+        future: Future = Future()
+        jobb = Jobb(id=uuid.uuid4().hex, etikett=etikett, future=future, deler=list(jobber))
+        gjenstår = [len(jobber)]
+        lås = threading.Lock()
+
+        def del_ferdig(_f: Optional[Future]) -> None:
+            with lås:
+                gjenstår[0] -= 1
+                if gjenstår[0] > 0:
+                    return
+            try:
+                future.set_result(kombiner([j.future.result() for j in jobber]))
+            except BaseException as e:
+                future.set_exception(e)
+            jobb.ferdig = time.time()
+
+        with self._lås:
+            self._jobber[jobb.id] = jobb
+        if not jobber:
+            gjenstår[0] = 1
+            del_ferdig(None)
+        for j in jobber:
+            j.future.add_done_callback(del_ferdig)
+        return jobb
+
+    def hent(self, jobb_id: str) -> Optional[Jobb]:
+        with self._lås:
+            return self._jobber.get(jobb_id)
+
+    def glem(self, jobb_id: str) -> None:
+        """Fjerner en jobb fra oversikten (for synkrone kall som allerede har hentet resultatet)."""
+        with self._lås:
+            self._jobber.pop(jobb_id, None)
+
+    def status(self) -> Dict[str, Any]:
+        """Kødybde og utnyttelse, til bruk i /health."""
+        with self._lås:
+            i_arbeid = self._i_arbeid
+            fullførte = self._fullførte
+            avviste = self._avviste
+        aktive = min(i_arbeid, self.arbeidere)
+        return {
+            "modus": self.modus,
+            "arbeidere": self.arbeidere,
+            "aktive_arbeidere": aktive,
+            "utnyttelse": aktive / self.arbeidere,
+            "kodybde": max(0, i_arbeid - self.arbeidere),
+            "maks_kodybde": self.maks_ventende,
+            "fullforte_jobber": fullførte,
+            "avviste_jobber": avviste
+        }
+
+    def avslutt(self, vent: bool = True) -> None:
+        if self._executor is None:
+            return
+        self._executor.shutdown(wait=vent)
+        if self._startkø is not None:
+            self._startkø.put(None) # Stopper lyttetråden
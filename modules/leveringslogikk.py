@@ -1,5 +1,11 @@
-from typing import List, Dict, Any
-from modules.datamodel import Postkasse, Pakke, KapasitetKlasse
+import csv
+import json
+import itertools
+import numpy as np
+from typing import List, Dict, Any, Tuple, Iterable, Iterator, Optional, Union
+from modules.datamodel import Postkasse, Pakke, KapasitetKlasse, VolumKlasse, Utfall
+from modules.register import PostkasseRegister
+from modules.beslutningslogg import BeslutningsloggSkriver
 
 def beslutning_levering(postkasse: Postkasse, pakke: Pakke) -> bool:
     """
@@ -71,3 +77,309 @@ def simuler_rute(pakker: List[Pakke], postkasser: List[Postkasse]) -> Dict[str,
         resultat["logg"].append(beslutning)
         
     return resultat
+
+# --- Batch-motor (kolonnebasert) ---
+
+# Kapasitetskode for ukjent mottaker. Mindre enn alle volumkoder, så sammenligningen
+# sender automatisk slike pakker til hentekontor.
+UKJENT_KAPASITET = 0
+
+def kod_pakker_og_postkasser(pakker: List[Pakke], postkasser: List[Postkasse]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Konverterer dataklasse-lister til kolonneformatet som simuler_rute_batch forventer.
+    
+    Args:
+        pakker: Liste med pakker.
+        postkasser: Liste med alle kjente postkasser.
+        
+    Returns:
+        (volum_koder, mottaker_idx, kapasitet_koder). mottaker_idx er radnummer i
+        kapasitet_koder, eller -1 hvis mottakeren ikke finnes.
+    """
+    pk_rad = {pk.id: i for i, pk in enumerate(postkasser)}
+    kapasitet_koder = np.fromiter((pk.kapasitet_klasse.value for pk in postkasser), dtype=np.uint8, count=len(postkasser))
+    volum_koder = np.fromiter((p.volum_klasse.value for p in pakker), dtype=np.uint8, count=len(pakker))
+    mottaker_idx = np.fromiter((pk_rad.get(p.mottaker_postkasse_id, -1) for p in pakker), dtype=np.int64, count=len(pakker))
+    return volum_koder, mottaker_idx, kapasitet_koder
+
+def simuler_rute_batch(volum_koder: np.ndarray, mottaker_idx: np.ndarray, kapasitet_koder: np.ndarray, med_utfall: bool = False) -> Dict[str, Any]:
+    """
+    Vektorisert variant av simuler_rute for store pakkevolumer.
+    Samme regel som beslutning_levering, men alle beslutninger tas med ett
+    oppslag og én sammenligning over hele pakkekolonnen.
+    
+    Args:
+        volum_koder: VolumKlasse-verdier per pakke (1-3).
+        mottaker_idx: Radnummer i kapasitet_koder per pakke, -1 for ukjent mottaker.
+        kapasitet_koder: KapasitetKlasse-verdier per postkasse (1-3).
+        med_utfall: Returner også en uint8-kolonne med Utfall-koder per pakke.
+        
+    Returns:
+        Dict med samme tellere som simuler_rute, pluss 'ukjent_postkasse'
+        og 'utfall' (None hvis med_utfall er False).
+    """
+    volum_koder = np.asarray(volum_koder)
+    mottaker_idx = np.asarray(mottaker_idx)
+    if mottaker_idx.dtype.kind not in "iu":
+        mottaker_idx = mottaker_idx.astype(np.int64)
+    
+    # Sentinel-rad sist i oppslagstabellen: indeks -1 treffer UKJENT_KAPASITET
+    oppslag = np.append(np.asarray(kapasitet_koder, dtype=np.uint8), np.uint8(UKJENT_KAPASITET))
+    ugyldig = (mottaker_idx < -1) | (mottaker_idx >= len(oppslag) - 1)
+    if ugyldig.any():
+        mottaker_idx = np.where(ugyldig, -1, mottaker_idx)
+    
+    kapasitet = oppslag[mottaker_idx]
+    levert = kapasitet >= volum_koder
+    
+    antall = int(len(volum_koder))
+    direkte = int(np.count_nonzero(levert))
+    ukjent = int(np.count_nonzero(kapasitet == UKJENT_KAPASITET))
+    
+    utfall = None
+    if med_utfall:
+        utfall = np.full(antall, Utfall.HENTEKONTOR.value, dtype=np.uint8)
+        utfall[levert] = Utfall.LEVERT_I_POSTKASSE.value
+        utfall[kapasitet == UKJENT_KAPASITET] = Utfall.UKJENT_POSTKASSE.value
+    
+    return {
+        "antall_pakker": antall,
+        "direkte_i_postkasse": direkte,
+        "til_hentekontor": antall - direkte, # Inkluderer ukjente mottakere, som simuler_rute
+        "ukjent_postkasse": ukjent,
+        "utfall": utfall
+    }
+
+def simuler_rute_mot_register(pakker: List[Pakke], register: PostkasseRegister, med_utfall: bool = False) -> Dict[str, Any]:
+    """
+    Som simuler_rute, men slår opp mottakere i et PostkasseRegister i stedet
+    for å bygge et oppslagsverk fra en liste postkasser ved hvert kall.
+    
+    Returns:
+        Samme dict som simuler_rute_batch.
+    """
+    volum_koder = np.fromiter((p.volum_klasse.value for p in pakker), dtype=np.uint8, count=len(pakker))
+    mottaker_idx = register.indekser(p.mottaker_postkasse_id for p in pakker)
+    return simuler_rute_batch(volum_koder, mottaker_idx, register.kapasitet, med_utfall=med_utfall)
+
+# --- Strømming (konstant minnebruk) ---
+
+LOGG_KOLONNER = ["pakke_id", "volum", "destinasjon_pk", "utfall", "pk_kapasitet"]
+
+def les_pakker_csv(sti: str) -> Iterator[Pakke]:
+    """
+    Leser pakker lazy fra et CSV-manifest med kolonnene
+    id, volum_klasse (S/M/L) og mottaker_postkasse_id.
+    """
+    with open(sti, newline="") as f:
+        for rad in csv.DictReader(f):
+            yield Pakke(id=rad["id"], volum_klasse=VolumKlasse[rad["volum_klasse"]], mottaker_postkasse_id=rad["mottaker_postkasse_id"])
+
+def les_pakker_jsonl(sti: str) -> Iterator[Pakke]:
+    """
+    Leser pakker lazy fra et JSONL-manifest (ett objekt per linje, samme felt som les_pakker_csv).
+    """
+    with open(sti) as f:
+        for linje in f:
+            if not linje.strip():
+                continue
+            rad = json.loads(linje)
+            yield Pakke(id=rad["id"], volum_klasse=VolumKlasse[rad["volum_klasse"]], mottaker_postkasse_id=rad["mottaker_postkasse_id"])
+
+def _kapasitet_navn(koder: np.ndarray) -> np.ndarray:
+    # Kode 0 (ukjent mottaker) vises som "N/A", som i simuler_rute
+    navn = np.array(["N/A"] + [k.name for k in KapasitetKlasse], dtype=object)
+    return navn[koder]
+
+def simuler_rute_strom(pakker: Iterable[Pakke], postkasser: Union[List[Postkasse], PostkasseRegister],
+                       chunk_storrelse: int = 100_000, logg_fil: Optional[str] = None, utdrag: int = 10,
+                       logg_katalog: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Strømmende variant av simuler_rute for store pakkevolumer.
+    Pakkene leses i biter av chunk_storrelse og beregnes med simuler_rute_batch.
+    Kun løpende tellere holdes i minnet; beslutningsloggen skrives bit for bit til logg_fil (CSV)
+    og/eller logg_katalog (binært kolonneformat, se modules.beslutningslogg).
+    
+    Args:
+        pakker: Vilkårlig iterator av pakker, f.eks. fra les_pakker_csv.
+        postkasser: Liste med postkasser eller et PostkasseRegister.
+        chunk_storrelse: Antall pakker per bit.
+        logg_fil: CSV-fil for beslutningsloggen. None = ingen logg.
+        utdrag: Antall beslutninger som beholdes i minnet for rapport.
+        logg_katalog: Katalog for binær beslutningslogg. None = ingen.
+        
+    Returns:
+        Dict med samme tellere som simuler_rute_batch, pluss 'logg_fil', 'logg_katalog' og
+        'logg_utdrag' (de første beslutningene, samme format som simuler_rute sin logg).
+    """
+    register = postkasser if isinstance(postkasser, PostkasseRegister) else PostkasseRegister.fra_postkasser(postkasser)
+    kapasitet_koder = register.kapasitet
+    
+    resultat = {
+        "antall_pakker": 0,
+        "direkte_i_postkasse": 0,
+        "til_hentekontor": 0,
+        "ukjent_postkasse": 0,
+        "logg_fil": logg_fil,
+        "logg_katalog": logg_katalog,
+        "logg_utdrag": []
+    }
+    
+    logg_f = open(logg_fil, "w", newline="") if logg_fil else None
+    binær = None
+    if logg_katalog:
+        binær = BeslutningsloggSkriver(logg_katalog, register.postkasse_ids(), register.oppgang, register.oppgang_ids)
+    try:
+        skriver = None
+        if logg_f:
+            skriver = csv.writer(logg_f)
+            skriver.writerow(LOGG_KOLONNER)
+        
+        iterator = iter(pakker)
+        while True:
+            chunk = list(itertools.islice(iterator, chunk_storrelse))
+            if not chunk:
+                break
+            
+            volum_koder = np.fromiter((p.volum_klasse.value for p in chunk), dtype=np.uint8, count=len(chunk))
+            mottaker_idx = register.indekser(p.mottaker_postkasse_id for p in chunk)
+            trenger_logg = skriver is not None or binær is not None or len(resultat["logg_utdrag"]) < utdrag
+            res = simuler_rute_batch(volum_koder, mottaker_idx, kapasitet_koder, med_utfall=trenger_logg)
+            
+            for nøkkel in ("antall_pakker", "direkte_i_postkasse", "til_hentekontor", "ukjent_postkasse"):
+                resultat[nøkkel] += res[nøkkel]
+            
+            if trenger_logg:
+                kjent = mottaker_idx >= 0
+                kap_koder = np.zeros(len(chunk), dtype=np.uint8)
+                kap_koder[kjent] = kapasitet_koder[mottaker_idx[kjent]]
+                if binær is not None:
+                    binær.skriv(res["utfall"], volum_koder, kap_koder, mottaker_idx,
+                                pakke_ids=(p.id for p in chunk),
+                                mottaker_ids=[p.mottaker_postkasse_id for p in chunk] if res["ukjent_postkasse"] else None)
+                if skriver is None and len(resultat["logg_utdrag"]) >= utdrag:
+                    continue
+                utfall_navn = np.array([u.name for u in Utfall], dtype=object)[res["utfall"]]
+                rader = zip(
+                    (p.id for p in chunk),
+                    (p.volum_klasse.name for p in chunk),
+                    (p.mottaker_postkasse_id for p in chunk),
+                    utfall_navn,
+                    _kapasitet_navn(kap_koder)
+                )
+                if skriver is not None:
+                    rader = list(rader)
+                    skriver.writerows(rader)
+                for rad in itertools.islice(rader, utdrag - len(resultat["logg_utdrag"])):
+                    resultat["logg_utdrag"].append(dict(zip(LOGG_KOLONNER, rad)))
+    finally:
+        if logg_f:
+            logg_f.close()
+        if binær is not None:
+            binær.lukk()
+    
+    return resultat
+
+# --- Inkrementell simulering ---
+
+class InkrementellSimulering:
+    """
+    Simuleringstilstand som kan oppdateres når postkasser skannes på nytt.
+    
+    Ventende pakker indekseres på mottaker_postkasse_id, med et antall per
+    volumklasse for hver postkasse. Når noen postkasser får ny kapasitet,
+    beregnes bare deres pakker på nytt, og totalene justeres med differansen.
+    Kostnaden skalerer dermed med antall endrede postkasser, ikke med antall pakker.
+    """
+    
+    def __init__(self, pakker: Iterable[Pakke], postkasser: Iterable[Postkasse]):
+        self._kapasitet: Dict[str, int] = {pk.id: pk.kapasitet_klasse.value for pk in postkasser}
+        self._pakker: Dict[str, List[Pakke]] = {}
+        self._telling: Dict[str, List[int]] = {} # {pk_id: antall pakker per volumkode (indeks 1-3)}
+        self.antall_pakker = 0
+        self.direkte_i_postkasse = 0
+        self.ukjent_postkasse = 0
+        self.legg_til_pakker(pakker)
+    
+    @property
+    def til_hentekontor(self) -> int:
+        return self.antall_pakker - self.direkte_i_postkasse
+    
+    def _direkte(self, pk_id: str) -> int:
+        # Antall pakker til pk_id som får plass med gjeldende kapasitet (0 = ukjent postkasse)
+        telling = self._telling.get(pk_id)
+        if telling is None:
+            return 0
+        return sum(telling[1:self._kapasitet.get(pk_id, 0) + 1])
+    
+    def legg_til_pakker(self, pakker: Iterable[Pakke]) -> None:
+        """Registrerer nye ventende pakker og oppdaterer totalene."""
+        for p in pakker:
+            pk_id = p.mottaker_postkasse_id
+            telling = self._telling.get(pk_id)
+            if telling is None:
+                telling = self._telling[pk_id] = [0, 0, 0, 0]
+                self._pakker[pk_id] = []
+            telling[p.volum_klasse.value] += 1
+            self._pakker[pk_id].append(p)
+            
+            self.antall_pakker += 1
+            kap = self._kapasitet.get(pk_id, 0)
+            if kap == 0:
+                self.ukjent_postkasse += 1
+            elif kap >= p.volum_klasse.value:
+                self.direkte_i_postkasse += 1
+    
+    def pakker_for(self, pk_id: str) -> List[Pakke]:
+        """Ventende pakker til en gitt postkasse."""
+        return list(self._pakker.get(pk_id, []))
+    
+    def oppdater_kapasitet(self, endringer: Dict[str, KapasitetKlasse]) -> Dict[str, int]:
+        """
+        Oppdaterer kapasiteten til noen postkasser (nye postkasser legges til).
+        
+        Args:
+            endringer: {postkasse_id: ny KapasitetKlasse}
+            
+        Returns:
+            Endringen i totalene, pluss hvor mange pakker som ble re-evaluert.
+        """
+        delta_direkte = 0
+        delta_ukjent = 0
+        reevaluerte = 0
+        
+        for pk_id, kap in endringer.items():
+            telling = self._telling.get(pk_id)
+            antall = sum(telling) if telling else 0
+            for_direkte = self._direkte(pk_id)
+            var_ukjent = pk_id not in self._kapasitet
+            
+            self._kapasitet[pk_id] = kap.value
+            
+            delta_direkte += self._direkte(pk_id) - for_direkte
+            if var_ukjent:
+                delta_ukjent -= antall
+            reevaluerte += antall
+        
+        self.direkte_i_postkasse += delta_direkte
+        self.ukjent_postkasse += delta_ukjent
+        return {
+            "direkte_i_postkasse": delta_direkte,
+            "til_hentekontor": -delta_direkte,
+            "ukjent_postkasse": delta_ukjent,
+            "endrede_postkasser": len(endringer),
+            "reevaluerte_pakker": reevaluerte
+        }
+    
+    def oppdater_postkasser(self, postkasser: Iterable[Postkasse]) -> Dict[str, int]:
+        """Som oppdater_kapasitet, men tar Postkasse-objekter (f.eks. fra en ny skanning)."""
+        return self.oppdater_kapasitet({pk.id: pk.kapasitet_klasse for pk in postkasser})
+    
+    def resultat(self) -> Dict[str, Any]:
+        """Gjeldende totaler, med samme nøkler som simuler_rute (uten logg)."""
+        return {
+            "antall_pakker": self.antall_pakker,
+            "direkte_i_postkasse": self.direkte_i_postkasse,
+            "til_hentekontor": self.til_hentekontor,
+            "ukjent_postkasse": self.ukjent_postkasse
+        }
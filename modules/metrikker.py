@@ -0,0 +1,211 @@
+import time
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+class Metrikker:
+    """
+    Tidtakere og tellere for bildeanalysen.
+
+    Tider lagres per steg som (antall, sum, maks) i sekunder, tellere som heltall.
+    Registeret er trådsikkert, og et øyeblikksbilde fra en annen prosess kan
+    flettes inn med flett().
+    """
+
+    def __init__(self):
+        self.aktiv = False
+        self._lås = threading.Lock()
+        self._tider: Dict[str, List[float]] = {} # {steg: [antall, sum, maks]}
+        self._tellere: Dict[str, int] = {}
+
+    def registrer(self, tider: List[Tuple[str, float]], tellere: Optional[Dict[str, int]] = None) -> None:
+        """Legger inn flere målinger under én lås."""
+        with self._lås:
+            for steg, sekunder in tider:
+                t = self._tider.get(steg)
+                if t is None:
+                    self._tider[steg] = [1, sekunder, sekunder]
+                else:
+                    t[0] += 1
+                    t[1] += sekunder
+                    if sekunder > t[2]: t[2] = sekunder
+            for navn, n in (tellere or {}).items():
+                self._tellere[navn] = self._tellere.get(navn, 0) + n
+
+    def oyeblikksbilde(self) -> Dict[str, Any]:
+        with self._lås:
+            return {
+                "tider": {steg: list(t) for steg, t in self._tider.items()},
+                "tellere": dict(self._tellere)
+            }
+
+    def flett(self, bilde: Dict[str, Any]) -> None:
+        """Fletter inn et øyeblikksbilde (f.eks. fra en arbeidsprosess)."""
+        with self._lås:
+            for steg, (antall, sum_, maks) in bilde["tider"].items():
+                t = self._tider.setdefault(steg, [0, 0.0, 0.0])
+                t[0] += antall
+                t[1] += sum_
+                t[2] = max(t[2], maks)
+            for navn, n in bilde["tellere"].items():
+                self._tellere[navn] = self._tellere.get(navn, 0) + n
+
+    def nullstill(self) -> None:
+        with self._lås:
+            self._tider.clear()
+            self._tellere.clear()
+
+class Stoppeklokke:
+    """
+    Tar tiden på stegene i ett kall. runde(steg) lagrer tiden siden forrige runde;
+    ferdig() skriver alt til registeret på en gang, så låsen tas én gang per kall.
+    """
+
+    def __init__(self, register: Metrikker):
+        self._register = register
+        self._tider: List[Tuple[str, float]] = []
+        self._tellere: Dict[str, int] = {}
+        self._start = self._forrige = time.perf_counter()
+
+    def runde(self, steg: str) -> None:
+        naa = time.perf_counter()
+        self._tider.append((steg, naa - self._forrige))
+        self._forrige = naa
+
+    def tell(self, navn: str, n: int = 1) -> None:
+        self._tellere[navn] = self._tellere.get(navn, 0) + n
+
+    def ferdig(self, steg: str = "totalt") -> None:
+        self._tider.append((steg, time.perf_counter() - self._start))
+        self._register.registrer(self._tider, self._tellere)
+
+class _AvslåttKlokke:
+    # Brukes når metrikker er slått av: alle kall er tomme
+    def runde(self, steg: str) -> None:
+        pass
+
+    def tell(self, navn: str, n: int = 1) -> None:
+        pass
+
+    def ferdig(self, steg: str = "totalt") -> None:
+        pass
+
+INGEN_KLOKKE = _AvslåttKlokke()
+
+# Prosessens felles register
+METRIKKER = Metrikker()
+
+def aktiver(aktiv: bool = True) -> None:
+    METRIKKER.aktiv = aktiv
+
+def er_aktiv() -> bool:
+    return METRIKKER.aktiv
+
+def stoppeklokke() -> Any:
+    """Ny Stoppeklokke, eller en tom klokke som ikke koster noe når metrikker er av."""
+    return Stoppeklokke(METRIKKER) if METRIKKER.aktiv else INGEN_KLOKKE
+
+# --- Arbeidsprosesser ---
+
+def _kjør_målt(fn: Callable, args: tuple) -> Tuple[Any, Dict[str, Any]]:
+    # Kjøres i arbeidsprosessen: mål bare denne jobben og send målingene tilbake
+    METRIKKER.aktiv = True
+    METRIKKER.nullstill()
+    resultat = fn(*args)
+    return resultat, METRIKKER.oyeblikksbilde()
+
+class _MåltFuture(Future):
+    """
+    Resultatet av en målt jobb. Venter/kjører speiler den indre jobben i
+    prosesspoolen; resultatet settes først når målingene er flettet inn.
+    """
+
+    def __init__(self, indre: Future):
+        super().__init__()
+        self._indre = indre
+        indre.add_done_callback(self._indre_ferdig)
+
+    def running(self) -> bool:
+        return self._indre.running() and not self.done()
+
+    def cancel(self) -> bool:
+        # Den indre jobben avgjør; avbrytes den, følger denne etter i _indre_ferdig
+        return self._indre.cancel()
+
+    def _indre_ferdig(self, f: Future) -> None:
+        if f.cancelled():
+            super().cancel()
+            return
+        try:
+            resultat, bilde = f.result()
+        except BaseException as e:
+            self.set_exception(e)
+            return
+        METRIKKER.flett(bilde)
+        self.set_result(resultat)
+
+def send_inn(executor: Executor, fn: Callable, *args: Any) -> Future:
+    """
+    Som executor.submit, men målinger gjort i en arbeidsprosess flettes inn
+    i denne prosessens register når jobben er ferdig. Tråder deler registeret
+    allerede, så da er dette en vanlig submit.
+    """
+    if not METRIKKER.aktiv or not isinstance(executor, ProcessPoolExecutor):
+        return executor.submit(fn, *args)
+    return _MåltFuture(executor.submit(_kjør_målt, fn, args))
+
+# --- Utdata ---
+
+_HJELP = {
+    "bilder": "Analyserte bilder",
+    "konturer": "Konturer funnet",
+    "forkastet_stoy": "Konturer forkastet som støy",
+    "postkasser": "Postkasser funnet",
+    "finmalinger": "Bokser målt på nytt i full oppløsning",
+    "feil": "Bilder som ikke kunne analyseres"
+}
+
+def prometheus(prefiks: str = "pkasse", register: Optional[Metrikker] = None) -> str:
+    """Registeret i Prometheus tekstformat."""
+    bilde = (register or METRIKKER).oyeblikksbilde()
+    linjer = [
+        f"# HELP {prefiks}_steg_sekunder Tid brukt per steg i bildeanalysen",
+        f"# TYPE {prefiks}_steg_sekunder summary"
+    ]
+    for steg, (antall, sum_, _) in sorted(bilde["tider"].items()):
+        linjer.append(f'{prefiks}_steg_sekunder_sum{{steg="{steg}"}} {sum_:.6f}')
+        linjer.append(f'{prefiks}_steg_sekunder_count{{steg="{steg}"}} {antall}')
+    linjer.append(f"# HELP {prefiks}_steg_maks_sekunder Lengste enkeltmåling per steg")
+    linjer.append(f"# TYPE {prefiks}_steg_maks_sekunder gauge")
+    for steg, (_, _, maks) in sorted(bilde["tider"].items()):
+        linjer.append(f'{prefiks}_steg_maks_sekunder{{steg="{steg}"}} {maks:.6f}')
+    for navn, n in sorted(bilde["tellere"].items()):
+        linjer.append(f"# HELP {prefiks}_{navn}_total {_HJELP.get(navn, navn)}")
+        linjer.append(f"# TYPE {prefiks}_{navn}_total counter")
+        linjer.append(f"{prefiks}_{navn}_total {n}")
+    return "\n".join(linjer) + "\n"
+
+def sammendrag(register: Optional[Metrikker] = None) -> Tuple[List[List[Any]], Dict[str, Any]]:
+    """
+    Tabellrader (steg, antall, snitt ms, maks ms, andel) og nøkkeltall for utskrift.
+    Andelen er i forhold til stegets "totalt".
+    """
+    bilde = (register or METRIKKER).oyeblikksbilde()
+    tider, tellere = bilde["tider"], bilde["tellere"]
+    totalt = tider.get("totalt", [0, 0.0, 0.0])[1]
+
+    rader = []
+    for steg, (antall, sum_, maks) in tider.items():
+        andel = f"{sum_ / totalt * 100:.1f}%" if totalt and steg != "totalt" else ""
+        rader.append([steg, antall, sum_ / antall * 1000 if antall else 0.0, maks * 1000, andel])
+
+    bilder = tellere.get("bilder", 0)
+    nokkeltall = {
+        "bilder": bilder,
+        "bilder_per_sek": bilder / totalt if totalt else 0.0, # Per arbeider (ren analysetid)
+        "konturer_per_bilde": tellere.get("konturer", 0) / bilder if bilder else 0.0,
+        "forkastet_stoy": tellere.get("forkastet_stoy", 0),
+        "finmalinger": tellere.get("finmalinger", 0),
+        "feil": tellere.get("feil", 0)
+    }
+    return rader, nokkeltall
@@ -1,12 +1,20 @@
-from typing import Dict, Any
+import io
+import csv
+import sys
+import json
+import argparse
+import numpy as np
+from typing import Dict, Any, List, Tuple, Optional
 from tabulate import tabulate
+from modules.beslutningslogg import Beslutningslogg, UKJENT
+from modules.datamodel import Utfall
 
 def rapport(simuleringsresultat: Dict[str, Any]) -> None:
     """
     Genererer og printer en rapport basert på simuleringsresultatet.
     
     Args:
-        simuleringsresultat: Output fra simuler_rute funksjonen.
+        simuleringsresultat: Output fra simuler_rute eller simuler_rute_strom.
     """
     print("\n" + "="*50)
     print("LEVERINGSRAPPORT")
@@ -26,7 +34,13 @@ def rapport(simuleringsresultat: Dict[str, Any]) -> None:
         
     print("\nDetaljert Logg (Siste 10 transaksjoner):")
     
-    logg_data = simuleringsresultat["logg"]
+    if "logg" in simuleringsresultat:
+        logg_data = simuleringsresultat["logg"]
+        antall_logget = len(logg_data)
+    else:
+        # Strømmende simulering (simuler_rute_strom): kun et utdrag er i minnet, resten ligger i logg_fil
+        logg_data = simuleringsresultat["logg_utdrag"]
+        antall_logget = total
     # Vis bare de siste 10 for å ikke spamme konsollen, men i ekte system ville vi logget alt til fil
     sample_logg = logg_data[:10] if len(logg_data) <= 10 else logg_data[:10] 
     
@@ -43,6 +57,171 @@ def rapport(simuleringsresultat: Dict[str, Any]) -> None:
     headers = ["Pakke ID", "Postkasse ID", "Pakke Volum", "PK Kapasitet", "Beslutning"]
     print(tabulate(tabell_data, headers=headers, tablefmt="simple"))
     
-    if len(logg_data) > 10:
-        print(f"... og {len(logg_data) - 10} flere.")
+    if antall_logget > 10:
+        print(f"... og {antall_logget - 10} flere.")
+    if simuleringsresultat.get("logg_fil"):
+        print(f"Full logg: {simuleringsresultat['logg_fil']}")
+    if simuleringsresultat.get("logg_katalog"):
+        print(f"Binær logg: {simuleringsresultat['logg_katalog']}")
     print("="*50 + "\n")
+
+def rapport_fra_logg(logg_katalog: str) -> None:
+    """
+    Lager rapporten på nytt fra en lagret binær beslutningslogg (se modules.beslutningslogg).
+    Loggen minnemappes, så bare tellerne og de første radene leses inn.
+    """
+    logg = Beslutningslogg.åpne(logg_katalog)
+    resultat = logg.tellinger()
+    resultat["logg_utdrag"] = list(logg.rader(0, 10))
+    resultat["logg_katalog"] = logg_katalog
+    rapport(resultat)
+
+# --- Aggregerte rapporter ---
+
+Tabell = Tuple[List[str], List[List[Any]]] # (kolonner, rader)
+
+def aggreger(logg: Beslutningslogg, chunk_storrelse: int = 4_000_000) -> Dict[str, Any]:
+    """
+    Teller utfall per oppgang og per volumklasse × kapasitetsklasse i ett pass
+    over en binær beslutningslogg. Kolonnene leses i biter med np.bincount, så
+    minnebruken er uavhengig av loggens lengde.
+    
+    Returns:
+        Dict med navnelister og tellematriser:
+            'per_oppgang': (oppganger + 1, utfall), siste rad er ukjent oppgang
+            'per_volum_kapasitet': (volumkoder, kapasitetskoder, utfall), indeksert på kodene
+    """
+    k = logg.kolonner
+    ordbok = logg.meta["ordboker"]
+    n_utfall = len(ordbok["utfall"])
+    n_volum = len(ordbok["volum"])
+    n_kap = len(ordbok["kapasitet"])
+    n_opp = len(logg.oppganger)
+    
+    # Postkasser uten kjent oppgang samles i en ekstra gruppe til slutt. Det siste
+    # elementet er for postkasse-kode -1 (mottaker ukjent og ikke logget), som
+    # ellers ville indeksert siste postkasse.
+    pk_gruppe = np.where(logg.postkasse_oppgang >= 0, logg.postkasse_oppgang, n_opp).astype(np.intp)
+    pk_gruppe = np.append(pk_gruppe, n_opp)
+    
+    per_oppgang = np.zeros((n_opp + 1) * n_utfall, dtype=np.int64)
+    per_vk = np.zeros(n_volum * n_kap * n_utfall, dtype=np.int64)
+    for start in range(0, len(logg), chunk_storrelse):
+        stopp = start + chunk_storrelse
+        utfall = k["utfall"][start:stopp].astype(np.intp)
+        gruppe = pk_gruppe[k["postkasse"][start:stopp]]
+        per_oppgang += np.bincount(gruppe * n_utfall + utfall, minlength=per_oppgang.size)
+        vk = (k["volum"][start:stopp].astype(np.intp) * n_kap + k["kapasitet"][start:stopp]) * n_utfall + utfall
+        per_vk += np.bincount(vk, minlength=per_vk.size)
+        
+    return {
+        "antall_pakker": len(logg),
+        "utfall": ordbok["utfall"],
+        "volum": ordbok["volum"],
+        "kapasitet": ordbok["kapasitet"],
+        "oppganger": logg.oppganger + [UKJENT],
+        "per_oppgang": per_oppgang.reshape(n_opp + 1, n_utfall),
+        "per_volum_kapasitet": per_vk.reshape(n_volum, n_kap, n_utfall)
+    }
+
+def _andel(del_: int, total: int) -> float:
+    return round(del_ / total * 100, 1) if total else 0.0
+
+def tabell_per_oppgang(agg: Dict[str, Any]) -> Tabell:
+    """Utfall per oppgang. Oppganger uten pakker utelates."""
+    m = agg["per_oppgang"]
+    totalt = m.sum(axis=1)
+    direkte = Utfall.LEVERT_I_POSTKASSE.value
+    rader = [
+        [agg["oppganger"][i], int(totalt[i])] + [int(n) for n in m[i]] + [_andel(int(m[i, direkte]), int(totalt[i]))]
+        for i in np.flatnonzero(totalt)
+    ]
+    return ["oppgang", "totalt"] + agg["utfall"] + ["andel_direkte"], rader
+
+def tabell_volum_kapasitet(agg: Dict[str, Any]) -> Tabell:
+    """Utfall per kombinasjon av pakkevolum og postkassekapasitet."""
+    m = agg["per_volum_kapasitet"]
+    totalt = m.sum(axis=2)
+    direkte = Utfall.LEVERT_I_POSTKASSE.value
+    rader = [
+        [agg["volum"][v], agg["kapasitet"][kap], int(totalt[v, kap])] + [int(n) for n in m[v, kap]]
+        + [_andel(int(m[v, kap, direkte]), int(totalt[v, kap]))]
+        for v, kap in zip(*np.nonzero(totalt))
+    ]
+    return ["volum", "kapasitet", "totalt"] + agg["utfall"] + ["andel_direkte"], rader
+
+def tabell_topp_hentekontor(agg: Dict[str, Any], topp: int = 10) -> Tabell:
+    """
+    De topp oppgangene som sender flest pakker til hentekontor. Pakker til ukjente
+    postkasser har ingen oppgang og vises bare i tabell_per_oppgang.
+    """
+    m = agg["per_oppgang"][:-1]
+    totalt = m.sum(axis=1)
+    hent = totalt - m[:, Utfall.LEVERT_I_POSTKASSE.value]
+    topp = min(topp, int(np.count_nonzero(hent)))
+    if topp == 0:
+        utvalg = np.zeros(0, dtype=np.intp)
+    else:
+        utvalg = np.argpartition(-hent, topp - 1)[:topp]
+        utvalg = utvalg[np.lexsort((utvalg, -hent[utvalg]))] # Flest først, likt antall i oppgang-rekkefølge
+    rader = [[agg["oppganger"][i], int(hent[i]), int(totalt[i]), _andel(int(hent[i]), int(totalt[i]))] for i in utvalg]
+    return ["oppgang", "til_hentekontor", "totalt", "andel_hentekontor"], rader
+
+def aggregat_tabeller(agg: Dict[str, Any], topp: int = 10) -> Dict[str, Tabell]:
+    return {
+        "per_oppgang": tabell_per_oppgang(agg),
+        "volum_kapasitet": tabell_volum_kapasitet(agg),
+        "topp_hentekontor": tabell_topp_hentekontor(agg, topp)
+    }
+
+def formater_aggregat(agg: Dict[str, Any], format: str = "tabell", topp: int = 10, tabeller: Optional[List[str]] = None) -> str:
+    """
+    Formaterer aggregatene som tekst.
+    
+    Args:
+        format: "tabell" (tabulate, for terminal), "json" eller "csv".
+            CSV er i langt format med tabellnavnet i første kolonne, så alle
+            tabellene får plass i én fil.
+        tabeller: Navn fra aggregat_tabeller som skal tas med. None = alle.
+    """
+    alle = aggregat_tabeller(agg, topp)
+    valgt = {navn: alle[navn] for navn in (tabeller or alle)}
+    
+    if format == "json":
+        return json.dumps({
+            "antall_pakker": agg["antall_pakker"],
+            **{navn: [dict(zip(kolonner, rad)) for rad in rader] for navn, (kolonner, rader) in valgt.items()}
+        }, ensure_ascii=False)
+        
+    if format == "csv":
+        ut = io.StringIO()
+        skriver = csv.writer(ut)
+        for navn, (kolonner, rader) in valgt.items():
+            skriver.writerow(["tabell"] + kolonner)
+            skriver.writerows([navn] + rad for rad in rader)
+        return ut.getvalue()
+        
+    deler = [f"Totalt antall pakker: {agg['antall_pakker']}"]
+    for navn, (kolonner, rader) in valgt.items():
+        deler.append(f"\n{navn.replace('_', ' ').upper()}\n" + tabulate(rader, headers=kolonner, tablefmt="simple"))
+    return "\n".join(deler)
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Aggregert rapport fra en binær beslutningslogg")
+    parser.add_argument("logg_katalog", help="Katalog skrevet av simuler_rute_strom(logg_katalog=...)")
+    parser.add_argument("--format", choices=["tabell", "json", "csv"], default="tabell")
+    parser.add_argument("--topp", type=int, default=10, help="Antall oppganger i topp-listen for hentekontor")
+    parser.add_argument("--tabeller", nargs="+", choices=["per_oppgang", "volum_kapasitet", "topp_hentekontor"])
+    parser.add_argument("--ut", help="Skriv til fil i stedet for stdout")
+    args = parser.parse_args(argv)
+    
+    tekst = formater_aggregat(aggreger(Beslutningslogg.åpne(args.logg_katalog)), args.format, args.topp, args.tabeller)
+    if args.ut:
+        with open(args.ut, "w", newline="") as f:
+            f.write(tekst)
+    else:
+        sys.stdout.write(tekst + ("" if tekst.endswith("\n") else "\n"))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,359 @@
+import os
+import json
+import time
+import shutil
+import logging
+import numpy as np
+from typing import List, Dict, Any, Callable, Iterable, Optional, Union
+from datetime import datetime
+from modules.datamodel import Postkasse, KapasitetKlasse
+
+logger = logging.getLogger(__name__)
+
+Tidspunkt = Union[datetime, int, float, None]
+
+def _til_epoch(tidspunkt: Tidspunkt) -> int:
+    """Konverterer datetime/epoch (eller None = nå) til epoch-sekunder."""
+    if tidspunkt is None:
+        return int(datetime.now().timestamp())
+    if isinstance(tidspunkt, datetime):
+        return int(tidspunkt.timestamp())
+    return int(tidspunkt)
+
+class PostkasseRegister:
+    """
+    Kolonnebasert register over postkasser.
+
+    Hver postkasse er en rad. ID-en internes i en {id: rad}-indeks, mens
+    selve tilstanden ligger i NumPy-kolonner:
+        kapasitet        uint8  KapasitetKlasse-verdi
+        sist_verifisert  int64  Epoch-sekunder
+        oppgang          int32  Fremmednøkkel til oppgang-tabellen
+
+    Registeret kan lagres til en katalog og åpnes igjen med minnemapping,
+    slik at flere arbeidsprosesser kan dele samme register uten kopiering.
+    ID-indeksen lagres også, som sorterte ID-er med radnummer, så et
+    minnemappet register slår opp med binærsøk uten å bygge en dict.
+    """
+
+    def __init__(self, start_kapasitet: int = 1024):
+        self._n = 0
+        self._ids: Optional[List[str]] = []
+        self._id_tabell: Optional[np.ndarray] = None # Brukes når registeret er minnemappet
+        self._indeks: Optional[Dict[str, int]] = {}
+        self._id_sortert: Optional[np.ndarray] = None # Lagret indeks: sorterte ID-er ...
+        self._id_rad: Optional[np.ndarray] = None     # ... og radnummeret til hver
+        self._oppgang_ids: List[str] = []
+        self._oppgang_indeks: Dict[str, int] = {}
+
+        start_kapasitet = max(start_kapasitet, 1)
+        self._kapasitet = np.zeros(start_kapasitet, dtype=np.uint8)
+        self._sist_verifisert = np.zeros(start_kapasitet, dtype=np.int64)
+        self._oppgang = np.zeros(start_kapasitet, dtype=np.int32)
+        self._skrivbar = True
+
+    # --- Kolonner (kun de brukte radene) ---
+
+    @property
+    def kapasitet(self) -> np.ndarray:
+        return self._kapasitet[:self._n]
+
+    @property
+    def sist_verifisert(self) -> np.ndarray:
+        return self._sist_verifisert[:self._n]
+
+    @property
+    def oppgang(self) -> np.ndarray:
+        return self._oppgang[:self._n]
+
+    @property
+    def oppgang_ids(self) -> List[str]:
+        return list(self._oppgang_ids)
+
+    def __len__(self) -> int:
+        return self._n
+
+    def __contains__(self, pk_id: str) -> bool:
+        return self.rad(pk_id) >= 0
+
+    # --- Oppslag ---
+
+    def _sikre_indeks(self) -> Dict[str, int]:
+        # Ved minnemappet lasting bygges indeksen først ved første oppslag
+        if self._indeks is None:
+            self._indeks = {self._id_ved(i): i for i in range(self._n)}
+        return self._indeks
+
+    def _id_ved(self, rad: int) -> str:
+        if self._ids is not None:
+            return self._ids[rad]
+        return self._id_tabell[rad].decode("utf-8")
+
+    def _søk(self, pk_ids: List[str]) -> np.ndarray:
+        # Binærsøk i den lagrede indeksen (minnemappet, delt mellom prosessene)
+        if len(self._id_sortert) == 0 or not pk_ids:
+            return np.full(len(pk_ids), -1, dtype=np.int64)
+        nøkler = np.array([pk_id.encode("utf-8") for pk_id in pk_ids], dtype=bytes)
+        pos = np.minimum(np.searchsorted(self._id_sortert, nøkler), len(self._id_sortert) - 1)
+        return np.where(self._id_sortert[pos] == nøkler, self._id_rad[pos], -1).astype(np.int64)
+
+    def rad(self, pk_id: str) -> int:
+        """Radnummer for en postkasse-ID, eller -1 hvis den er ukjent. O(1), O(log n) minnemappet."""
+        if self._indeks is None and self._id_sortert is not None:
+            return int(self._søk([pk_id])[0])
+        return self._sikre_indeks().get(pk_id, -1)
+
+    def indekser(self, pk_ids: Iterable[str]) -> np.ndarray:
+        """Radnummer for mange ID-er på en gang (-1 for ukjente)."""
+        if self._indeks is None and self._id_sortert is not None:
+            return self._søk(list(pk_ids))
+        indeks = self._sikre_indeks()
+        return np.fromiter((indeks.get(pk_id, -1) for pk_id in pk_ids), dtype=np.int64)
+
+    def hent(self, pk_id: str) -> Optional[Postkasse]:
+        """Materialiserer én rad som et Postkasse-objekt."""
+        r = self.rad(pk_id)
+        if r < 0:
+            return None
+        return Postkasse(
+            id=pk_id,
+            oppgang_id=self._oppgang_ids[self._oppgang[r]],
+            kapasitet_klasse=KapasitetKlasse(int(self._kapasitet[r])),
+            sist_verifisert=datetime.fromtimestamp(int(self._sist_verifisert[r]))
+        )
+
+    def postkasse_ids(self) -> List[str]:
+        return [self._id_ved(i) for i in range(self._n)]
+
+    # --- Skriving ---
+
+    def _sikre_skrivbar(self) -> None:
+        # Et minnemappet register er skrivebeskyttet; kopier til minnet ved første skriving
+        if self._skrivbar:
+            return
+        self._ids = self.postkasse_ids()
+        self._id_tabell = None
+        self._id_sortert = self._id_rad = None
+        self._sikre_indeks()
+        self._kapasitet = np.array(self._kapasitet)
+        self._sist_verifisert = np.array(self._sist_verifisert)
+        self._oppgang = np.array(self._oppgang)
+        self._skrivbar = True
+
+    def _sikre_plass(self, n_nye: int) -> None:
+        behov = self._n + n_nye
+        if behov <= len(self._kapasitet):
+            return
+        ny_str = max(behov, 2 * len(self._kapasitet))
+        for navn in ("_kapasitet", "_sist_verifisert", "_oppgang"):
+            gammel = getattr(self, navn)
+            ny = np.zeros(ny_str, dtype=gammel.dtype)
+            ny[:self._n] = gammel[:self._n]
+            setattr(self, navn, ny)
+
+    def _oppgang_nr(self, oppgang_id: str) -> int:
+        nr = self._oppgang_indeks.get(oppgang_id)
+        if nr is None:
+            nr = len(self._oppgang_ids)
+            self._oppgang_ids.append(oppgang_id)
+            self._oppgang_indeks[oppgang_id] = nr
+        return nr
+
+    def upsert(self, pk_id: str, oppgang_id: str, kapasitet_klasse: KapasitetKlasse, sist_verifisert: Tidspunkt = None) -> int:
+        """
+        Setter inn eller oppdaterer én postkasse.
+
+        Returns:
+            Radnummeret til postkassen.
+        """
+        self._sikre_skrivbar()
+        r = self._indeks.get(pk_id)
+        if r is None:
+            self._sikre_plass(1)
+            r = self._n
+            self._n += 1
+            self._ids.append(pk_id)
+            self._indeks[pk_id] = r
+        self._kapasitet[r] = kapasitet_klasse.value
+        self._sist_verifisert[r] = _til_epoch(sist_verifisert)
+        self._oppgang[r] = self._oppgang_nr(oppgang_id)
+        return r
+
+    def upsert_analyse(self, analyse: List[Dict[str, Any]], sist_verifisert: Tidspunkt = None) -> int:
+        """
+        Bulk-oppdatering fra output av bildeanalyse.analyser_bilder_av_oppgang.
+        Postkassens fulle ID bygges som "<oppgang_id>-<postkasse_id>", som ellers i prosjektet.
+
+        Returns:
+            Antall nye rader.
+        """
+        self._sikre_skrivbar()
+        epoch = _til_epoch(sist_verifisert)
+        self._sikre_plass(len(analyse))
+
+        nye = 0
+        for item in analyse:
+            pk_id = f"{item['oppgang_id']}-{item['postkasse_id']}"
+            r = self._indeks.get(pk_id)
+            if r is None:
+                r = self._n
+                self._n += 1
+                self._ids.append(pk_id)
+                self._indeks[pk_id] = r
+                nye += 1
+            self._kapasitet[r] = item["kapasitet_klasse"].value
+            self._sist_verifisert[r] = epoch
+            self._oppgang[r] = self._oppgang_nr(item["oppgang_id"])
+        return nye
+
+    @classmethod
+    def fra_postkasser(cls, postkasser: List[Postkasse]) -> "PostkasseRegister":
+        """Bygger et register fra eksisterende Postkasse-objekter."""
+        reg = cls(start_kapasitet=len(postkasser))
+        for pk in postkasser:
+            reg.upsert(pk.id, pk.oppgang_id, pk.kapasitet_klasse, pk.sist_verifisert)
+        return reg
+
+    # --- Lagring ---
+
+    def lagre(self, katalog: str) -> None:
+        """
+        Lagrer registeret som .npy-kolonner i en katalog.
+        Filene kan åpnes minnemappet med PostkasseRegister.last().
+
+        Hver lagring skrives til en ny generasjonskatalog som fsynces før
+        pekerfilen GJELDENDE byttes inn med os.replace. En leser ser derfor
+        enten hele den forrige lagringen eller hele den nye, også etter et
+        krasj. Den forrige generasjonen beholdes for lesere som akkurat har
+        lest pekeren; eldre generasjoner slettes.
+        """
+        os.makedirs(katalog, exist_ok=True)
+        forrige = _les_peker(katalog)
+        generasjon = f"gen-{time.time_ns()}-{os.getpid()}"
+        gen_katalog = os.path.join(katalog, generasjon)
+        os.makedirs(gen_katalog)
+
+        ids = self.postkasse_ids()
+        id_tabell = np.array([pk_id.encode("utf-8") for pk_id in ids], dtype=bytes) if ids else np.zeros(0, dtype="S1")
+        rekkefølge = np.argsort(id_tabell, kind="stable")
+
+        kolonner = {
+            "ids": id_tabell,
+            "id_sortert": id_tabell[rekkefølge],
+            "id_rad": rekkefølge.astype(np.int64),
+            "kapasitet": self.kapasitet,
+            "sist_verifisert": self.sist_verifisert,
+            "oppgang": self.oppgang
+        }
+        meta = json.dumps({"antall": self._n, "oppganger": self._oppgang_ids}).encode("utf-8")
+        try:
+            for navn, kolonne in kolonner.items():
+                _skriv_atomisk(os.path.join(gen_katalog, f"{navn}.npy"), lambda f, k=kolonne: np.save(f, k))
+            _skriv_atomisk(os.path.join(gen_katalog, "oppganger.json"), lambda f: f.write(meta))
+            _fsync_katalog(gen_katalog)
+        except BaseException:
+            shutil.rmtree(gen_katalog, ignore_errors=True)
+            raise
+
+        _skriv_atomisk(os.path.join(katalog, GJELDENDE), lambda f: f.write(generasjon.encode("utf-8")))
+        _fsync_katalog(katalog)
+        _rydd_generasjoner(katalog, forrige)
+        logger.info(f"Register med {self._n} postkasser lagret til {gen_katalog}")
+
+    @classmethod
+    def last(cls, katalog: str, minnemappet: bool = True) -> "PostkasseRegister":
+        """
+        Åpner et lagret register. Med minnemappet=True deles sidene med
+        andre prosesser som åpner samme katalog; registeret kopieres først
+        til minnet hvis det skrives til.
+        """
+        for forsøk in range(3):
+            reg = cls._les(katalog, minnemappet)
+            if reg is not None:
+                return reg
+            time.sleep(0.05) # Generasjonen ble ryddet bort mellom peker og filer
+        raise ValueError(f"Fant ingen lesbar generasjon av registeret i {katalog}")
+
+    @classmethod
+    def _les(cls, katalog: str, minnemappet: bool) -> Optional["PostkasseRegister"]:
+        modus = "r" if minnemappet else None
+        generasjon = _les_peker(katalog)
+        if generasjon is not None:
+            katalog = os.path.join(katalog, generasjon)
+        # Uten peker er det en eldre lagring med kolonnene rett i katalogen
+
+        def kolonne(navn: str) -> np.ndarray:
+            return np.load(os.path.join(katalog, f"{navn}.npy"), mmap_mode=modus)
+
+        try:
+            with open(os.path.join(katalog, "oppganger.json")) as f:
+                meta = json.load(f)
+            reg = cls.__new__(cls)
+            reg._n = meta["antall"]
+            reg._oppgang_ids = meta["oppganger"]
+            reg._oppgang_indeks = {opp_id: i for i, opp_id in enumerate(reg._oppgang_ids)}
+            reg._id_tabell = kolonne("ids")
+            reg._ids = None
+            reg._indeks = None
+            if os.path.exists(os.path.join(katalog, "id_sortert.npy")):
+                reg._id_sortert, reg._id_rad = kolonne("id_sortert"), kolonne("id_rad")
+            else:
+                reg._id_sortert = reg._id_rad = None # Eldre lagring: dict bygges ved første oppslag
+            reg._kapasitet = kolonne("kapasitet")
+            reg._sist_verifisert = kolonne("sist_verifisert")
+            reg._oppgang = kolonne("oppgang")
+            reg._skrivbar = False
+        except FileNotFoundError:
+            if generasjon is None:
+                raise
+            return None
+
+        lengder = {len(reg._id_tabell), len(reg._kapasitet), len(reg._sist_verifisert), len(reg._oppgang)}
+        if reg._id_sortert is not None:
+            lengder |= {len(reg._id_sortert), len(reg._id_rad)}
+        if lengder != {reg._n}:
+            raise ValueError(f"Registeret i {katalog} er inkonsistent (kolonnene passer ikke med oppganger.json)")
+        return reg
+
+GJELDENDE = "GJELDENDE"
+
+def _les_peker(katalog: str) -> Optional[str]:
+    """Navnet på gjeldende generasjon, eller None for en eldre lagring uten peker."""
+    try:
+        with open(os.path.join(katalog, GJELDENDE)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def _generasjonsnummer(navn: str) -> int:
+    return int(navn.split("-")[1])
+
+def _rydd_generasjoner(katalog: str, forrige: Optional[str]) -> None:
+    """Sletter generasjoner eldre enn den forrige; den forrige kan fortsatt leses."""
+    if forrige is None:
+        return
+    grense = _generasjonsnummer(forrige)
+    for navn in os.listdir(katalog):
+        if navn.startswith("gen-") and _generasjonsnummer(navn) < grense:
+            shutil.rmtree(os.path.join(katalog, navn), ignore_errors=True)
+
+def _fsync_katalog(katalog: str) -> None:
+    fd = os.open(katalog, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _skriv_atomisk(sti: str, skriv: Callable[[Any], Any]) -> None:
+    """Skriver til en midlertidig fil i samme katalog og bytter den inn med os.replace."""
+    tmp = f"{sti}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            skriv(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, sti)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
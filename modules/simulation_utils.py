@@ -1,106 +1,183 @@
-import random
 import os
 import shutil
 import logging
-from typing import List, Tuple, Dict, Any
+import itertools
+import cv2
+import numpy as np
+from typing import List, Tuple, Dict, Any, Optional, Union
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 # Import modules
 from modules.datamodel import Postkasse, Pakke, Oppgang, VolumKlasse
 import modules.bildeanalyse as vision
 import modules.leveringslogikk as delivery
+from modules.bildecache import AnalyseCache
+from modules import metrikker
 
 logger = logging.getLogger("SimUtils")
 
-def generer_syntetiske_ruter(n_oppganger: int, n_postkasser_per_oppgang: int, n_pakker: int) -> Tuple[List[Dict[str, Any]], List[Pakke]]:
+# Pakker som kolonner: (volum_koder, mottaker_idx). mottaker_idx er posisjonen i den
+# flate listen av expected_pk_ids fra oppgang_configs (oppgang for oppgang).
+PakkeKolonner = Tuple[np.ndarray, np.ndarray]
+
+def _lag_oppgang_configs(n_oppganger: int, n_postkasser_per_oppgang: int) -> List[Dict[str, Any]]:
+    # Generer IDer for postkassene som VI VET skal være der
+    return [
+        {"id": f"TEST-OPP-{i}", "expected_pk_ids": [f"TEST-OPP-{i}-PK-{j}" for j in range(1, n_postkasser_per_oppgang + 1)]}
+        for i in range(1, n_oppganger + 1)
+    ]
+
+def generer_pakkekolonner(n_postkasser: int, n_pakker: int, rng: np.random.Generator,
+                          volum_fordeling: Optional[Tuple[float, float, float]] = None,
+                          zipf_a: Optional[float] = None) -> PakkeKolonner:
+    """
+    Trekker mottakere og volumklasser for alle pakkene på en gang.
+    
+    Args:
+        n_postkasser: Antall mulige mottakere.
+        n_pakker: Antall pakker.
+        rng: Seedet Generator.
+        volum_fordeling: Sannsynlighet for (S, M, L). None = lik fordeling.
+        zipf_a: Skjevhet i mottakerfordelingen. Postkasse nr. k (i tilfeldig rekkefølge)
+            får vekt 1/k^a, slik at noen få husstander får mange pakker. None = lik fordeling.
+            
+    Returns:
+        (volum_koder uint8 med VolumKlasse-verdier, mottaker_idx int64 i [0, n_postkasser)).
+    """
+    # 1. Volumklasser: invers CDF over fordelingen
+    if volum_fordeling is None:
+        volum_koder = rng.integers(VolumKlasse.S.value, VolumKlasse.L.value + 1, size=n_pakker, dtype=np.uint8)
+    else:
+        p = np.asarray(volum_fordeling, dtype=np.float64)
+        if p.shape != (3,) or (p < 0).any() or p.sum() <= 0:
+            raise ValueError(f"volum_fordeling må være tre ikke-negative vekter for S, M, L: {volum_fordeling}")
+        kum = np.cumsum(p / p.sum())
+        volum_koder = (np.searchsorted(kum, rng.random(n_pakker), side="right") + VolumKlasse.S.value).astype(np.uint8)
+        np.minimum(volum_koder, VolumKlasse.L.value, out=volum_koder) # Avrunding i kum[-1]
+        
+    # 2. Mottakere: uniform, eller avkortet Zipf over tilfeldig rangerte postkasser
+    if n_postkasser == 0:
+        return volum_koder[:0], np.zeros(0, dtype=np.int64)
+    if not zipf_a:
+        mottaker_idx = rng.integers(0, n_postkasser, size=n_pakker, dtype=np.int64)
+    else:
+        vekter = np.arange(1, n_postkasser + 1, dtype=np.float64) ** -zipf_a
+        kum = np.cumsum(vekter / vekter.sum())
+        rang = np.minimum(np.searchsorted(kum, rng.random(n_pakker), side="right"), n_postkasser - 1)
+        mottaker_idx = rng.permutation(n_postkasser)[rang]
+    return volum_koder, mottaker_idx
+
+def generer_syntetiske_ruter_kolonner(n_oppganger: int, n_postkasser_per_oppgang: int, n_pakker: int, seed: Optional[int] = None,
+                                      volum_fordeling: Optional[Tuple[float, float, float]] = None,
+                                      zipf_a: Optional[float] = None) -> Tuple[List[Dict[str, Any]], PakkeKolonner]:
+    """
+    Som generer_syntetiske_ruter, men pakkene returneres som NumPy-kolonner uten
+    Pakke-objekter. Egnet for lasttester med millioner av pakker.
+    """
+    oppgang_configs = _lag_oppgang_configs(n_oppganger, n_postkasser_per_oppgang)
+    rng = np.random.default_rng(seed)
+    kolonner = generer_pakkekolonner(n_oppganger * n_postkasser_per_oppgang, n_pakker, rng, volum_fordeling, zipf_a)
+    return oppgang_configs, kolonner
+
+def pakker_fra_kolonner(oppgang_configs: List[Dict[str, Any]], kolonner: PakkeKolonner) -> List[Pakke]:
+    """Materialiserer Pakke-objekter fra kolonnene (for kode som trenger objekter)."""
+    alle_pk_ids = [pk_id for conf in oppgang_configs for pk_id in conf["expected_pk_ids"]]
+    volum_koder, mottaker_idx = kolonner
+    volum = [VolumKlasse.S, VolumKlasse.M, VolumKlasse.L]
+    return [
+        Pakke(id=f"TEST-PKG-{k}", volum_klasse=volum[v - 1], mottaker_postkasse_id=alle_pk_ids[m])
+        for k, (v, m) in enumerate(zip(volum_koder.tolist(), mottaker_idx.tolist()))
+    ]
+
+def generer_syntetiske_ruter(n_oppganger: int, n_postkasser_per_oppgang: int, n_pakker: int, seed: Optional[int] = None,
+                             volum_fordeling: Optional[Tuple[float, float, float]] = None,
+                             zipf_a: Optional[float] = None) -> Tuple[List[Dict[str, Any]], List[Pakke]]:
     """
     Genererer konfigurajson for oppganger og en liste pakker (logisk).
     Returnerer ikke Oppgang-objekter ennå, da de må hydreres via bildeanalyse.
+    Med seed blir pakkene reproduserbare.
     """
-    # 1. Konfigurer oppganger (Vi trenger IDer for pakkegenerering)
-    oppgang_configs = []
-    alle_pk_ids = []
-    
-    for i in range(1, n_oppganger + 1):
-        oppgang_id = f"TEST-OPP-{i}"
-        
-        # Generer IDer for postkassene som VI VET skal være der
-        pk_ids = [f"{oppgang_id}-PK-{j}" for j in range(1, n_postkasser_per_oppgang + 1)]
-        alle_pk_ids.extend(pk_ids)
-        
-        config = {
-            "id": oppgang_id,
-            "expected_pk_ids": pk_ids
-        }
-        oppgang_configs.append(config)
-        
-    # 2. Generer pakker tilfeldig fordelt
-    pakker = []
-    for k in range(n_pakker):
-        if not alle_pk_ids: break
-        
-        recipient_id = random.choice(alle_pk_ids)
-        vol = random.choice([VolumKlasse.S, VolumKlasse.M, VolumKlasse.L])
-        
-        p = Pakke(id=f"TEST-PKG-{k}", volum_klasse=vol, mottaker_postkasse_id=recipient_id)
-        pakker.append(p)
-        
-    return oppgang_configs, pakker
+    oppgang_configs, kolonner = generer_syntetiske_ruter_kolonner(
+        n_oppganger, n_postkasser_per_oppgang, n_pakker, seed, volum_fordeling, zipf_a)
+    return oppgang_configs, pakker_fra_kolonner(oppgang_configs, kolonner)
 
-def kjør_simulering(navn: str, oppgang_configs: List[Dict], pakker: List[Pakke], stoy_faktor: float = 0.05, antall_bilder: int = 3) -> Dict[str, Any]:
+def _analyser_oppgang(opp_id: str, antall_bilder: int, stoy_faktor: float, seed: np.random.SeedSequence,
+                      temp_img_dir: Optional[str], cache: Optional[AnalyseCache] = None) -> List[Dict[str, Any]]:
     """
-    Kjører en full end-to-end simulering for gitt config.
-    Genererer bilder -> Analyserer -> Simulerer levering.
+    Genererer og analyserer bildene til én oppgang. Kjøres i en arbeidsprosess.
+    All tilfeldighet kommer fra seed, så resultatet er uavhengig av hvilken prosess som kjører den.
+    Bildene holdes i minnet; med temp_img_dir skrives de i tillegg til disk (debug).
     """
-    logger.info(f"Start simulering: {navn}")
+    rng = np.random.default_rng(seed)
     
-    # Temp mappe for bilder
-    base_dir = os.getcwd()
-    temp_img_dir = os.path.join(base_dir, "data", "temp_test_bilder", navn)
-    if os.path.exists(temp_img_dir):
-        shutil.rmtree(temp_img_dir)
-    os.makedirs(temp_img_dir)
+    # Generer alle bildene på en gang, med tilfeldig forskyvning for realisme
+    forskyvninger = rng.integers(-5, 6, size=(antall_bilder, 2))
+    bilder = list(vision.generer_test_bilder_batch(antall_bilder, stoy_faktor, forskyvninger, rng=rng))
+    if temp_img_dir:
+        for j, bilde in enumerate(bilder):
+            cv2.imwrite(os.path.join(temp_img_dir, f"{opp_id}_img{j}.png"), bilde)
+            
+    # Analyser
+    # Merk: Vi bruker API-et som returnerer en liste dicts
+    return vision.analyser_bilder_av_oppgang(bilder, opp_id, cache=cache)
+
+def _start_visjon(navn: str, oppgang_configs: List[Dict], stoy_faktor: float, antall_bilder: int,
+                  seed: Optional[np.random.SeedSequence], executor: Optional[ProcessPoolExecutor],
+                  cache: Optional[AnalyseCache], lagre_bilder: bool = False) -> List[Any]:
+    """
+    Starter visjonsfasen for et scenario. Returnerer futures (med executor) eller ferdige resultater.
+    """
+    # Temp mappe for bilder (kun når de skal lagres for feilsøking)
+    temp_img_dir = None
+    if lagre_bilder:
+        base_dir = os.getcwd()
+        temp_img_dir = os.path.join(base_dir, "data", "temp_test_bilder", navn)
+        if os.path.exists(temp_img_dir):
+            shutil.rmtree(temp_img_dir)
+        os.makedirs(temp_img_dir)
+        
+    # Én seed per oppgang, avledet fra scenarioets seed og oppgangens posisjon
+    if seed is None:
+        seed = np.random.SeedSequence()
+    oppgang_seeds = seed.spawn(len(oppgang_configs))
     
+    if executor is None:
+        return [_analyser_oppgang(conf["id"], antall_bilder, stoy_faktor, s, temp_img_dir, cache)
+                for conf, s in zip(oppgang_configs, oppgang_seeds)]
+    return [metrikker.send_inn(executor, _analyser_oppgang, conf["id"], antall_bilder, stoy_faktor, s, temp_img_dir)
+            for conf, s in zip(oppgang_configs, oppgang_seeds)]
+
+def _fullfør_simulering(navn: str, oppgang_configs: List[Dict], pakker: Union[List[Pakke], PakkeKolonner], stoy_faktor: float,
+                        visjon: List[Any]) -> Dict[str, Any]:
+    """
+    Hydrerer oppgangene fra visjonsresultatene og simulerer levering.
+    Pakkene kan være Pakke-objekter eller PakkeKolonner (se generer_syntetiske_ruter_kolonner).
+    """
     hydrated_oppganger = []
+    naa = datetime.now() # Ett felles tidsstempel for hele hydreringen
     
-    # 1. VISJON FASE
-    for conf in oppgang_configs:
+    for conf, raw in zip(oppgang_configs, visjon):
         opp_id = conf["id"]
-        img_paths = []
-        
-        # Generer bilder
-        for j in range(antall_bilder):
-            fname = os.path.join(temp_img_dir, f"{opp_id}_img{j}.png")
-            # Random shift for realism
-            sx = random.randint(-5, 5)
-            sy = random.randint(-5, 5)
-            try:
-                vision.generer_test_bilde(fname, shift_x=sx, shift_y=sy, stoy_faktor=stoy_faktor)
-                img_paths.append(fname)
-            except Exception as e:
-                logger.error(f"Feil ved bildegenerering: {e}")
-                
-        # Analyser
-        # Merk: Vi bruker API-et som returnerer en liste dicts
-        raw_data = vision.analyser_bilder_av_oppgang(img_paths, opp_id)
+        raw_data = raw.result() if hasattr(raw, "result") else raw
         
         # Bygg Oppgang objekt
         postkasser = []
         for item in raw_data:
             # Merk: ID konstruksjon her matcher det vi gjorde i generer_test_bilde/analyser_bilde
-            # analyser_bilde returnerer "PK-1", "PK-2". 
+            # analyser_bilde returnerer "PK-1", "PK-2".
             # Vi må prefixe med oppgang_id for å matche pakkenes mottaker ID.
             pk_local_id = item["postkasse_id"] # "PK-1"
             
             # ! VIKTIG: I generer_syntetiske_ruter laget vi IDs som "TEST-OPP-1-PK-1".
-            # Vi må sikre at IDene matcher. 
+            # Vi må sikre at IDene matcher.
             full_id = f"{opp_id}-{pk_local_id}"
             
             pk = Postkasse(
                 id=full_id,
                 oppgang_id=opp_id,
                 kapasitet_klasse=item["kapasitet_klasse"],
-                sist_verifisert=datetime.now()
+                sist_verifisert=naa
             )
             postkasser.append(pk)
             
@@ -108,8 +185,16 @@ def kjør_simulering(navn: str, oppgang_configs: List[Dict], pakker: List[Pakke]
         
     # 2. LEVERING FASE
     alle_postkasser = [pk for opp in hydrated_oppganger for pk in opp.postkasser]
-    res = delivery.simuler_rute(pakker, alle_postkasser)
-    
+    if isinstance(pakker, tuple):
+        # Kolonner: kapasitet per forventet postkasse, UKJENT_KAPASITET der visjonen ikke fant den
+        kapasitet = {pk.id: pk.kapasitet_klasse.value for pk in alle_postkasser}
+        kapasitet_koder = np.fromiter(
+            (kapasitet.get(pk_id, delivery.UKJENT_KAPASITET) for conf in oppgang_configs for pk_id in conf["expected_pk_ids"]),
+            dtype=np.uint8)
+        res = delivery.simuler_rute_batch(pakker[0], pakker[1], kapasitet_koder)
+    else:
+        res = delivery.simuler_rute(pakker, alle_postkasser)
+        
     # Beregn nøkkeltall
     total = res["antall_pakker"]
     direkte = res["direkte_i_postkasse"]
@@ -126,3 +211,84 @@ def kjør_simulering(navn: str, oppgang_configs: List[Dict], pakker: List[Pakke]
         "hentekontor": hent,
         "andel_direkte_pst": andel_direkte
     }
+
+def kjør_simulering(navn: str, oppgang_configs: List[Dict], pakker: List[Pakke], stoy_faktor: float = 0.05, antall_bilder: int = 3,
+                    cache: Optional[AnalyseCache] = None, seed: Optional[np.random.SeedSequence] = None,
+                    executor: Optional[ProcessPoolExecutor] = None, lagre_bilder: bool = False) -> Dict[str, Any]:
+    """
+    Kjører en full end-to-end simulering for gitt config.
+    Genererer bilder -> Analyserer -> Simulerer levering.
+    Med en AnalyseCache analyseres identiske bilder bare én gang på tvers av kjøringer.
+    Med seed (SeedSequence) er bildene reproduserbare, og med executor fordeles
+    oppgangene på en prosesspool uten at resultatet endres.
+    Bildene genereres og analyseres i minnet; lagre_bilder=True skriver dem også
+    til data/temp_test_bilder/<navn> for feilsøking.
+    """
+    logger.info(f"Start simulering: {navn}")
+    
+    # 1. VISJON FASE
+    visjon = _start_visjon(navn, oppgang_configs, stoy_faktor, antall_bilder, seed, executor, cache, lagre_bilder)
+    return _fullfør_simulering(navn, oppgang_configs, pakker, stoy_faktor, visjon)
+
+# --- Scenario-kjøring ---
+
+def scenario_rutenett(stoy: List[float], bilder: List[int], oppganger: List[int], pakker: List[int]) -> List[Dict[str, Any]]:
+    """
+    Lager scenarioer for alle kombinasjoner av parametrene (samme format som i automatiser_test).
+    """
+    scenarier = []
+    for s, b, o, p in itertools.product(stoy, bilder, oppganger, pakker):
+        scenarier.append({
+            "navn": f"stoy={s} bilder={b} oppganger={o} pakker={p}",
+            "oppganger": o,
+            "pakker": p,
+            "stoy": s,
+            "bilder": b
+        })
+    return scenarier
+
+def kjør_scenarioer(scenarier: List[Dict[str, Any]], arbeidere: int = 1, seed: int = 0,
+                    n_postkasser_per_oppgang: int = 11, lagre_bilder: bool = False) -> List[Dict[str, Any]]:
+    """
+    Kjører mange scenarioer, med alle oppganger fra alle scenarioer fordelt på én prosesspool.
+    
+    Hvert scenario får sin egen seed avledet fra (seed, scenario-indeks), og hver
+    oppgang sin egen avledet fra scenarioets. Resultatene er derfor identiske
+    uansett antall arbeidere.
+    
+    Args:
+        scenarier: Dicts med navn, oppganger, pakker, stoy og bilder, og valgfritt
+            volum_fordeling (S, M, L) og zipf (se generer_pakkekolonner).
+            Pakkene holdes som kolonner, så store pakkevolumer er billige.
+        arbeidere: Antall prosesser. 1 kjører alt i denne prosessen.
+        seed: Rot-seed for hele kjøringen.
+        lagre_bilder: Skriv bildene til data/temp_test_bilder (debug).
+        
+    Returns:
+        Én resultat-dict per scenario (som fra kjør_simulering), i samme rekkefølge.
+    """
+    scenario_seeds = np.random.SeedSequence(seed).spawn(len(scenarier))
+    executor = ProcessPoolExecutor(max_workers=arbeidere) if arbeidere > 1 else None
+    try:
+        # 1. Generer data og send all visjon til poolen før vi venter på noe
+        planer = []
+        for scen, scen_seed in zip(scenarier, scenario_seeds):
+            logger.info(f"Kjører scenario: {scen['navn']}")
+            rute_seed, visjon_seed = scen_seed.spawn(2)
+            opp_conf, pakker = generer_syntetiske_ruter_kolonner(
+                n_oppganger=scen["oppganger"],
+                n_postkasser_per_oppgang=n_postkasser_per_oppgang,
+                n_pakker=scen["pakker"],
+                seed=int(rute_seed.generate_state(1)[0]),
+                volum_fordeling=scen.get("volum_fordeling"),
+                zipf_a=scen.get("zipf")
+            )
+            visjon = _start_visjon(scen["navn"], opp_conf, scen["stoy"], scen["bilder"], visjon_seed, executor, None, lagre_bilder)
+            planer.append((scen, opp_conf, pakker, visjon))
+            
+        # 2. Levering per scenario etter hvert som visjonen blir ferdig
+        return [_fullfør_simulering(scen["navn"], opp_conf, pakker, scen["stoy"], visjon)
+                for scen, opp_conf, pakker, visjon in planer]
+    finally:
+        if executor is not None:
+            executor.shutdown()
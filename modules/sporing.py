@@ -0,0 +1,287 @@
+import os
+import logging
+import tempfile
+import cv2
+import numpy as np
+from dataclasses import dataclass, field
+from typing import List, Tuple, Dict, Any, Iterable, Optional, Union
+from modules.datamodel import KapasitetKlasse
+from modules import bildeanalyse, detektorer, metrikker
+
+logger = logging.getLogger(__name__)
+
+# Standardverdier for sporing, valgt for 30 fps fra en telefon som føres langs reolen
+NOKKEL_INTERVALL = 10  # Full analyse minst hver n-te ramme
+MAKS_FLYTTING = 0.2    # ... og når bildet har flyttet seg mer enn denne andelen av bildets korteste side
+MIN_RESPONS = 0.05     # Fasekorrelasjon med lavere toppverdi regnes som upålitelig (gir nøkkelramme)
+IOU_TERSKEL = 0.3      # Minste overlapp for å koble et funn til et spor
+INNE_TERSKEL = 0.7     # Kuttede bokser: minste andel av den minste boksen som må overlappe
+MAKS_TAPT = 3          # Nøkkelrammer et synlig spor kan mangle før det avsluttes
+MIN_TREFF = 2          # Spor sett i færre nøkkelrammer enn dette regnes som støy
+FLYT_BREDDE = 256      # Omtrentlig bredde (px) bildene tynnes til før fasekorrelasjon
+KANT_MARGIN = 2        # Bokser nærmere bildekanten enn dette (px) er kuttet og gir ingen klasse
+
+@dataclass(slots=True)
+class Spor:
+    """
+    Én postkasse fulgt gjennom videoen. Boksen er i verdenskoordinater (piksler
+    i første ramme), så sporet beholder posisjonen sin selv når det er ute av bildet.
+    """
+    nr: int
+    boks: np.ndarray # (x, y, w, h) som float
+    klasser: List[KapasitetKlasse] = field(default_factory=list)    # Fra hele bokser (tom: aldri sett helt)
+    kuttede: List[KapasitetKlasse] = field(default_factory=list)    # Fra bokser som berørte bildekanten
+    treff: int = 0
+    tapt: int = 0
+    aktiv: bool = True
+
+def _overlapp(a: np.ndarray, b: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Parvis overlapp mellom (N, 4) og (M, 4) bokser på formen (x, y, w, h).
+
+    Returns:
+        (IoU, snitt delt på den minste boksen). Det siste er 1 når en kuttet
+        boks ligger helt inne i den hele, der IoU bare blir andelen som er synlig.
+    """
+    ax2, ay2 = a[:, 0] + a[:, 2], a[:, 1] + a[:, 3]
+    bx2, by2 = b[:, 0] + b[:, 2], b[:, 1] + b[:, 3]
+    iw = np.clip(np.minimum(ax2[:, None], bx2[None]) - np.maximum(a[:, 0, None], b[None, :, 0]), 0, None)
+    ih = np.clip(np.minimum(ay2[:, None], by2[None]) - np.maximum(a[:, 1, None], b[None, :, 1]), 0, None)
+    snitt = iw * ih
+    areal_a, areal_b = (a[:, 2] * a[:, 3])[:, None], (b[:, 2] * b[:, 3])[None]
+    iou = snitt / np.maximum(areal_a + areal_b - snitt, 1e-9)
+    return iou, snitt / np.maximum(np.minimum(areal_a, areal_b), 1e-9)
+
+def _grådig_kobling(kostnad: np.ndarray, tillatt: np.ndarray) -> List[Tuple[int, int]]:
+    # Kobler (rad, kolonne) med lavest kostnad først; hver rad og kolonne brukes én gang
+    par = []
+    brukte_r, brukte_k = set(), set()
+    rader, kolonner = np.nonzero(tillatt)
+    for i in np.argsort(kostnad[rader, kolonner], kind="stable"):
+        r, k = int(rader[i]), int(kolonner[i])
+        if r not in brukte_r and k not in brukte_k:
+            par.append((r, k))
+            brukte_r.add(r)
+            brukte_k.add(k)
+    return par
+
+class Sporer:
+    """
+    Følger postkasser gjennom en strøm av videorammer.
+
+    Bare nøkkelrammer analyseres fullt (med detektoren). Mellom dem måles
+    kamerabevegelsen med fasekorrelasjon på nedskalerte gråtonebilder, som tar
+    rundt et millisekund per ramme. Bevegelsen summeres til en forskyvning,
+    slik at funn i hver nøkkelramme kan legges i felles verdenskoordinater og
+    kobles til eksisterende spor med IoU (og avstand mellom sentrene som
+    reserve). Hver nøkkelramme retter også opp drift i forskyvningen.
+
+    Nøkkelrammer tas hver nokkel_intervall-te ramme, når bildet har flyttet
+    seg mye siden forrige, eller når bevegelsen ikke kunne måles sikkert.
+
+    Bruk: legg_til(ramme) for hver ramme, deretter resultat(oppgang_id).
+    """
+
+    def __init__(self, detektor: Optional[detektorer.Detektor] = None, nokkel_intervall: int = NOKKEL_INTERVALL,
+                 iou_terskel: float = IOU_TERSKEL, maks_tapt: int = MAKS_TAPT, min_treff: int = MIN_TREFF):
+        self.detektor = detektor or detektorer.aktiv()
+        self.nokkel_intervall = nokkel_intervall
+        self.iou_terskel = iou_terskel
+        self.maks_tapt = maks_tapt
+        self.min_treff = min_treff
+        self.spor: List[Spor] = []
+        self.rammer = 0
+        self.nokkelrammer = 0
+        self._forskyvning = np.zeros(2) # Innholdets forflytning siden første ramme (px)
+        self._siden_nokkel = np.zeros(2)
+        self._rammer_siden_nokkel = 0
+        self._forrige: Optional[np.ndarray] = None
+        self._vindu: Optional[np.ndarray] = None
+        self._trinn = 1
+
+    def _liten(self, ramme: np.ndarray) -> np.ndarray:
+        # Hver trinn-te piksel i grønn kanal: nær gratis, og like presist som cv2.resize for fasekorrelasjon
+        self._trinn = max(1, -(-ramme.shape[1] // FLYT_BREDDE))
+        kanal = ramme[..., 1] if ramme.ndim == 3 else ramme
+        liten = kanal[::self._trinn, ::self._trinn].astype(np.float32)
+        if self._vindu is None or self._vindu.shape != liten.shape:
+            self._vindu = cv2.createHanningWindow(liten.shape[::-1], cv2.CV_32F)
+        return liten
+
+    def legg_til(self, ramme: np.ndarray) -> None:
+        """Tar imot neste ramme (BGR- eller gråtonearray)."""
+        klokke = metrikker.stoppeklokke()
+        liten = self._liten(ramme)
+        nokkel = self._forrige is None or self._rammer_siden_nokkel + 1 >= self.nokkel_intervall
+        if self._forrige is not None:
+            (dx, dy), respons = cv2.phaseCorrelate(self._forrige, liten, self._vindu)
+            flytting = np.array([dx, dy]) * self._trinn
+            self._forskyvning += flytting
+            self._siden_nokkel += flytting
+            if respons < MIN_RESPONS or np.abs(self._siden_nokkel).max() > MAKS_FLYTTING * min(ramme.shape[:2]):
+                nokkel = True
+        self._forrige = liten
+        self.rammer += 1
+        self._rammer_siden_nokkel += 1
+        klokke.runde("flyt")
+
+        if nokkel:
+            self._nokkelramme(ramme)
+            klokke.runde("nokkelramme")
+            klokke.tell("nokkelrammer")
+        klokke.tell("rammer")
+        klokke.ferdig("sporing_ramme")
+
+    def _nokkelramme(self, ramme: np.ndarray) -> None:
+        self.nokkelrammer += 1
+        self._rammer_siden_nokkel = 0
+        self._siden_nokkel[:] = 0
+        funn = self.detektor.finn_bokser([ramme])[0]
+        if not funn:
+            self._tell_tapte(ramme, set())
+            return
+
+        bokser = np.array([b for b, _ in funn], dtype=np.float64)
+        h, w = ramme.shape[:2]
+        kuttet = ((bokser[:, 0] <= KANT_MARGIN) | (bokser[:, 1] <= KANT_MARGIN) |
+                  (bokser[:, 0] + bokser[:, 2] >= w - KANT_MARGIN) | (bokser[:, 1] + bokser[:, 3] >= h - KANT_MARGIN))
+        aktive = [s for s in self.spor if s.aktiv]
+        par = self._koble(aktive, bokser, kuttet)
+
+        # Rett opp driften i forskyvningen med de hele boksene som ble koblet
+        if par:
+            avvik = [aktive[i].boks[:2] - (bokser[j, :2] - self._forskyvning) for i, j in par if not kuttet[j]]
+            if avvik:
+                self._forskyvning -= np.median(avvik, axis=0)
+        verden = bokser.copy()
+        verden[:, :2] -= self._forskyvning
+
+        sett = set()
+        koblet = {j: aktive[i] for i, j in par}
+        for j, (_, kap) in enumerate(funn):
+            spor = koblet.get(j)
+            if spor is None:
+                spor = Spor(nr=len(self.spor), boks=verden[j])
+                self.spor.append(spor)
+            elif not kuttet[j] or (not spor.klasser and verden[j, 2] * verden[j, 3] > spor.boks[2] * spor.boks[3]):
+                spor.boks = verden[j] # En kuttet boks erstatter bare en mindre kuttet boks
+            (spor.kuttede if kuttet[j] else spor.klasser).append(kap)
+            spor.treff += 1
+            spor.tapt = 0
+            sett.add(spor.nr)
+        self._tell_tapte(ramme, sett)
+
+    def _koble(self, aktive: List[Spor], bokser: np.ndarray, kuttet: np.ndarray) -> List[Tuple[int, int]]:
+        # (spor-indeks, funn-indeks): først på overlapp, så gjenværende på avstand mellom sentrene
+        if not aktive:
+            return []
+        spor_bokser = np.array([s.boks for s in aktive])
+        spor_bokser[:, :2] += self._forskyvning # Forventet plassering i denne rammen
+        iou, inne = _overlapp(spor_bokser, bokser)
+        # Er en av boksene kuttet, holder det at den minste ligger inne i den andre
+        delvis = kuttet[None, :] | np.array([not s.klasser for s in aktive])[:, None]
+        likhet = np.where(delvis, np.maximum(iou, inne), iou)
+        par = _grådig_kobling(-likhet, (iou >= self.iou_terskel) | (delvis & (inne >= INNE_TERSKEL)))
+
+        brukte_s, brukte_f = {i for i, _ in par}, {j for _, j in par}
+        ledige_s = [i for i in range(len(aktive)) if i not in brukte_s]
+        ledige_f = [j for j in range(len(bokser)) if j not in brukte_f]
+        if ledige_s and ledige_f:
+            a, b = spor_bokser[ledige_s], bokser[ledige_f]
+            avstand = np.linalg.norm((a[:, None, :2] + a[:, None, 2:] / 2) - (b[None, :, :2] + b[None, :, 2:] / 2), axis=2)
+            grense = 0.5 * np.maximum(a[:, 2], a[:, 3])[:, None]
+            par += [(ledige_s[i], ledige_f[j]) for i, j in _grådig_kobling(avstand, avstand <= grense)]
+        return par
+
+    def _tell_tapte(self, ramme: np.ndarray, sett: set) -> None:
+        # Spor som burde vært i bildet men ikke ble funnet; spor utenfor bildet venter bare
+        h, w = ramme.shape[:2]
+        for spor in self.spor:
+            if not spor.aktiv or spor.nr in sett:
+                continue
+            x, y = spor.boks[:2] + self._forskyvning
+            if x >= 0 and y >= 0 and x + spor.boks[2] <= w and y + spor.boks[3] <= h:
+                spor.tapt += 1
+                if spor.tapt > self.maks_tapt:
+                    spor.aktiv = False
+
+    def ferdige_spor(self) -> List[Spor]:
+        """Spor sett i nok nøkkelrammer, ovenfra og ned og venstre mot høyre."""
+        min_treff = min(self.min_treff, self.nokkelrammer)
+        spor = sorted((s for s in self.spor if s.treff >= min_treff), key=lambda s: s.boks[1])
+        if not spor:
+            return []
+        # Rader: en ny rad starter når toppen ligger mer enn en halv boks under radens første
+        halv = 0.5 * float(np.median([s.boks[3] for s in spor]))
+        rader, rad_topp = [[spor[0]]], spor[0].boks[1]
+        for s in spor[1:]:
+            if s.boks[1] - rad_topp > halv:
+                rader.append([])
+                rad_topp = s.boks[1]
+            rader[-1].append(s)
+        return [s for rad in rader for s in sorted(rad, key=lambda s: s.boks[0])]
+
+    def resultat(self, oppgang_id: str) -> List[Dict[str, Any]]:
+        """
+        Én oppføring per postkasse, i samme format som analyser_bilder_av_oppgang.
+        Klassen er den største som er sett i en nøkkelramme der hele postkassen
+        var i bildet (konservativt); bare kuttede observasjoner brukes hvis den
+        aldri var helt synlig.
+        """
+        observasjoner = [(f"PK-{i + 1}", kap)
+                         for i, s in enumerate(self.ferdige_spor())
+                         for kap in (s.klasser or s.kuttede)]
+        resultat = bildeanalyse.aggreger_observasjoner([observasjoner], oppgang_id)
+        logger.info(f"Sporing av {oppgang_id}: {self.rammer} rammer, {self.nokkelrammer} nøkkelrammer, "
+                    f"{len(resultat)} postkasser ({len(self.spor)} spor)")
+        return resultat
+
+def analyser_rammer(rammer: Iterable[np.ndarray], oppgang_id: str, detektor: Optional[detektorer.Detektor] = None,
+                    **valg: Any) -> List[Dict[str, Any]]:
+    """Sporer postkasser gjennom rammene (se Sporer) og returnerer aggregert output."""
+    sporer = Sporer(detektor, **valg)
+    for ramme in rammer:
+        sporer.legg_til(ramme)
+    return sporer.resultat(oppgang_id)
+
+def les_rammer(kilde: Union[str, bytes], maks_rammer: Optional[int] = None) -> Iterable[np.ndarray]:
+    """
+    Dekoder en videofil (sti eller bytes) ramme for ramme med OpenCV.
+    Bytes skrives til en midlertidig fil, siden VideoCapture leser fra fil.
+    """
+    sti, midlertidig = kilde, None
+    if not isinstance(kilde, str):
+        fd, midlertidig = tempfile.mkstemp(suffix=".video")
+        with os.fdopen(fd, "wb") as f:
+            f.write(kilde)
+        sti = midlertidig
+    video = cv2.VideoCapture(sti)
+    try:
+        if not video.isOpened():
+            raise ValueError("Kunne ikke åpne videoen")
+        n = 0
+        while maks_rammer is None or n < maks_rammer:
+            ok, ramme = video.read()
+            if not ok:
+                break
+            n += 1
+            yield ramme
+    finally:
+        video.release()
+        if midlertidig:
+            os.remove(midlertidig)
+
+def analyser_video(kilde: Union[str, bytes], oppgang_id: str, detektor: Optional[detektorer.Detektor] = None,
+                   maks_rammer: Optional[int] = None, **valg: Any) -> List[Dict[str, Any]]:
+    """
+    Analyserer en video av en oppgang (sti eller bytes, f.eks. MP4/MOV fra telefonen).
+    Postkassene spores mellom rammene, så hver postkasse telles én gang uansett
+    hvor mange rammer den er med i.
+
+    Args:
+        detektor: Analysemetode for nøkkelrammene (må gi bokser). None bruker den aktive.
+        maks_rammer: Stopp etter så mange rammer (None = hele videoen).
+        valg: Videre til Sporer (nokkel_intervall, iou_terskel, maks_tapt, min_treff).
+    """
+    logger.info(f"Analyserer video for oppgang {oppgang_id}")
+    return analyser_rammer(les_rammer(kilde, maks_rammer), oppgang_id, detektor, **valg)
@@ -0,0 +1,482 @@
+import os
+import re
+import json
+import time
+import zlib
+import fcntl
+import queue
+import heapq
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Any, Callable, Iterator, Optional
+from modules.datamodel import KapasitetKlasse
+from modules.jobbko import JobbKo, KoFullError
+
+logger = logging.getLogger(__name__)
+
+Analyseresultat = List[Any] # [(pk_id, KapasitetKlasse), ...] som fra analyser_bilde
+
+MAKS_BIT = 4 * 1024 * 1024    # Største bit per forespørsel (etter dekomprimering)
+MAKS_FIL = 64 * 1024 * 1024   # Største bilde som tas imot
+LÅSER = 64                    # Faste låser; bildene fordeles på dem etter hash
+_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+# Filendelser for mottatte bilder; .jpg først, som eldre lagringer bruker
+FILTYPER = (".jpg", ".png", ".heic", ".webp", ".gif", ".bmp", ".tif", ".bin")
+_MAGI = ((b"\xff\xd8\xff", ".jpg"), (b"\x89PNG\r\n\x1a\n", ".png"), (b"GIF8", ".gif"),
+         (b"BM", ".bmp"), (b"II*\x00", ".tif"), (b"MM\x00*", ".tif"))
+
+class SynkFeil(Exception):
+    """Grunnklasse for feil i synkroniseringen. Meldingen kan vises til klienten."""
+
+class UkjentOpplasting(SynkFeil):
+    """Biter for et bilde som ikke er meldt inn med start()."""
+
+class FeilPosisjon(SynkFeil):
+    """Biten starter et annet sted enn det serveren har mottatt. Klienten fortsetter fra mottatt."""
+
+    def __init__(self, melding: str, mottatt: int):
+        super().__init__(melding)
+        self.mottatt = mottatt
+
+class FeilSjekksum(SynkFeil):
+    """Biten eller hele bildet stemmer ikke med oppgitt SHA-256. Biten må sendes på nytt."""
+
+class ForStor(SynkFeil):
+    """Biten eller bildet er større enn grensen."""
+
+def sjekk_sha(sha: str) -> str:
+    """Godtar bare 64 små heksadesimale tegn (hashen brukes i filnavn)."""
+    if not isinstance(sha, str) or not _SHA256.match(sha):
+        raise SynkFeil(f"Ugyldig SHA-256: {sha!r}")
+    return sha
+
+def dekomprimer(data: bytes, koding: Optional[str], maks: int = MAKS_BIT) -> bytes:
+    """Pakker ut en gzip-kodet kropp, med grense så en liten kropp ikke kan blåses opp i minnet."""
+    if not koding or koding == "identity":
+        return data
+    if koding != "gzip":
+        raise SynkFeil(f"Ukjent Content-Encoding: {koding}")
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        ut = d.decompress(data, maks + 1)
+    except zlib.error as e:
+        raise SynkFeil(f"Ugyldig gzip: {e}") from None
+    if len(ut) > maks or d.unconsumed_tail:
+        raise ForStor(f"Utpakket kropp er større enn {maks} bytes")
+    return ut
+
+def filtype(hode: bytes, filnavn: Optional[str] = None) -> str:
+    """
+    Filendelse for et bilde ut fra de første bytene. Kjennes ikke formatet
+    igjen, brukes endelsen i det innmeldte filnavnet, ellers .bin.
+    """
+    for magi, endelse in _MAGI:
+        if hode.startswith(magi):
+            return endelse
+    if hode[:4] == b"RIFF" and hode[8:12] == b"WEBP":
+        return ".webp"
+    if hode[4:8] == b"ftyp" and hode[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return ".heic"
+    endelse = os.path.splitext(filnavn or "")[1].lower()
+    endelse = {".jpeg": ".jpg", ".tiff": ".tif"}.get(endelse, endelse)
+    return endelse if endelse in FILTYPER else ".bin"
+
+class SynkLager:
+    """
+    Innholdsadressert mottak for bilder fra appens offline-kø.
+
+    Klienten melder inn hvert bilde med SHA-256 og størrelse (start). Bilder
+    serveren allerede har, er ferdige med en gang. Resten sendes i biter med
+    sjekksum, som skrives rett til <katalog>/delvis/<sha>.part. Filstørrelsen
+    på disk er hvor langt opplastingen har kommet, så en avbrutt opplasting
+    (eller en omstartet server) fortsetter der den stoppet.
+
+    Når siste bit er mottatt, kontrolleres hele filen mot hashen og flyttes til
+    <katalog>/bilder/<sha[:2]>/<sha><endelse>, med endelsen fra bildets
+    format (se filtype). Analyseresultatet lagres ved siden av som
+    <sha>.resultat.json.
+
+    Flere serverprosesser kan dele katalogen: hvert bilde låses både med en
+    trådlås og med flock på en av LÅSER låsfiler i <katalog>/delvis.
+    """
+
+    def __init__(self, katalog: str, maks_bit: int = MAKS_BIT, maks_fil: int = MAKS_FIL):
+        self.katalog = katalog
+        self.maks_bit = maks_bit
+        self.maks_fil = maks_fil
+        self._delvis = os.path.join(katalog, "delvis")
+        self._bilder = os.path.join(katalog, "bilder")
+        os.makedirs(self._delvis, exist_ok=True)
+        os.makedirs(self._bilder, exist_ok=True)
+        # Samme bilde har alltid samme lås, så to forsøk på samme bit ikke blandes
+        self._låser = [threading.Lock() for _ in range(LÅSER)]
+
+    # --- Stier ---
+
+    def _finn(self, sha: str) -> Optional[str]:
+        for endelse in FILTYPER:
+            sti = os.path.join(self._bilder, sha[:2], f"{sha}{endelse}")
+            if os.path.exists(sti):
+                return sti
+        return None
+
+    def sti(self, sha: str) -> str:
+        """Stien til et mottatt bilde. FileNotFoundError hvis bildet ikke er mottatt ferdig."""
+        sti = self._finn(sha)
+        if sti is None:
+            raise FileNotFoundError(f"{sha} er ikke mottatt")
+        return sti
+
+    def _del_sti(self, sha: str) -> str:
+        return os.path.join(self._delvis, f"{sha}.part")
+
+    def _meta_sti(self, sha: str) -> str:
+        return os.path.join(self._delvis, f"{sha}.json")
+
+    def _ferdig_meta_sti(self, sha: str) -> str:
+        return os.path.join(self._bilder, sha[:2], f"{sha}.meta.json")
+
+    def _resultat_sti(self, sha: str) -> str:
+        return os.path.join(self._bilder, sha[:2], f"{sha}.resultat.json")
+
+    def _feil_sti(self, sha: str) -> str:
+        return os.path.join(self._bilder, sha[:2], f"{sha}.feil.json")
+
+    @contextmanager
+    def _lås_for(self, sha: str) -> Iterator[None]:
+        # flock gjelder per åpnet fil, så trådlåsen trengs fortsatt i prosessen.
+        # Låsfilen åpnes for hvert kall: en arvet fil etter fork ville delt låsen med forelderen.
+        nr = int(sha[:8], 16) % len(self._låser)
+        with self._låser[nr]:
+            with open(os.path.join(self._delvis, f".las-{nr:02d}"), "a") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                yield # Låsen slippes når filen lukkes
+
+    def _fjern_delvis(self, sha: str) -> None:
+        for sti in (self._del_sti(sha), self._meta_sti(sha)):
+            try:
+                os.remove(sti)
+            except FileNotFoundError:
+                pass
+
+    # --- Opplasting ---
+
+    def finnes(self, sha: str) -> bool:
+        return self._finn(sjekk_sha(sha)) is not None
+
+    def status(self, sha: str) -> Dict[str, Any]:
+        """{"sha256", "status": "ferdig" | "delvis" | "ukjent", "mottatt", "storrelse"}"""
+        sha = sjekk_sha(sha)
+        if (sti := self._finn(sha)) is not None:
+            storrelse = os.path.getsize(sti)
+            return {"sha256": sha, "status": "ferdig", "mottatt": storrelse, "storrelse": storrelse}
+        try:
+            with open(self._meta_sti(sha)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return {"sha256": sha, "status": "ukjent", "mottatt": 0, "storrelse": None}
+        mottatt = os.path.getsize(self._del_sti(sha)) if os.path.exists(self._del_sti(sha)) else 0
+        return {"sha256": sha, "status": "delvis", "mottatt": mottatt, "storrelse": meta["storrelse"]}
+
+    def start(self, sha: str, storrelse: int, oppgang_id: Optional[str] = None, filnavn: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Melder inn et bilde. Returnerer status; "ferdig" betyr at ingenting
+        trenger å sendes, ellers fortsetter klienten fra "mottatt".
+        """
+        sha = sjekk_sha(sha)
+        if not isinstance(storrelse, int) or storrelse <= 0:
+            raise SynkFeil(f"Ugyldig størrelse for {sha}: {storrelse!r}")
+        if storrelse > self.maks_fil:
+            raise ForStor(f"{sha} er {storrelse} bytes; grensen er {self.maks_fil}")
+        with self._lås_for(sha):
+            status = self.status(sha)
+            if status["status"] == "ferdig":
+                # Hashen avgjør: bildet er her, uansett hvilken størrelse klienten oppgir
+                if status["storrelse"] != storrelse:
+                    logger.warning(f"Synk: {sha[:12]} meldt inn med {storrelse} bytes, men har {status['storrelse']}")
+                self._fjern_delvis(sha) # Rester fra en opplasting som ble avbrutt etter fullføring
+                return status
+            if status["status"] == "ukjent" or status["storrelse"] != storrelse:
+                # Ny opplasting, eller klienten har endret størrelsen: begynn på nytt
+                meta = {"storrelse": storrelse, "oppgang_id": oppgang_id, "filnavn": filnavn, "startet": time.time()}
+                with open(self._meta_sti(sha), "w") as f:
+                    json.dump(meta, f)
+                open(self._del_sti(sha), "wb").close()
+                status = self.status(sha)
+            return status
+
+    def skriv_bit(self, sha: str, posisjon: int, data: bytes, sjekksum: Optional[str]) -> Dict[str, Any]:
+        """
+        Skriver en bit fra posisjon. Biten må starte der forrige sluttet, og
+        sjekksummen (SHA-256 av biten) er påkrevd, så en ødelagt bit avvises
+        med en gang i stedet for når hele bildet er mottatt.
+
+        Returns:
+            Status som fra status(). Kallet som fullfører bildet får i tillegg "ny": True.
+
+        Raises:
+            UkjentOpplasting, FeilPosisjon (med .mottatt), FeilSjekksum, ForStor
+        """
+        sha = sjekk_sha(sha)
+        if len(data) > self.maks_bit:
+            raise ForStor(f"Biten er {len(data)} bytes; grensen er {self.maks_bit}")
+        if not sjekksum:
+            raise FeilSjekksum("Biten mangler sjekksum (SHA-256)")
+        if hashlib.sha256(data).hexdigest() != sjekksum.strip().lower():
+            raise FeilSjekksum(f"Sjekksummen for biten ved {posisjon} stemmer ikke")
+
+        with self._lås_for(sha):
+            status = self.status(sha)
+            if status["status"] == "ferdig":
+                return status # Gjentatt siste bit etter et brutt svar
+            if status["status"] == "ukjent":
+                raise UkjentOpplasting(f"{sha} er ikke meldt inn")
+            if posisjon != status["mottatt"]:
+                raise FeilPosisjon(f"Forventet posisjon {status['mottatt']}, fikk {posisjon}", status["mottatt"])
+            if posisjon + len(data) > status["storrelse"]:
+                raise ForStor(f"Biten går forbi oppgitt størrelse {status['storrelse']}")
+
+            with open(self._del_sti(sha), "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno()) # Det som er kvittert for, skal overleve et strømbrudd
+            if posisjon + len(data) < status["storrelse"]:
+                status["mottatt"] = posisjon + len(data)
+                return status
+            return self._fullfør(sha)
+
+    def _fullfør(self, sha: str) -> Dict[str, Any]:
+        h = hashlib.sha256()
+        with open(self._del_sti(sha), "rb") as f:
+            for blokk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(blokk)
+        if h.hexdigest() != sha:
+            # Bitene var hele hver for seg, men filen er feil (f.eks. feil hash i manifestet)
+            open(self._del_sti(sha), "wb").close()
+            raise FeilSjekksum(f"Hele filen stemmer ikke med {sha}; start på nytt fra 0")
+
+        with open(self._del_sti(sha), "rb") as f:
+            hode = f.read(16)
+        with open(self._meta_sti(sha)) as f:
+            endelse = filtype(hode, json.load(f).get("filnavn"))
+        sti = os.path.join(self._bilder, sha[:2], f"{sha}{endelse}")
+        os.makedirs(os.path.dirname(sti), exist_ok=True)
+        os.replace(self._meta_sti(sha), self._ferdig_meta_sti(sha))
+        os.replace(self._del_sti(sha), sti) # Sist: bildet finnes først når alt er på plass
+        logger.info(f"Synk: mottok {sha[:12]} ({os.path.getsize(sti)} bytes, {endelse})")
+        status = self.status(sha)
+        status["ny"] = True # Bare kallet som fullførte, så bildet analyseres én gang
+        return status
+
+    def meta(self, sha: str) -> Optional[Dict[str, Any]]:
+        """Innmeldte metadata (storrelse, oppgang_id, filnavn), eller None for ukjente bilder."""
+        sha = sjekk_sha(sha)
+        for sti in (self._ferdig_meta_sti(sha), self._meta_sti(sha)):
+            try:
+                with open(sti) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                continue
+        return None
+
+    def les(self, sha: str) -> bytes:
+        with open(self.sti(sjekk_sha(sha)), "rb") as f:
+            return f.read()
+
+    # --- Resultater ---
+
+    def lagre_resultat(self, sha: str, resultat: Analyseresultat) -> None:
+        sti = self._resultat_sti(sha)
+        with open(sti + ".tmp", "w") as f:
+            json.dump([[pk_id, kap.name] for pk_id, kap in resultat], f)
+        os.replace(sti + ".tmp", sti)
+        try:
+            os.remove(self._feil_sti(sha)) # Lyktes etter tidligere feil
+        except FileNotFoundError:
+            pass
+
+    def registrer_feil(self, sha: str, feil: str) -> int:
+        """Lagrer siste feil for analysen av et bilde. Returnerer antall feilede forsøk så langt."""
+        forrige = self.hent_feil(sha)
+        forsøk = (forrige["forsok"] if forrige else 0) + 1
+        sti = self._feil_sti(sha)
+        with open(sti + ".tmp", "w") as f:
+            json.dump({"forsok": forsøk, "feil": feil, "tid": time.time()}, f)
+        os.replace(sti + ".tmp", sti)
+        return forsøk
+
+    def hent_feil(self, sha: str) -> Optional[Dict[str, Any]]:
+        """{"forsok", "feil", "tid"} hvis analysen har feilet uten å lykkes siden, ellers None."""
+        try:
+            with open(self._feil_sti(sjekk_sha(sha))) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def hent_resultat(self, sha: str) -> Optional[Analyseresultat]:
+        try:
+            with open(self._resultat_sti(sjekk_sha(sha))) as f:
+                return [(pk_id, KapasitetKlasse[navn]) for pk_id, navn in json.load(f)]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def uten_resultat(self) -> Iterator[str]:
+        """Mottatte bilder som ikke er analysert (f.eks. fordi serveren stoppet)."""
+        for mappe in os.scandir(self._bilder):
+            if not mappe.is_dir():
+                continue
+            for entry in os.scandir(mappe.path):
+                sha, endelse = entry.name[:64], entry.name[64:]
+                if endelse in FILTYPER and _SHA256.match(sha) and not os.path.exists(self._resultat_sti(sha)):
+                    yield sha
+
+class Bakgrunnsanalyse:
+    """
+    Analyserer mottatte bilder i bakgrunnen, gjennom den vanlige JobbKo-en.
+
+    Synkroniserte bilder har ingen som venter på svaret, så de slippes bare inn
+    når køen har ledig plass: høyst andel av kapasiteten brukes av bakgrunns-
+    jobber, og resten er alltid ledig for /analyze. En stor synk ved skiftslutt
+    jevnes dermed ut over tid i stedet for å gi 503 for alle andre.
+
+    En analyse som feiler, registreres i lageret og prøves igjen etter
+    ventetid * 2^(forsøk - 1) sekunder, opptil maks_forsøk ganger. Bilder som
+    fortsatt feiler, prøves igjen ved neste start().
+
+    Args:
+        lager: SynkLager bildene ligger i.
+        ko: Funksjon som gir gjeldende JobbKo (serveren kan bytte den ut).
+        analyser: Kalles i køen med stien til bildet (f.eks. bildeanalyse.analyser_ett).
+        ved_resultat: Valgfri callback(sha, resultat), f.eks. for å fylle analysecachen.
+        andel: Hvor stor del av køens kapasitet bakgrunnsjobber kan bruke.
+    """
+
+    def __init__(self, lager: SynkLager, ko: Callable[[], JobbKo], analyser: Callable[[str], Analyseresultat],
+                 ved_resultat: Optional[Callable[[str, Analyseresultat], None]] = None, andel: float = 0.5,
+                 pause: float = 0.2, maks_forsøk: int = 5, ventetid: float = 30.0):
+        self.lager = lager
+        self.ko = ko
+        self.analyser = analyser
+        self.ved_resultat = ved_resultat
+        self.andel = andel
+        self.pause = pause
+        self.maks_forsøk = maks_forsøk
+        self.ventetid = ventetid
+        self._venter: "queue.Queue[str]" = queue.Queue()
+        self._senere: List[Any] = [] # Heap av (tidspunkt, sha) for nye forsøk
+        self._i_kø: set = set()
+        self._lås = threading.Lock()
+        self._kjører = 0
+        self.ferdige = 0
+        self.feilet = 0
+        self._tråd: Optional[threading.Thread] = None
+
+    def start(self) -> "Bakgrunnsanalyse":
+        """Starter tråden og legger inn bilder som ble mottatt men ikke analysert før en omstart."""
+        self._tråd = threading.Thread(target=self._løkke, name="synk-analyse", daemon=True)
+        self._tråd.start()
+        gjenopptatt = sum(self.legg_til(sha) for sha in self.lager.uten_resultat())
+        if gjenopptatt:
+            logger.info(f"Synk: {gjenopptatt} mottatte bilder venter på analyse")
+        return self
+
+    def legg_til(self, sha: str) -> bool:
+        """Legger et mottatt bilde i kø for analyse. False hvis det allerede venter."""
+        with self._lås:
+            if sha in self._i_kø:
+                return False
+            self._i_kø.add(sha)
+        self._venter.put(sha)
+        return True
+
+    def _ledig(self, ko: JobbKo) -> bool:
+        status = ko.status()
+        with self._lås:
+            kjører = self._kjører
+        i_arbeid = status["aktive_arbeidere"] + status["kodybde"]
+        return i_arbeid < ko.kapasitet and kjører < max(1, int(ko.kapasitet * self.andel))
+
+    def _neste(self) -> str:
+        while True:
+            with self._lås:
+                naa = time.time()
+                while self._senere and self._senere[0][0] <= naa:
+                    self._venter.put(heapq.heappop(self._senere)[1])
+            try:
+                return self._venter.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+    def _løkke(self) -> None:
+        while True:
+            sha = self._neste()
+            try:
+                self._send_inn(sha)
+            except Exception as e:
+                # Én feil skal ikke stoppe tråden; bildet prøves igjen senere
+                logger.exception(f"Synk: kunne ikke legge {sha[:12]} i køen")
+                self._feilet(sha, e)
+
+    def _send_inn(self, sha: str) -> None:
+        while True:
+            ko = self.ko()
+            if self._ledig(ko):
+                try:
+                    jobb = ko.send_inn(self.analyser, self.lager.sti(sha), etikett="synk")
+                    break
+                except KoFullError:
+                    pass # Noen kom før oss; vent og prøv igjen
+            time.sleep(self.pause)
+        with self._lås:
+            self._kjører += 1
+        jobb.future.add_done_callback(lambda f, sha=sha, jobb=jobb, ko=ko: self._ferdig(sha, ko, jobb.id, f))
+
+    def _ferdig(self, sha: str, ko: JobbKo, jobb_id: str, future: Any) -> None:
+        ko.glem(jobb_id)
+        with self._lås:
+            self._kjører -= 1
+        try:
+            if future.cancelled():
+                raise RuntimeError("jobben ble avbrutt")
+            if future.exception() is not None:
+                raise future.exception()
+            resultat = future.result()
+            self.lager.lagre_resultat(sha, resultat)
+        except Exception as e:
+            logger.error(f"Synk: analyse av {sha[:12]} feilet: {e}")
+            self._feilet(sha, e)
+            return
+        with self._lås:
+            self._i_kø.discard(sha)
+            self.ferdige += 1
+        if self.ved_resultat is not None:
+            try:
+                self.ved_resultat(sha, resultat)
+            except Exception:
+                logger.exception(f"Synk: ved_resultat feilet for {sha[:12]}") # Resultatet er lagret uansett
+
+    def _feilet(self, sha: str, feil: Exception) -> None:
+        try:
+            forsøk = self.lager.registrer_feil(sha, f"{type(feil).__name__}: {feil}")
+        except OSError:
+            logger.exception(f"Synk: kunne ikke registrere feilen for {sha[:12]}")
+            forsøk = self.maks_forsøk
+        with self._lås:
+            self.feilet += 1
+            if forsøk < self.maks_forsøk:
+                heapq.heappush(self._senere, (time.time() + self.ventetid * 2 ** (forsøk - 1), sha))
+                return
+            self._i_kø.discard(sha) # Gir opp til neste start(); feilen ligger i lageret
+        logger.error(f"Synk: gir opp {sha[:12]} etter {forsøk} forsøk")
+
+    def status(self) -> Dict[str, Any]:
+        with self._lås:
+            return {"venter": self._venter.qsize(), "kjorer": self._kjører, "prover_igjen": len(self._senere),
+                    "ferdige": self.ferdige, "feilet": self.feilet}
+
+    def er_i_kø(self, sha: str) -> bool:
+        with self._lås:
+            return sha in self._i_kø
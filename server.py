@@ -1,29 +1,149 @@
 import os
 import logging
-from flask import Flask, request, jsonify
+import json
+import argparse
+import functools
+from flask import Flask, request, jsonify, Response, stream_with_context, url_for
 from werkzeug.utils import secure_filename
-from modules import bildeanalyse
+from modules import bildeanalyse, metrikker, detektorer, inferenstjeneste, sporing, synk
+from modules.jobbko import JobbKo, KoFullError
+from modules.bildecache import AnalyseCache
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("FlaskServer")
 
-UPLOAD_FOLDER = 'data/uploads'
-TRAINING_FOLDER = 'data/training_raw'
+TRAINING_FOLDER = os.environ.get('TRAINING_FOLDER', 'data/training_raw')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+VIDEO_EXTENSIONS = {'mp4', 'mov', 'm4v', 'avi', 'webm'}
 
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
 if not os.path.exists(TRAINING_FOLDER):
     os.makedirs(TRAINING_FOLDER)
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['TRAINING_FOLDER'] = TRAINING_FOLDER
+# Set SAVE_TRAINING_DATA=0 to skip collecting uploads for ML training
+app.config['SAVE_TRAINING_DATA'] = os.environ.get('SAVE_TRAINING_DATA', '1') != '0'
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# Single background writer: training data is persisted off the request path (see start_services)
+training_writer = None
+
+# Seconds a synchronous request waits before it is handed back as an async job
+app.config['SYNC_TIMEOUT'] = float(os.environ.get('SYNC_TIMEOUT', '30'))
+# Retry-After (seconds) sent with 503 when the work queue is full
+app.config['RETRY_AFTER'] = int(os.environ.get('RETRY_AFTER', '2'))
+
+# Per-stage timers and counters for the vision pipeline, served on /metrics.
+# Set METRICS=0 to switch them off (the hot path then skips all timing).
+metrikker.aktiver(os.environ.get('METRICS', '1') != '0')
+
+# Bounded work queue in front of the CPU-bound analysis. The dev server uses
+# threads (OpenCV releases the GIL); --production swaps in a process pool.
+# Nothing runs until start_services().
+job_queue = JobbKo(modus="tråd")
+
+# Content-addressed result cache. ANALYSIS_CACHE_DIR adds a size-bounded disk tier.
+analysis_cache = AnalyseCache(
+    maks_elementer=int(os.environ.get('ANALYSIS_CACHE_SIZE', '1024')),
+    disk_katalog=os.environ.get('ANALYSIS_CACHE_DIR') or None
+)
+
+def configure_detector(name, model=None, address=None):
+    """Loads the mailbox detector once, warms it up and makes it the default for all analysis."""
+    if name == 'tjeneste':
+        # Shared inference sidecar (python -m modules.inferenstjeneste): one model, batched across workers
+        detector = inferenstjeneste.TjenesteDetektor(inferenstjeneste.les_adresse(address) if address else inferenstjeneste.STANDARD_ADRESSE)
+    else:
+        detector = detektorer.lag_detektor(name, model)
+    detektorer.installer(detector)
+    logger.info(f"Detector: {detector.navn}" + (f" ({model or address})" if model or address else ""))
+    return detector
+
+# Mailbox detector: the threshold-and-contour analysis by default. DETECTOR=onnx with
+# DETECTOR_MODEL=<model.onnx> uses the YOLOv8 model exported by train_model.py;
+# DETECTOR=tjeneste sends images to the inference sidecar at INFERENCE_ADDRESS.
+if os.environ.get('DETECTOR'):
+    configure_detector(os.environ['DETECTOR'], os.environ.get('DETECTOR_MODEL'), os.environ.get('INFERENCE_ADDRESS'))
+
+# Bulk sync for the app's offline queue: resumable, checksummed chunk uploads into a
+# content-addressed store (SYNC_DIR), analysed in the background with spare queue capacity.
+sync_store = synk.SynkLager(os.environ.get('SYNC_DIR', 'data/sync'))
+
+def store_sync_result(sha, results):
+    """Makes background results visible to /analyze as well (same content, same cache key)."""
+    analysis_cache.lagre(analysis_cache.nokkel(sync_store.les(sha), detektorer.aktiv().parametre()), results)
+
+sync_analysis = synk.Bakgrunnsanalyse(sync_store, lambda: job_queue, bildeanalyse.analyser_ett, ved_resultat=store_sync_result,
+                                      andel=float(os.environ.get('SYNC_QUEUE_SHARE', '0.5')))
+
+def configure_job_queue(mode, workers=None, max_waiting=None):
+    """Replaces the work queue, e.g. with a process pool sized to the cores."""
+    global job_queue
+    old = job_queue
+    # Process workers load and warm up the active detector once, when they start
+    job_queue = JobbKo(arbeidere=workers, maks_ventende=max_waiting, modus=mode,
+                       initializer=detektorer.installer, initargs=(detektorer.aktiv(),)).start()
+    old.avslutt(vent=False)
+    logger.info(f"Work queue: {job_queue.arbeidere} {mode} workers, {job_queue.maks_ventende} waiting slots")
+
+def start_services(mode="tråd", workers=None, max_waiting=None):
+    """
+    Starts the work queue, the training-data writer and the sync analysis.
+    Called once from main (or by whatever hosts the app) after the detector is
+    configured. The queue goes first, so process workers are forked before any
+    of the server's own threads exist.
+    """
+    global training_writer
+    if training_writer is not None:
+        return
+    configure_job_queue(mode, workers, max_waiting)
+    training_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="training-writer")
+    sync_analysis.start()
+
+def allowed_file(filename, extensions=ALLOWED_EXTENSIONS):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in extensions
+
+def save_training_image(data, training_folder):
+    """Writes an uploaded image to the training vault. Runs on the background writer."""
+    try:
+        timestamp = int(time.time())
+        unique_id = uuid.uuid4().hex[:8]
+        train_filename = f"training_{timestamp}_{unique_id}.jpg"
+        train_filepath = os.path.join(training_folder, train_filename)
+        
+        with open(train_filepath, 'wb') as dst:
+            dst.write(data)
+            
+        logger.info(f"Image saved for ML training: {train_filepath}")
+    except Exception as e:
+        logger.warning(f"Could not save training data: {e}")
+
+def queue_training_image(data):
+    """Schedules an optional, asynchronous write of the upload to the training vault."""
+    if app.config['SAVE_TRAINING_DATA'] and training_writer is not None:
+        training_writer.submit(save_training_image, data, app.config['TRAINING_FOLDER'])
+
+def serialize_mailboxes(results):
+    """Serializes analyser_bilde output to the JSON shape the app expects."""
+    json_results = []
+    for pk_id, kap_enum in results:
+        json_results.append({
+            "id": pk_id,
+            "kapasitet_klasse": kap_enum.name # "LITEN", "STANDARD", "STOR"
+        })
+    return json_results
+
+def serialize_aggregate(aggregated):
+    """Serializes analyser_bilder_av_oppgang output (one entry per mailbox)."""
+    return [{
+        "id": item["postkasse_id"],
+        "oppgang_id": item["oppgang_id"],
+        "kapasitet_klasse": item["kapasitet_klasse"].name,
+        "antall_observasjoner": item["bilde_info"]["antall_observasjoner"],
+        "konservativt_valg": item["bilde_info"]["konservativt_valg"]
+    } for item in aggregated]
 
 @app.route('/analyze', methods=['POST'])
 def analyze_image():
@@ -39,40 +159,39 @@ def analyze_image():
         return jsonify({"error": "No selected file"}), 400
         
     if file and allowed_file(file.filename):
-        # Original upload logic
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        # Read the upload once; analysis decodes straight from memory
+        data = file.read()
         
-        # --- ML DATA COLLECTION START ---
-        try:
-            timestamp = int(time.time())
-            unique_id = uuid.uuid4().hex[:8]
-            train_filename = f"training_{timestamp}_{unique_id}.jpg"
-            train_filepath = os.path.join(app.config['TRAINING_FOLDER'], train_filename)
-            
-            # Copy/Save for training (The Vault)
-            with open(filepath, 'rb') as src, open(train_filepath, 'wb') as dst:
-                dst.write(src.read())
-                
-            logger.info(f"Image saved for ML training: {train_filepath}")
-        except Exception as e:
-            logger.warning(f"Could not save training data: {e}")
-        # --- ML DATA COLLECTION END ---
+        # --- ML DATA COLLECTION (The Vault) ---
+        queue_training_image(data)
+        
+        logger.info(f"Image received ({len(data)} bytes). Analyzing...")
+        
+        _, cache_key, cached = bildeanalyse.cache_oppslag(data, analysis_cache)
+        if cached is not None:
+            logger.info(f"Cache hit. Found {len(cached)} mailboxes.")
+            json_results = serialize_mailboxes(cached)
+            return jsonify({
+                "success": True,
+                "filename": filename,
+                "postkasser": json_results,
+                "count": len(json_results),
+                "cached": True
+            }), 200
         
-        logger.info(f"Image received and saved to {filepath}. Analyzing...")
+        # Raises KoFullError (-> 503) if the queue is full
+        job = job_queue.send_inn(bildeanalyse.analyser_ett, data, etikett="bilde")
+        remember_result(job, cache_key)
+        if wants_async():
+            return job_accepted(job)
         
         try:
             # Reuse existing MVP module logic
-            results = bildeanalyse.analyser_bilde(filepath)
+            results = job.future.result(timeout=app.config['SYNC_TIMEOUT'])
+            job_queue.glem(job.id)
             
-            # Serialize results
-            json_results = []
-            for pk_id, kap_enum in results:
-                json_results.append({
-                    "id": pk_id,
-                    "kapasitet_klasse": kap_enum.name # "LITEN", "STANDARD", "STOR"
-                })
+            json_results = serialize_mailboxes(results)
             
             response = {
                 "success": True,
@@ -83,19 +202,422 @@ def analyze_image():
             logger.info(f"Analysis success. Found {len(json_results)} mailboxes.")
             return jsonify(response), 200
             
+        except TimeoutError:
+            logger.info(f"Analysis still running after {app.config['SYNC_TIMEOUT']}s, returning job {job.id}")
+            return job_accepted(job)
         except Exception as e:
             logger.error(f"Analysis failed: {e}")
             return jsonify({"error": str(e)}), 500
             
     return jsonify({"error": "Invalid file type. Allowed: png, jpg, jpeg"}), 400
 
+@app.route('/analyze/batch', methods=['POST'])
+def analyze_batch():
+    """
+    Endpoint for analyzing all photos of one entrance in a single request.
+    Expected multipart/form-data with one or more 'images' files and an 'oppgang_id' field.
+    Returns the aggregated (conservative) capacity class per mailbox.
+    
+    With ?stream=1 (or Accept: application/x-ndjson) the response is NDJSON:
+    one line per image as it finishes, then a final line with the aggregate
+    (or an error line). Like /analyze, a batch still running after
+    SYNC_TIMEOUT is handed back as a job (202).
+    """
+    oppgang_id = request.form.get('oppgang_id', '').strip()
+    if not oppgang_id:
+        return jsonify({"error": "Missing oppgang_id"}), 400
+    
+    files = request.files.getlist('images') or request.files.getlist('image')
+    if not files:
+        return jsonify({"error": "No images part"}), 400
+    
+    invalid = [f.filename for f in files if not (f.filename and allowed_file(f.filename))]
+    if invalid:
+        return jsonify({"error": f"Invalid file type for {invalid}. Allowed: png, jpg, jpeg"}), 400
+    
+    images = [f.read() for f in files]
+    filenames = [secure_filename(f.filename) for f in files]
+    for data in images:
+        queue_training_image(data)
+    
+    logger.info(f"Batch received for {oppgang_id}: {len(images)} images. Analyzing...")
+    
+    # Duplicate photos (e.g. re-uploads after a dropped connection) come from the cache
+    lookups = [bildeanalyse.cache_oppslag(data, analysis_cache) for data in images]
+    per_image = [cached for _, _, cached in lookups]
+    missing = [i for i, cached in enumerate(per_image) if cached is None]
+    
+    # Only uncached images are analysed. Batches larger than the whole queue run as
+    # one job in a single worker (key None); otherwise one job per image, reserved
+    # all-or-nothing (KoFullError -> 503). Each finished image fills the cache.
+    if len(missing) > job_queue.kapasitet:
+        job = job_queue.send_inn(bildeanalyse.analyser_bilder, [images[i] for i in missing], etikett="bilder")
+        remember_results(job, [lookups[i][1] for i in missing])
+        pending = {None: job}
+    else:
+        jobs = job_queue.send_inn_mange(bildeanalyse.analyser_ett, [(images[i],) for i in missing], etikett="bilde")
+        pending = dict(zip(missing, jobs))
+        for i, job in pending.items():
+            remember_result(job, lookups[i][1])
+    
+    if wants_async():
+        return job_accepted(collect_batch(per_image, missing, pending, oppgang_id))
+    
+    stream = request.args.get('stream') == '1' or request.accept_mimetypes.best == 'application/x-ndjson'
+    if stream and None not in pending:
+        return Response(stream_with_context(stream_batch(per_image, pending, filenames, oppgang_id)), mimetype='application/x-ndjson')
+    
+    try:
+        deadline = time.monotonic() + app.config['SYNC_TIMEOUT']
+        for i, job in pending.items():
+            result = job.future.result(timeout=max(0.0, deadline - time.monotonic()))
+            job_queue.glem(job.id)
+            place_result(per_image, missing, i, result)
+        aggregated = bildeanalyse.aggreger_observasjoner(per_image, oppgang_id)
+        json_results = serialize_aggregate(aggregated)
+        logger.info(f"Batch analysis success. Found {len(json_results)} mailboxes in {oppgang_id} "
+                    f"({len(images) - len(missing)} of {len(images)} images cached).")
+        return jsonify({
+            "success": True,
+            "oppgang_id": oppgang_id,
+            "antall_bilder": len(images),
+            "postkasser": json_results,
+            "count": len(json_results)
+        }), 200
+    except TimeoutError:
+        logger.info(f"Batch analysis for {oppgang_id} still running after {app.config['SYNC_TIMEOUT']}s, returning a job")
+        return job_accepted(collect_batch(per_image, missing, pending, oppgang_id))
+    except Exception as e:
+        logger.error(f"Batch analysis failed: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/analyze/video', methods=['POST'])
+def analyze_video():
+    """
+    Endpoint for a video sweep along one entrance.
+    Expected multipart/form-data with a 'video' file and an 'oppgang_id' field.
+    Mailboxes are tracked across frames (modules.sporing), so each one is
+    counted once; the response has the same shape as /analyze/batch.
+    """
+    oppgang_id = request.form.get('oppgang_id', '').strip()
+    if not oppgang_id:
+        return jsonify({"error": "Missing oppgang_id"}), 400
+    
+    file = request.files.get('video')
+    if file is None or file.filename == '':
+        return jsonify({"error": "No video part"}), 400
+    if not allowed_file(file.filename, VIDEO_EXTENSIONS):
+        return jsonify({"error": f"Invalid file type. Allowed: {', '.join(sorted(VIDEO_EXTENSIONS))}"}), 400
+    
+    data = file.read()
+    logger.info(f"Video received for {oppgang_id} ({len(data)} bytes). Tracking...")
+    
+    # Raises KoFullError (-> 503) if the queue is full
+    job = job_queue.send_inn(sporing.analyser_video, data, oppgang_id, etikett="oppgang")
+    if wants_async():
+        return job_accepted(job)
+    
+    try:
+        aggregated = job.future.result(timeout=app.config['SYNC_TIMEOUT'])
+        job_queue.glem(job.id)
+        json_results = serialize_aggregate(aggregated)
+        logger.info(f"Video analysis success. Found {len(json_results)} mailboxes in {oppgang_id}.")
+        return jsonify({
+            "success": True,
+            "oppgang_id": oppgang_id,
+            "postkasser": json_results,
+            "count": len(json_results)
+        }), 200
+    except TimeoutError:
+        logger.info(f"Video analysis still running after {app.config['SYNC_TIMEOUT']}s, returning job {job.id}")
+        return job_accepted(job)
+    except Exception as e:
+        logger.error(f"Video analysis failed: {e}")
+        return jsonify({"error": str(e)}), 500
+
+def sync_status(status):
+    """Serializes SynkLager status for the app (English keys, like the rest of the API)."""
+    state = {"ferdig": "complete", "delvis": "partial", "ukjent": "unknown"}[status["status"]]
+    response = {"sha256": status["sha256"], "status": state, "offset": status["mottatt"], "size": status["storrelse"]}
+    if state == "complete":
+        results = sync_store.hent_resultat(status["sha256"])
+        response["analysis"] = "done" if results is not None else "pending"
+        if results is not None:
+            response["postkasser"] = serialize_mailboxes(results)
+        elif (error := sync_store.hent_feil(status["sha256"])) is not None:
+            response["analysis"] = "retrying" if sync_analysis.er_i_kø(status["sha256"]) else "failed"
+            response["analysis_error"] = error["feil"]
+    return response
+
+def sync_received(sha):
+    """Called once per newly completed upload: training copy and background analysis."""
+    _, cache_key, cached = bildeanalyse.cache_oppslag(sync_store.sti(sha), analysis_cache)
+    if cached is not None:
+        sync_store.lagre_resultat(sha, cached) # Seen before via /analyze
+    else:
+        sync_analysis.legg_til(sha)
+    queue_training_image(sync_store.les(sha))
+
+@app.route('/sync/manifest', methods=['POST'])
+def sync_manifest():
+    """
+    First step of a bulk sync. Body (JSON, optionally Content-Encoding: gzip):
+    {"images": [{"sha256": ..., "size": ..., "oppgang_id": ..., "filename": ...}, ...]}
+    
+    Returns the state of every image: "complete" (nothing to send, the server
+    already has these bytes) or "partial" with the offset to continue from.
+    """
+    try:
+        body = json.loads(synk.dekomprimer(request.get_data(), request.headers.get('Content-Encoding')))
+        images = body["images"]
+        states = [sync_status(sync_store.start(item["sha256"], item["size"], item.get("oppgang_id"), item.get("filename")))
+                  for item in images]
+    except synk.ForStor as e:
+        return jsonify({"error": str(e)}), 413
+    except (synk.SynkFeil, ValueError, KeyError, TypeError) as e:
+        return jsonify({"error": f"Invalid manifest: {e}"}), 400
+    
+    missing = sum(s["status"] != "complete" for s in states)
+    logger.info(f"Sync manifest: {len(states)} images, {len(states) - missing} already on the server")
+    return jsonify({"chunk_size": sync_store.maks_bit, "images": states, "missing": missing}), 200
+
+@app.route('/sync/images/<sha>', methods=['PUT'])
+def sync_chunk(sha):
+    """
+    Uploads one chunk. Headers: Upload-Offset (where the chunk starts),
+    X-Chunk-SHA256 (of the uncompressed chunk, required) and optionally Content-Encoding: gzip.
+    
+    409 with the server's offset if the chunk does not continue the upload
+    (e.g. after a dropped response); 422 if a checksum does not match.
+    """
+    try:
+        offset = int(request.headers.get('Upload-Offset', request.args.get('offset', '')))
+    except ValueError:
+        return jsonify({"error": "Missing or invalid Upload-Offset"}), 400
+    if not request.headers.get('X-Chunk-SHA256'):
+        return jsonify({"error": "Missing X-Chunk-SHA256"}), 400
+    if (request.content_length or 0) > sync_store.maks_bit:
+        return jsonify({"error": f"Chunk larger than {sync_store.maks_bit} bytes"}), 413
+    
+    try:
+        data = synk.dekomprimer(request.get_data(), request.headers.get('Content-Encoding'), sync_store.maks_bit)
+        status = sync_store.skriv_bit(sha, offset, data, request.headers.get('X-Chunk-SHA256'))
+    except synk.FeilPosisjon as e:
+        return jsonify({"error": str(e), "offset": e.mottatt}), 409
+    except synk.FeilSjekksum as e:
+        return jsonify({"error": str(e)}), 422
+    except synk.UkjentOpplasting as e:
+        return jsonify({"error": str(e)}), 404
+    except synk.ForStor as e:
+        return jsonify({"error": str(e)}), 413
+    except synk.SynkFeil as e:
+        return jsonify({"error": str(e)}), 400
+    
+    if status.get("ny"):
+        sync_received(sha)
+    return jsonify(sync_status(status)), 200
+
+@app.route('/sync/images/<sha>', methods=['GET'])
+def sync_image_status(sha):
+    """Upload offset (to resume) and, once analysed, the mailboxes found."""
+    try:
+        status = sync_store.status(sha)
+    except synk.SynkFeil as e:
+        return jsonify({"error": str(e)}), 400
+    if status["status"] == "ukjent":
+        return jsonify({"error": "Unknown image"}), 404
+    return jsonify(sync_status(status)), 200
+
+def image_line(i, filename, results, cached=False):
+    return json.dumps({
+        "type": "image",
+        "index": i,
+        "filename": filename,
+        "cached": cached,
+        "postkasser": serialize_mailboxes(results)
+    }) + "\n"
+
+def place_result(per_image, missing, key, result):
+    """Puts a finished job's result in place: one image, or (key None) every missing image of a single-job batch."""
+    if key is None:
+        for i, image_result in zip(missing, result):
+            per_image[i] = image_result
+    else:
+        per_image[key] = result
+
+def combine_batch(per_image, missing, keys, oppgang_id, results):
+    """Fills in the analysed images and aggregates the entrance (for a batch handed back as a job)."""
+    per_image = list(per_image)
+    for key, result in zip(keys, results):
+        place_result(per_image, missing, key, result)
+    return bildeanalyse.aggreger_observasjoner(per_image, oppgang_id)
+
+def collect_batch(per_image, missing, pending, oppgang_id):
+    """One job id for the whole entrance; it finishes when the last image does. Cached images are merged in."""
+    return job_queue.samle(list(pending.values()),
+                           functools.partial(combine_batch, list(per_image), missing, list(pending), oppgang_id),
+                           etikett="oppgang")
+
+def stream_batch(per_image, pending, filenames, oppgang_id):
+    """
+    Yields one NDJSON line per analysed image (cached first, then completion order), then the aggregate.
+    If anything fails the last line is {"type": "error", ...} instead, so a client can tell a
+    failed stream from a finished one.
+    """
+    try:
+        for i, results in enumerate(per_image):
+            if results is not None:
+                yield image_line(i, filenames[i], results, cached=True)
+        
+        futures = {job.future: i for i, job in pending.items()}
+        for future in as_completed(futures):
+            i = futures[future]
+            per_image[i] = future.result()
+            job_queue.glem(pending[i].id)
+            yield image_line(i, filenames[i], per_image[i])
+        
+        json_results = serialize_aggregate(bildeanalyse.aggreger_observasjoner(per_image, oppgang_id))
+    except Exception as e:
+        logger.error(f"Streaming batch analysis for {oppgang_id} failed: {e}")
+        yield json.dumps({"type": "error", "success": False, "oppgang_id": oppgang_id, "error": str(e)}) + "\n"
+        return
+    yield json.dumps({
+        "type": "result",
+        "success": True,
+        "oppgang_id": oppgang_id,
+        "antall_bilder": len(per_image),
+        "postkasser": json_results,
+        "count": len(json_results)
+    }) + "\n"
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Polling endpoint for async analysis jobs."""
+    job = job_queue.hent(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    
+    response = {"job_id": job.id, "status": job.status}
+    if job.status == "ferdig":
+        result = job.future.result()
+        if job.etikett == "oppgang":
+            json_results = serialize_aggregate(result)
+        else:
+            json_results = serialize_mailboxes(result)
+        response.update({"success": True, "postkasser": json_results, "count": len(json_results)})
+    elif job.status == "feilet":
+        error = "Job was cancelled" if job.future.cancelled() else str(job.future.exception())
+        response.update({"success": False, "error": error})
+    return jsonify(response), 200
+
+def remember_result(job, cache_key):
+    """Stores the job result in the analysis cache once it finishes (sync or async)."""
+    if cache_key is None:
+        return
+    def store(future):
+        if not future.cancelled() and future.exception() is None:
+            analysis_cache.lagre(cache_key, future.result())
+    job.future.add_done_callback(store)
+
+def remember_results(job, cache_keys):
+    """Like remember_result, for a job that returns one result per image."""
+    def store(future):
+        if not future.cancelled() and future.exception() is None:
+            for cache_key, result in zip(cache_keys, future.result()):
+                if cache_key is not None:
+                    analysis_cache.lagre(cache_key, result)
+    job.future.add_done_callback(store)
+
+def wants_async():
+    return request.args.get('async') == '1'
+
+def job_accepted(job):
+    """202 response pointing the client at the polling endpoint."""
+    status_url = url_for('job_status', job_id=job.id)
+    response = jsonify({"job_id": job.id, "status": job.status, "status_url": status_url})
+    response.headers['Location'] = status_url
+    return response, 202
+
+@app.errorhandler(KoFullError)
+def queue_full(e):
+    logger.warning(f"Rejected request: {e}")
+    response = jsonify({"error": "Server busy, try again later"})
+    response.headers['Retry-After'] = str(app.config['RETRY_AFTER'])
+    return response, 503
+
+def queue_and_cache_metrics():
+    """Work queue and cache state as Prometheus gauges/counters."""
+    queue = job_queue.status()
+    cache = analysis_cache.statistikk()
+    values = [
+        ("pkasse_queue_workers", "gauge", "Analysis workers", queue["arbeidere"]),
+        ("pkasse_queue_active_workers", "gauge", "Workers busy with a job", queue["aktive_arbeidere"]),
+        ("pkasse_queue_depth", "gauge", "Jobs waiting for a worker", queue["kodybde"]),
+        ("pkasse_queue_completed_total", "counter", "Finished jobs", queue["fullforte_jobber"]),
+        ("pkasse_queue_rejected_total", "counter", "Jobs rejected with 503", queue["avviste_jobber"]),
+        ("pkasse_cache_hits_total", "counter", "Analysis cache hits", cache["treff"]),
+        ("pkasse_cache_misses_total", "counter", "Analysis cache misses", cache["bom"]),
+        ("pkasse_cache_entries", "gauge", "Entries in the in-memory cache", cache["elementer_minne"]),
+    ]
+    lines = []
+    for name, kind, help_text, value in values:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of pipeline timings, queue and cache."""
+    body = metrikker.prometheus() + queue_and_cache_metrics()
+    detector = detektorer.aktiv()
+    if isinstance(detector, inferenstjeneste.TjenesteDetektor):
+        try:
+            body += inferenstjeneste.prometheus(detector.statistikk())
+        except (ConnectionError, TimeoutError) as e:
+            logger.warning(f"Inference sidecar stats unavailable: {e}")
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({"status": "running", "message": "Postkasse Vision API Ready"}), 200
+    return jsonify({"status": "running", "message": "Postkasse Vision API Ready", "detector": detektorer.aktiv().navn,
+                    "queue": job_queue.status(), "cache": analysis_cache.statistikk(), "sync": sync_analysis.status()}), 200
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Postkasse Vision API")
+    parser.add_argument('--production', action='store_true', help="Process-pool workers, no debug/reloader")
+    parser.add_argument('--workers', type=int, default=None, help="Analysis workers (default: CPU count)")
+    parser.add_argument('--queue-size', type=int, default=None, help="Waiting jobs before 503 (default: 4 x workers)")
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--detector', choices=['kontur', 'onnx', 'tjeneste'], default=os.environ.get('DETECTOR', 'kontur'))
+    parser.add_argument('--model', default=os.environ.get('DETECTOR_MODEL'), help="ONNX model for --detector onnx")
+    parser.add_argument('--inference-address', default=os.environ.get('INFERENCE_ADDRESS'),
+                        help="host:port or socket path of the sidecar for --detector tjeneste")
+    args = parser.parse_args()
+    
+    # Load the model before the workers start, so they warm up the same detector
+    if args.detector != detektorer.aktiv().navn:
+        configure_detector(args.detector, args.model, args.inference_address)
+        
     # Host on 0.0.0.0 to enable access from devices on the same network
     print("\nStarting Flask Server...")
     print("Ensure your iPhone is on the same Wi-Fi.")
-    print("Endpoint: http://<YOUR_IP>:5001/analyze\n")
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    print(f"Endpoint: http://<YOUR_IP>:{args.port}/analyze")
+    print(f"Batch:    http://<YOUR_IP>:{args.port}/analyze/batch\n")
+    
+    if args.production:
+        start_services("prosess", workers=args.workers, max_waiting=args.queue_size)
+        try:
+            from waitress import serve
+        except ImportError:
+            serve = None
+        if serve is not None:
+            # Request threads mostly wait on the queue, so allow more than the worker count
+            serve(app, host='0.0.0.0', port=args.port, threads=job_queue.kapasitet)
+        else:
+            logger.info("waitress not installed, using the threaded Werkzeug server")
+            app.run(host='0.0.0.0', port=args.port, debug=False, threaded=True)
+    else:
+        # The reloader runs main() in a watcher process and again in the serving child;
+        # only the child (WERKZEUG_RUN_MAIN) gets the queue and background threads
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_services("tråd", workers=args.workers, max_waiting=args.queue_size)
+        app.run(host='0.0.0.0', port=args.port, debug=True)
@@ -0,0 +1,284 @@
+import os
+import sys
+import json
+import time
+import fnmatch
+import argparse
+import platform
+import resource
+import subprocess
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+
+# Paths
+HISTORY_FILE = 'data/benchmarks/history.json'
+BASELINE_FILE = 'data/benchmarks/baseline.json'
+
+# A benchmark is flagged when median latency or peak RSS grows more than this
+DEFAULT_THRESHOLD = 0.20
+
+# --- Benchmark definitions ---
+# Each setup function builds its inputs (not timed) and returns (fn, units per call).
+# All inputs are seeded, so every run measures the same work.
+
+def _shelf_jpeg(width, height):
+    import cv2
+    from modules import bildeanalyse
+    image = bildeanalyse.generer_test_bilde(shift_x=2, shift_y=-3, stoy_faktor=0.05, rng=np.random.default_rng(0))
+    image = cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR)
+    return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+def setup_analyze_image(width, height):
+    from modules import bildeanalyse
+    data = _shelf_jpeg(width, height)
+    return (lambda: bildeanalyse.analyser_bilde(data)), 1
+
+def setup_analyze_entrance(n_images):
+    from modules import bildeanalyse
+    rng = np.random.default_rng(0)
+    shifts = rng.integers(-5, 6, size=(n_images, 2))
+    images = list(bildeanalyse.generer_test_bilder_batch(n_images, 0.05, shifts, rng=rng))
+    return (lambda: bildeanalyse.analyser_bilder_av_oppgang(images, "BENCH-1")), n_images
+
+def _route(n_packages):
+    from modules import simulation_utils
+    from modules.datamodel import Postkasse, KapasitetKlasse
+    configs, packages = simulation_utils.generer_syntetiske_ruter(1000, 11, n_packages, seed=0)
+    rng = np.random.default_rng(0)
+    verified_at = datetime.now()
+    mailboxes = [
+        Postkasse(id=pk_id, oppgang_id=conf["id"], kapasitet_klasse=KapasitetKlasse(int(k)), sist_verifisert=verified_at)
+        for conf in configs
+        for pk_id, k in zip(conf["expected_pk_ids"], rng.integers(1, 4, size=len(conf["expected_pk_ids"])))
+    ]
+    return packages, mailboxes
+
+def setup_simulate_route(n_packages):
+    from modules import leveringslogikk
+    packages, mailboxes = _route(n_packages)
+    return (lambda: leveringslogikk.simuler_rute(packages, mailboxes)), n_packages
+
+def setup_simulate_batch(n_packages):
+    # Object-based simuler_rute at 1e7 needs several GB; this measures the array engine instead
+    from modules import leveringslogikk
+    rng = np.random.default_rng(0)
+    n_mailboxes = 11000
+    volume = rng.integers(1, 4, size=n_packages, dtype=np.uint8)
+    recipient = rng.integers(-1, n_mailboxes, size=n_packages)
+    capacity = rng.integers(1, 4, size=n_mailboxes, dtype=np.uint8)
+    return (lambda: leveringslogikk.simuler_rute_batch(volume, recipient, capacity)), n_packages
+
+def setup_generate_routes(n_packages):
+    from modules import simulation_utils
+    return (lambda: simulation_utils.generer_syntetiske_ruter(1000, 11, n_packages, seed=0)), n_packages
+
+def setup_generate_route_columns(n_packages):
+    from modules import simulation_utils
+    return (lambda: simulation_utils.generer_syntetiske_ruter_kolonner(1000, 11, n_packages, seed=0, zipf_a=1.1)), n_packages
+
+def setup_serve_analyze(n_requests):
+    import io
+    import atexit
+    import shutil
+    import tempfile
+    # Keep the server's sync store and training folder out of data/, and the
+    # analysis cache in memory, so tom() below never clears a shared disk cache
+    scratch = tempfile.mkdtemp(prefix="pkasse-bench-")
+    atexit.register(shutil.rmtree, scratch, True)
+    os.environ['SYNC_DIR'] = os.path.join(scratch, 'sync')
+    os.environ['TRAINING_FOLDER'] = os.path.join(scratch, 'training_raw')
+    os.environ['SAVE_TRAINING_DATA'] = '0'
+    os.environ['ANALYSIS_CACHE_DIR'] = ''
+    import server
+    server.start_services()
+    client = server.app.test_client()
+    data = _shelf_jpeg(1920, 1080)
+
+    def run():
+        for _ in range(n_requests):
+            server.analysis_cache.tom() # Measure analysis, not cache hits
+            response = client.post('/analyze', data={'image': (io.BytesIO(data), 'bench.jpg')},
+                                   content_type='multipart/form-data')
+            assert response.status_code == 200, response.status_code
+    return run, n_requests
+
+BENCHMARKS = {
+    "analyze_image_640x480": (setup_analyze_image, (640, 480), 30),
+    "analyze_image_1920x1080": (setup_analyze_image, (1920, 1080), 20),
+    "analyze_image_4032x3024": (setup_analyze_image, (4032, 3024), 10),
+    "analyze_entrance_1": (setup_analyze_entrance, (1,), 30),
+    "analyze_entrance_5": (setup_analyze_entrance, (5,), 10),
+    "analyze_entrance_10": (setup_analyze_entrance, (10,), 5),
+    "simulate_route_1e3": (setup_simulate_route, (1_000,), 30),
+    "simulate_route_1e5": (setup_simulate_route, (100_000,), 5),
+    "simulate_route_1e6": (setup_simulate_route, (1_000_000,), 3),
+    "simulate_batch_1e7": (setup_simulate_batch, (10_000_000,), 5),
+    "generate_routes_1e3": (setup_generate_routes, (1_000,), 30),
+    "generate_routes_1e5": (setup_generate_routes, (100_000,), 5),
+    "generate_route_columns_1e7": (setup_generate_route_columns, (10_000_000,), 5),
+    "serve_analyze_20req": (setup_serve_analyze, (20,), 5),
+}
+
+# --- Measurement ---
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def run_one(name, repeat=None):
+    """Runs a single benchmark in this process and returns its measurements."""
+    import logging
+    logging.disable(logging.INFO) # The modules log every image
+
+    setup, args, default_repeat = BENCHMARKS[name]
+    repeat = repeat or default_repeat
+    fn, units = setup(*args)
+    fn() # Warm-up (imports, caches, allocator)
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    median = float(np.median(timings))
+    return {
+        "repeat": repeat,
+        "median_s": median,
+        "p95_s": float(np.percentile(timings, 95)),
+        "min_s": float(min(timings)),
+        "throughput_per_s": units / median if median > 0 else 0.0,
+        "units": units,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def run_isolated(name, repeat=None):
+    """Runs a benchmark in a fresh interpreter, so peak RSS is its own."""
+    cmd = [sys.executable, os.path.abspath(__file__), '--run-one', name]
+    if repeat:
+        cmd += ['--repeat', str(repeat)]
+    proc = subprocess.run(cmd, cwd=ROOT, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return {"error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit {proc.returncode}"}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+# --- History and baseline ---
+
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+def save_json(path, data):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+def find_regressions(results, baseline, threshold):
+    """Returns [(name, metric, baseline value, new value)] for everything that got worse than threshold."""
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get("results", {}).get(name)
+        if not base or "error" in res or "error" in base:
+            continue
+        for metric in ("median_s", "peak_rss_mb"):
+            if res[metric] > base[metric] * (1 + threshold):
+                regressions.append((name, metric, base[metric], res[metric]))
+    return regressions
+
+def print_table(results, baseline):
+    base_results = baseline.get("results", {}) if baseline else {}
+    print(f"\n{'Benchmark':<26} {'median ms':>10} {'p95 ms':>10} {'units/s':>12} {'peak MB':>9} {'vs base':>9}")
+    for name, res in results.items():
+        if "error" in res:
+            print(f"{name:<26} ERROR: {res['error']}")
+            continue
+        base = base_results.get(name)
+        delta = f"{(res['median_s'] / base['median_s'] - 1) * 100:+.0f}%" if base and "median_s" in base else ""
+        print(f"{name:<26} {res['median_s'] * 1000:>10.2f} {res['p95_s'] * 1000:>10.2f} "
+              f"{res['throughput_per_s']:>12.1f} {res['peak_rss_mb']:>9.1f} {delta:>9}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the vision, simulation and serving hot paths")
+    parser.add_argument('--only', nargs='+', help="Benchmark names or glob patterns (e.g. 'analyze_*')")
+    parser.add_argument('--repeat', type=int, help="Override the number of timed repetitions")
+    parser.add_argument('--list', action='store_true', help="List benchmarks and exit")
+    parser.add_argument('--history', default=HISTORY_FILE, help="JSON file every run is appended to")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="Baseline to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="Store this run as the new baseline")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="Allowed slowdown before flagging (0.2 = 20%%)")
+    parser.add_argument('--fail-on-regression', action='store_true', help="Exit with status 1 if anything regressed")
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one, args.repeat)))
+        return 0
+
+    if args.list:
+        for name in BENCHMARKS:
+            print(name)
+        return 0
+
+    names = list(BENCHMARKS)
+    if args.only:
+        names = [n for n in names if any(fnmatch.fnmatch(n, pat) or n == pat for pat in args.only)]
+        if not names:
+            print(f"No benchmarks match {args.only}. Use --list to see them.")
+            return 2
+
+    results = {}
+    for name in names:
+        print(f"Running {name}...", flush=True)
+        results[name] = run_isolated(name, args.repeat)
+
+    baseline = load_json(args.baseline, None)
+    print_table(results, baseline)
+
+    run = {
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    history = load_json(args.history, [])
+    history.append(run)
+    save_json(args.history, history)
+    print(f"\nAppended run to {args.history}")
+
+    if args.save_baseline:
+        save_json(args.baseline, run)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if baseline:
+        regressions = find_regressions(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nREGRESSIONS vs baseline {baseline.get('commit')} (threshold {args.threshold:.0%}):")
+            for name, metric, old, new in regressions:
+                print(f"  {name}: {metric} {old:.4g} -> {new:.4g} ({(new / old - 1) * 100:+.0f}%)")
+            if args.fail_on_regression:
+                return 1
+        else:
+            print(f"\nNo regressions vs baseline {baseline.get('commit')} (threshold {args.threshold:.0%}).")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
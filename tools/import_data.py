@@ -1,60 +1,261 @@
 import os
-import shutil
-import time
-import uuid
+import io
 import sys
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import cv2
+import numpy as np
 
 # Paths
 IMPORT_SOURCE = 'data/import_queue'
 TRAINING_DEST = 'data/training_raw'
-ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.heic'}
+MANIFEST_FILE = os.path.join(TRAINING_DEST, 'import_manifest.jsonl')
+ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.avif', '.bmp', '.tif', '.tiff', '.heic', '.heif'}
+
+# Output format
+JPEG_QUALITY = 92
+# Images within this many differing dHash bits count as the same photo (negative = exact bytes only)
+DEFAULT_MAX_DISTANCE = 4
 
 def setup_dirs():
     if not os.path.exists(IMPORT_SOURCE):
         os.makedirs(IMPORT_SOURCE)
         print(f"Created source folder: {IMPORT_SOURCE}")
         print(f"-> DROP YOUR WEB IMAGES OR AIRDROP PHOTOS HERE <-")
-    
+        
     if not os.path.exists(TRAINING_DEST):
         os.makedirs(TRAINING_DEST)
         print(f"Created destination folder: {TRAINING_DEST}")
 
-def process_import():
-    setup_dirs()
-    
-    files = [f for f in os.listdir(IMPORT_SOURCE) if os.path.isfile(os.path.join(IMPORT_SOURCE, f))]
-    valid_files = [f for f in files if os.path.splitext(f)[1].lower() in ALLOWED_EXTENSIONS]
+# --- Worker side (runs in the process pool) ---
+
+def decode_heic(data):
+    # OpenCV has no HEIC decoder; pillow-heif is optional
+    try:
+        import pillow_heif
+    except ImportError:
+        raise ValueError("HEIC needs pillow-heif (pip install pillow-heif)")
+    rgb = np.asarray(pillow_heif.open_heif(io.BytesIO(data), convert_hdr_to_8bit=True))
+    code = cv2.COLOR_RGBA2BGR if rgb.ndim == 3 and rgb.shape[2] == 4 else cv2.COLOR_RGB2BGR
+    return cv2.cvtColor(rgb, code)
+
+def decode_image(data, ext):
+    if ext in ('.heic', '.heif'):
+        return decode_heic(data)
+    # IMREAD_COLOR applies the EXIF orientation and drops alpha
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("could not decode image")
+    return image
+
+def dhash(image):
+    """64-bit difference hash: is each pixel brighter than its right neighbour in a 9x8 thumbnail."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def convert_one(src_path, tmp_path, max_side):
+    """
+    Decodes one queued file, writes it as a normalised JPEG to tmp_path and
+    returns its hashes. The caller decides whether to keep it.
+    """
+    with open(src_path, 'rb') as f:
+        data = f.read()
+    sha256 = hashlib.sha256(data).hexdigest()
+    image = decode_image(data, os.path.splitext(src_path)[1].lower())
     
-    if not valid_files:
-        print(f"\nNo valid images found in {IMPORT_SOURCE}.")
-        print("Please add .jpg, .png, or .heic files and run again.")
-        return
+    height, width = image.shape[:2]
+    if max_side and max(height, width) > max_side:
+        scale = max_side / max(height, width)
+        image = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        
+    ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not ok:
+        raise ValueError("could not encode JPEG")
+    with open(tmp_path, 'wb') as f:
+        f.write(jpeg.tobytes())
+    return {"sha256": sha256, "dhash": dhash(image), "width": image.shape[1], "height": image.shape[0]}
 
-    print(f"\nFound {len(valid_files)} images to import...")
+# --- Manifest ---
+
+def file_key(entry):
+    st = entry.stat()
+    return f"{entry.name}:{st.st_size}:{st.st_mtime_ns}"
+
+class NearDuplicateIndex:
+    """
+    Finds stored dHashes within max_distance bits of a new one without comparing
+    against all of them. The 64 bits are split into max_distance + 1 bands; two
+    hashes that differ in at most max_distance bits must agree exactly on at
+    least one band, so only images sharing a band value are compared.
+    """
     
-    count = 0
-    for filename in valid_files:
-        src_path = os.path.join(IMPORT_SOURCE, filename)
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        n_bands = min(max_distance + 1, 64) if max_distance >= 0 else 0
+        edges = [round(i * 64 / n_bands) for i in range(n_bands + 1)] if n_bands else []
+        self.bands = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(edges, edges[1:])] # (shift, mask)
+        self.tables = [{} for _ in self.bands]
+        self.hashes = []
+        self.names = []
         
-        # Generate new name
-        timestamp = int(time.time())
-        unique_id = uuid.uuid4().hex[:8]
-        ext = os.path.splitext(filename)[1].lower()
-        if ext == '.heic': ext = '.jpg' # Simple conversion assumption for naming, though conversion needs lib
+    def add(self, value, name):
+        i = len(self.hashes)
+        self.hashes.append(value)
+        self.names.append(name)
+        for table, (shift, mask) in zip(self.tables, self.bands):
+            table.setdefault((value >> shift) & mask, []).append(i)
+            
+    def nearest(self, value):
+        """Closest stored image as (name, distance), or None if none is within max_distance."""
+        best = None
+        for table, (shift, mask) in zip(self.tables, self.bands):
+            for i in table.get((value >> shift) & mask, ()):
+                distance = (self.hashes[i] ^ value).bit_count()
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (self.names[i], distance)
+        return best
+
+class Manifest:
+    """
+    Append-only JSONL log of every processed file. Each line is written as soon
+    as a file is done, so an interrupted run resumes where it stopped, and the
+    stored hashes dedupe against everything imported in earlier runs.
+    """
+    
+    def __init__(self, path, max_distance):
+        self.path = path
+        self.done = {}    # file key -> status
+        self.sha256 = {}  # source hash -> imported file name
+        self.similar = NearDuplicateIndex(max_distance)
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        self._add(json.loads(line))
+        self._file = open(path, 'a')
         
-        new_name = f"training_imported_{timestamp}_{unique_id}{ext}"
-        dest_path = os.path.join(TRAINING_DEST, new_name)
+    def _add(self, record):
+        self.done[record["key"]] = record["status"]
+        if record["status"] == "imported":
+            self.sha256[record["sha256"]] = record["dest"]
+            self.similar.add(int(record["dhash"], 16), record["dest"])
+            
+    def record(self, record):
+        self._add(record)
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
         
-        try:
-            # Move and rename
-            shutil.move(src_path, dest_path)
-            print(f"Imported: {filename} -> {new_name}")
-            count += 1
-        except Exception as e:
-            print(f"Error importing {filename}: {e}")
+    def close(self):
+        self._file.close()
+
+# --- Driver ---
+
+def scan_queue(source, manifest, retry_failed):
+    # os.scandir streams entries and gives stat() without an extra syscall on most platforms
+    with os.scandir(source) as entries:
+        for entry in entries:
+            if not entry.is_file() or os.path.splitext(entry.name)[1].lower() not in ALLOWED_EXTENSIONS:
+                continue
+            key = file_key(entry)
+            status = manifest.done.get(key)
+            if status is None or (status == "failed" and retry_failed):
+                yield entry.path, key
+
+def finish(manifest, src_path, key, tmp_path, result, args, stats):
+    name = os.path.basename(src_path)
+    record = {"key": key, "source": name}
+    
+    if isinstance(result, Exception):
+        record.update(status="failed", error=str(result))
+        stats["failed"] += 1
+        print(f"Error importing {name}: {result}")
+    else:
+        record.update(sha256=result["sha256"], dhash=f"{result['dhash']:016x}")
+        duplicate_of = manifest.sha256.get(result["sha256"])
+        near = None if duplicate_of else manifest.similar.nearest(result["dhash"])
+        if duplicate_of or near:
+            record.update(status="duplicate", duplicate_of=duplicate_of or near[0])
+            if near:
+                record["distance"] = near[1]
+            stats["duplicate"] += 1
+            print(f"Duplicate:  {name} = {record['duplicate_of']}")
+        else:
+            # Named by content, so a re-run can never create a second copy
+            dest = f"training_imported_{result['sha256'][:16]}.jpg"
+            os.replace(tmp_path, os.path.join(args.dest, dest))
+            record.update(status="imported", dest=dest, width=result["width"], height=result["height"])
+            stats["imported"] += 1
+            print(f"Imported:   {name} -> {dest}")
             
-    print(f"\nSuccess! Imported {count} images to {TRAINING_DEST}.")
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    manifest.record(record)
+    # The queue is an inbox: once the outcome is in the manifest, the source can go
+    if record["status"] != "failed" and not args.keep_source:
+        os.remove(src_path)
+
+def _result(future):
+    try:
+        return future.result()
+    except Exception as e:
+        return e
+
+def process_import(args):
+    setup_dirs()
+    os.makedirs(args.dest, exist_ok=True)
+    manifest = Manifest(args.manifest, args.max_distance)
+    stats = {"imported": 0, "duplicate": 0, "failed": 0}
+    workers = args.workers or os.cpu_count() or 1
+    max_in_flight = workers * 4 # Bounded, so a 100k queue is never submitted all at once
+    
+    pending = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for n, (src_path, key) in enumerate(scan_queue(args.source, manifest, args.retry_failed)):
+                tmp_path = os.path.join(args.dest, f".import_{os.getpid()}_{n}.jpg.tmp")
+                pending[pool.submit(convert_one, src_path, tmp_path, args.max_side)] = (src_path, key, tmp_path)
+                if len(pending) >= max_in_flight:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(manifest, *pending.pop(future), _result(future), args, stats)
+            for future in list(pending):
+                finish(manifest, *pending.pop(future), _result(future), args, stats)
+    finally:
+        manifest.close()
+        
+    total = sum(stats.values())
+    if total == 0:
+        print(f"\nNo new images found in {args.source}.")
+        print(f"Supported formats: {', '.join(sorted(ALLOWED_EXTENSIONS))}")
+        return stats
+        
+    print(f"\nImported {stats['imported']} images to {args.dest} "
+          f"({stats['duplicate']} duplicates skipped, {stats['failed']} failed).")
+    if stats["failed"]:
+        print("Failed files stay in the queue; run again with --retry-failed after fixing them.")
     print("These are now ready for training.")
+    return stats
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Import queued photos as normalised, deduplicated JPEGs")
+    parser.add_argument('--source', default=IMPORT_SOURCE)
+    parser.add_argument('--dest', default=TRAINING_DEST)
+    parser.add_argument('--manifest', default=None, help=f"Default: <dest>/{os.path.basename(MANIFEST_FILE)}")
+    parser.add_argument('--workers', type=int, default=None, help="Decoder processes (default: CPU count)")
+    parser.add_argument('--max-side', type=int, default=0, help="Downscale so the longest side is at most this (0 = keep size)")
+    parser.add_argument('--max-distance', type=int, default=DEFAULT_MAX_DISTANCE,
+                        help="dHash bits that may differ for a near-duplicate (-1 = exact duplicates only)")
+    parser.add_argument('--keep-source', action='store_true', help="Leave processed files in the queue")
+    parser.add_argument('--retry-failed', action='store_true', help="Try files that failed in an earlier run again")
+    args = parser.parse_args(argv)
+    args.manifest = args.manifest or os.path.join(args.dest, os.path.basename(MANIFEST_FILE))
+    return args
 
 if __name__ == "__main__":
-    process_import()
+    stats = process_import(parse_args())
+    sys.exit(1 if stats["failed"] else 0)
@@ -1,79 +1,228 @@
 import os
+import json
 import shutil
-import random
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 
 # Paths
 RAW_DIR = 'data/training_raw'
 DATASET_DIR = 'data/dataset'
-IMAGES_DIR = os.path.join(DATASET_DIR, 'images')
-LABELS_DIR = os.path.join(DATASET_DIR, 'labels')
-
-def setup_directories():
-    # Clean recreate
-    if os.path.exists(DATASET_DIR):
-        shutil.rmtree(DATASET_DIR)
-    
-    for split in ['train', 'val']:
-        os.makedirs(os.path.join(IMAGES_DIR, split), exist_ok=True)
-        os.makedirs(os.path.join(LABELS_DIR, split), exist_ok=True)
+MANIFEST_NAME = 'dataset_manifest.json'
+IMAGE_EXTENSIONS = ('.jpg', '.png')
+
+# Share of pairs in the validation set. The split is decided by the image hash,
+# so a pair never moves between train and val when the corpus grows.
+DEFAULT_VAL_FRACTION = 0.2
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def split_for(sha256, val_fraction):
+    """Deterministic split: the first 32 bits of the hash as a number in [0, 1)."""
+    return 'val' if int(sha256[:8], 16) / 2**32 < val_fraction else 'train'
+
+def link_or_copy(src, dst):
+    """Hardlink (no bytes copied); plain copy across filesystems or where links are unsupported."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        shutil.copyfile(src, dst)
+        return False
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# --- Manifest ---
+
+class Manifest:
+    """
+    State of the built dataset, keyed by image content hash:
+        pairs: {sha256: {"image", "label", "label_sha256", "split"}}
+        files: {file name in RAW_DIR: [size, mtime_ns, sha256]}
+    The file index lets unchanged files skip hashing; the pairs say what is
+    linked where, so only differences have to be applied.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pairs = {}
+        self.files = {}
+        self.val_fraction = None
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.pairs = data.get("pairs", {})
+            self.files = {name: tuple(v) for name, v in data.get("files", {}).items()}
+            self.val_fraction = data.get("val_fraction")
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({"val_fraction": self.val_fraction, "pairs": self.pairs,
+                       "files": {name: list(v) for name, v in self.files.items()}}, f)
+        os.replace(tmp, self.path)
+
+# --- Build ---
+
+def scan_pairs(raw_dir):
+    """{image name: (image entry, label entry)} for every image with a matching .txt."""
+    images, labels = {}, {}
+    with os.scandir(raw_dir) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            base, ext = os.path.splitext(entry.name)
+            if ext in IMAGE_EXTENSIONS:
+                images.setdefault(base, entry) # Same base name twice: the first one wins, as before
+            elif ext == '.txt':
+                labels[base] = entry
+    return {images[base].name: (images[base], labels[base]) for base in sorted(images) if base in labels}
+
+def hash_changed(entries, manifest, workers, rehash):
+    """Hashes files whose size or mtime differ from the manifest (in parallel) and updates the file index."""
+    todo = []
+    for entry in entries:
+        st = entry.stat()
+        known = manifest.files.get(entry.name)
+        if rehash or not known or known[0] != st.st_size or known[1] != st.st_mtime_ns:
+            todo.append((entry, st))
+    with ThreadPoolExecutor(max_workers=workers) as pool: # hashlib releases the GIL
+        for (entry, st), sha in zip(todo, pool.map(file_hash, [e.path for e, _ in todo])):
+            manifest.files[entry.name] = (st.st_size, st.st_mtime_ns, sha)
+    return len(todo)
+
+def dest_paths(dataset_dir, pair):
+    return (os.path.join(dataset_dir, 'images', pair["split"], pair["image"]),
+            os.path.join(dataset_dir, 'labels', pair["split"], pair["label"]))
+
+def remove_stale(dataset_dir, manifest):
+    """Deletes files in the split folders the manifest does not know (e.g. copies from the old full rebuild)."""
+    known = {path for pair in manifest.pairs.values() for path in dest_paths(dataset_dir, pair)}
+    removed = 0
+    for kind in ('images', 'labels'):
+        for split in ('train', 'val'):
+            with os.scandir(os.path.join(dataset_dir, kind, split)) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.path not in known:
+                        os.remove(entry.path)
+                        removed += 1
+    return removed
+
+def read_classes(raw_dir):
+    classes = ['postkasse'] # Default if file missing
+    classes_file = os.path.join(raw_dir, 'classes.txt')
+    if os.path.exists(classes_file):
+        with open(classes_file, 'r') as f:
+            classes = [line.strip() for line in f.readlines() if line.strip()]
+    return classes
 
-def create_yaml_config(classes):
+def write_yaml_config(dataset_dir, classes):
     data_yaml = {
-        'path': os.path.abspath(DATASET_DIR),
+        'path': os.path.abspath(dataset_dir),
         'train': 'images/train',
         'val': 'images/val',
         'nc': len(classes),
         'names': classes
     }
-    
-    with open(os.path.join(DATASET_DIR, 'data.yaml'), 'w') as f:
-        yaml.dump(data_yaml, f, default_flow_style=False)
-    
-    print(f"Created data.yaml with classes: {classes}")
-
-def prepare_data():
-    setup_directories()
-    
-    # Gather paired files (image + txt)
-    files = [f for f in os.listdir(RAW_DIR) if f.endswith('.jpg') or f.endswith('.png')]
-    paired_files = []
-    
-    # Read classes.txt if exists
-    classes = ['postkasse'] # Default if file missing
-    classes_file = os.path.join(RAW_DIR, 'classes.txt')
-    if os.path.exists(classes_file):
-        with open(classes_file, 'r') as f:
-            classes = [line.strip() for line in f.readlines() if line.strip()]
-            
-    for img_file in files:
-        basename = os.path.splitext(img_file)[0]
-        txt_file = basename + '.txt'
-        
-        if os.path.exists(os.path.join(RAW_DIR, txt_file)):
-            paired_files.append((img_file, txt_file))
-            
-    # Shuffle and Split
-    random.shuffle(paired_files)
-    split_idx = int(len(paired_files) * 0.8) # 80% train
-    
-    train_set = paired_files[:split_idx]
-    val_set = paired_files[split_idx:]
-    
-    print(f"Total pairs: {len(paired_files)}")
-    print(f"Training: {len(train_set)}")
-    print(f"Validation: {len(val_set)}")
-    
-    def copy_set(dataset, split_name):
-        for img, txt in dataset:
-            shutil.copy(os.path.join(RAW_DIR, img), os.path.join(IMAGES_DIR, split_name, img))
-            shutil.copy(os.path.join(RAW_DIR, txt), os.path.join(LABELS_DIR, split_name, txt))
-            
-    copy_set(train_set, 'train')
-    copy_set(val_set, 'val')
-    
-    create_yaml_config(classes)
-    print("\nDataset preparation complete! Ready for YOLO.")
+    yaml_path = os.path.join(dataset_dir, 'data.yaml')
+    content = yaml.dump(data_yaml, default_flow_style=False)
+    if os.path.exists(yaml_path):
+        with open(yaml_path) as f:
+            if f.read() == content:
+                return
+    with open(yaml_path, 'w') as f:
+        f.write(content)
+    print(f"Wrote data.yaml with classes: {classes}")
+
+def prepare_data(args):
+    for split in ['train', 'val']:
+        os.makedirs(os.path.join(args.dataset, 'images', split), exist_ok=True)
+        os.makedirs(os.path.join(args.dataset, 'labels', split), exist_ok=True)
+    manifest = Manifest(os.path.join(args.dataset, MANIFEST_NAME))
+    if manifest.val_fraction is not None and manifest.val_fraction != args.val_fraction:
+        # Every pair's split may change; moving them is still just relinking
+        print(f"Validation share changed ({manifest.val_fraction} -> {args.val_fraction}), re-splitting")
+    manifest.val_fraction = args.val_fraction
+
+    # 1. Find pairs and hash only what is new or touched since the last run
+    pairs = scan_pairs(args.raw)
+    hashed = hash_changed([e for pair in pairs.values() for e in pair], manifest, args.workers, args.rehash)
+
+    wanted = {}
+    for image, (image_entry, label_entry) in pairs.items():
+        sha = manifest.files[image][2]
+        if sha in wanted:
+            continue # Same photo under two names: keep one, so it cannot be in both train and val
+        wanted[sha] = {
+            "image": image,
+            "label": label_entry.name,
+            "label_sha256": manifest.files[label_entry.name][2],
+            "split": split_for(sha, args.val_fraction)
+        }
+    # Forget index entries for files that are gone
+    present = {e.name for pair in pairs.values() for e in pair}
+    manifest.files = {name: v for name, v in manifest.files.items() if name in present}
+
+    # 2. Remove pairs that disappeared or changed, then link the new ones
+    stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "copied": 0, "stale": 0}
+    updated = set()
+    for sha, old in list(manifest.pairs.items()):
+        new = wanted.get(sha)
+        if new == old and all(os.path.exists(p) for p in dest_paths(args.dataset, old)):
+            continue
+        for path in dest_paths(args.dataset, old):
+            remove_quietly(path)
+        del manifest.pairs[sha]
+        if new is None:
+            stats["removed"] += 1
+        else:
+            updated.add(sha) # Renamed, relabelled or re-split
+
+    for sha, pair in wanted.items():
+        if sha in manifest.pairs:
+            stats["unchanged"] += 1
+            continue
+        image_dst, label_dst = dest_paths(args.dataset, pair)
+        linked = link_or_copy(os.path.join(args.raw, pair["image"]), image_dst)
+        linked &= link_or_copy(os.path.join(args.raw, pair["label"]), label_dst)
+        stats["copied"] += not linked
+        manifest.pairs[sha] = pair
+        stats["updated" if sha in updated else "added"] += 1
+    manifest.save()
+    stats["stale"] = remove_stale(args.dataset, manifest)
+    write_yaml_config(args.dataset, read_classes(args.raw))
+
+    n_val = sum(p["split"] == 'val' for p in manifest.pairs.values())
+    print(f"Total pairs: {len(manifest.pairs)} (training {len(manifest.pairs) - n_val}, validation {n_val})")
+    print(f"Added {stats['added']}, updated {stats['updated']}, removed {stats['removed']}, "
+          f"unchanged {stats['unchanged']}; hashed {hashed} files")
+    if stats["stale"]:
+        print(f"Removed {stats['stale']} files not built from {args.raw}")
+    if stats["copied"]:
+        print(f"{stats['copied']} pairs were copied (hardlinks not possible between {args.raw} and {args.dataset})")
+    print("\nDataset is up to date. Ready for YOLO.")
+    return stats
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Incrementally build the YOLO dataset from labelled training photos")
+    parser.add_argument('--raw', default=RAW_DIR)
+    parser.add_argument('--dataset', default=DATASET_DIR)
+    parser.add_argument('--val-fraction', type=float, default=DEFAULT_VAL_FRACTION)
+    parser.add_argument('--workers', type=int, default=None, help="Hashing threads (default: CPU count)")
+    parser.add_argument('--rehash', action='store_true', help="Hash every file again instead of trusting size and mtime")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    prepare_data()
+    prepare_data(parse_args())
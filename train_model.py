@@ -22,6 +22,10 @@ def train():
     
     print("Training Complete!")
     print(f"Best model saved at: {results.save_dir}/weights/best.pt")
+    
+    # CPU inference in the server (DETECTOR=onnx) uses an ONNX export with a dynamic batch size
+    onnx_path = YOLO(f"{results.save_dir}/weights/best.pt").export(format='onnx', imgsz=640, dynamic=True)
+    print(f"ONNX model for the server: {onnx_path}")
 
 if __name__ == "__main__":
     train()